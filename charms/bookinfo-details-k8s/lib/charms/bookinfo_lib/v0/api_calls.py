@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""Accounting of the API calls a Bookinfo charm makes while handling a hook.
+
+This library counts and times the calls a charm makes to Pebble, to Juju hook tools (through
+the model backend) and to the Kubernetes API, and logs a summary of them at debug level once
+the hook is done. Tests can read the counts to hold each hook to a call budget.
+
+Hook tool calls are only reachable through the model backend of ops, and the Kubernetes
+client of the service mesh library through the attribute it documents for tests. Neither is
+public API, so they are only instrumented on the releases known to have them. On any other
+release the charm runs as usual, with a warning that those calls go uncounted.
+"""
+
+import logging
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+import ops
+from ops.charm import CharmBase
+from ops.framework import Object
+
+logger = logging.getLogger(__name__)
+
+LIBID = "api_calls_v0"
+LIBAPI = 0
+LIBPATCH = 3
+
+# Major releases of ops whose model backend runs the hook tools
+SUPPORTED_OPS_MAJOR = ("2",)
+# API version of the service mesh library whose Kubernetes client can be replaced
+SUPPORTED_MESH_LIBAPI = 0
+
+# Model backend methods that run a Juju hook tool
+HOOK_TOOL_METHODS = (
+    "action_fail",
+    "action_get",
+    "action_log",
+    "action_set",
+    "add_metrics",
+    "application_version_set",
+    "close_port",
+    "config_get",
+    "credential_get",
+    "is_leader",
+    "network_get",
+    "open_port",
+    "opened_ports",
+    "planned_units",
+    "relation_get",
+    "relation_ids",
+    "relation_list",
+    "relation_remote_app_name",
+    "relation_set",
+    "resource_get",
+    "secret_add",
+    "secret_get",
+    "secret_set",
+    "status_get",
+    "status_set",
+    "storage_get",
+    "storage_list",
+    "update_relation_data",
+)
+
+
+def _model_backend(charm: CharmBase) -> Optional[Any]:
+    """Return the model backend of ``charm``, which runs the Juju hook tools, if known."""
+    major = ops.__version__.split(".")[0]
+    backend = getattr(charm.model, "_backend", None)
+    if major not in SUPPORTED_OPS_MAJOR or not hasattr(backend, "relation_get"):
+        logger.warning(
+            f"Not counting hook tool calls with ops {ops.__version__}, "
+            f"only with ops {', '.join(f'{v}.x' for v in SUPPORTED_OPS_MAJOR)}"
+        )
+        return None
+    return backend
+
+
+class _CountedProxy:
+    """Forwards attribute access to a client, recording each method call it makes."""
+
+    def __init__(
+        self,
+        calls: "ApiCalls",
+        api: str,
+        target: Any = None,
+        factory: Optional[Callable[[], Any]] = None,
+    ):
+        self._calls = calls
+        self._api = api
+        self._target = target
+        self._factory = factory
+
+    def __getattr__(self, name: str):
+        if self._target is None and self._factory is not None:
+            self._target = self._factory()
+        attr = getattr(self._target, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        return self._calls.counted(self._api, name, attr)
+
+
+class ApiCalls(Object):
+    """Counts and times the Pebble, hook tool and Kubernetes calls made in a hook."""
+
+    def __init__(self, charm: CharmBase, key: str = "api-calls"):
+        super().__init__(charm, key)
+        self._charm = charm
+        self.counts: Counter = Counter()
+        self.seconds: Dict[Tuple[str, str], float] = defaultdict(float)
+        # APIs whose calls go uncounted, on releases lacking the internals instrumented
+        self.uncounted: Set[str] = set()
+
+        backend = _model_backend(charm)
+        if backend is None:
+            self.uncounted.add("hook-tools")
+        else:
+            self.instrument(backend, "hook-tools", HOOK_TOOL_METHODS)
+        for container in charm.unit.containers.values():
+            pebble = container.pebble
+            methods = [m for m in dir(pebble) if not m.startswith("_")]
+            self.instrument(pebble, "pebble", methods)
+
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    def instrument(self, client: Any, api: str, methods: Iterable[str]):
+        """Record the calls to the given methods of ``client`` under ``api``, in place."""
+        for method in methods:
+            func = getattr(client, method, None)
+            if callable(func) and not isinstance(func, type):
+                setattr(client, method, self.counted(api, method, func))
+
+    def counted(self, api: str, method: str, func: Callable) -> Callable:
+        """Return ``func`` recording its calls as ``method`` of ``api``."""
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.counts[api, method] += 1
+                self.seconds[api, method] += time.perf_counter() - start
+
+        return wrapper
+
+    def wrap(
+        self, api: str, target: Any = None, factory: Optional[Callable[[], Any]] = None
+    ) -> Any:
+        """Return a stand-in for a client whose method calls are recorded under ``api``.
+
+        With ``factory``, the client is only created on first use, so that hooks which do not
+        need it do not pay for it.
+        """
+        return _CountedProxy(self, api, target, factory)
+
+    def instrument_mesh(self, mesh: Any, factory: Callable[[], Any]):
+        """Record the Kubernetes calls of a service mesh consumer, made with a ``factory`` client.
+
+        The service mesh library has no public way to be given a client, so the attribute it
+        documents for tests is replaced, on the library API version known to have it. Other
+        versions keep their own client, with a warning.
+        """
+        lib = sys.modules[type(mesh).__module__]
+        if getattr(lib, "LIBAPI", None) != SUPPORTED_MESH_LIBAPI or not hasattr(
+            mesh, "_lightkube_client"
+        ):
+            logger.warning(
+                f"Not counting the Kubernetes calls of {lib.__name__} "
+                f"v{getattr(lib, 'LIBAPI', '?')}, only of v{SUPPORTED_MESH_LIBAPI}"
+            )
+            self.uncounted.add("kubernetes")
+            return
+        mesh._lightkube_client = self.wrap("kubernetes", factory=factory)
+
+    def total(self, api: str) -> int:
+        """Return how many calls were made to ``api``."""
+        return sum(count for (name, _), count in self.counts.items() if name == api)
+
+    def reset(self):
+        """Forget the calls recorded so far."""
+        self.counts.clear()
+        self.seconds.clear()
+
+    def summary(self) -> str:
+        """Describe the calls per API, with the time spent in them and the busiest methods."""
+        parts = []
+        for api in sorted({name for name, _ in self.counts}):
+            methods = {m: c for (name, m), c in self.counts.items() if name == api}
+            seconds = sum(s for (name, _), s in self.seconds.items() if name == api)
+            detail = ", ".join(f"{m} {c}" for m, c in sorted(methods.items()))
+            parts.append(
+                f"{api} {sum(methods.values())} calls in {seconds * 1000:.1f}ms ({detail})"
+            )
+        return "; ".join(parts) or "no calls"
+
+    def _on_commit(self, _):
+        """Log the calls of the hook once it has been handled."""
+        hook = os.environ.get("JUJU_DISPATCH_PATH", "hook")
+        logger.debug(f"API calls in {hook}: {self.summary()}")
+        self.reset()
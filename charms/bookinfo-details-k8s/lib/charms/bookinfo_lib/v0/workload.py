@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Health checks and drained restarts of a Bookinfo workload run by Pebble.
+
+Every Bookinfo charm runs one service in its workload container, next to a Pebble check that
+polls the service's health endpoint. This library defines that check and reads the health of
+the workload from it.
+
+Backend charms also restart their service by draining it first. A ready-level check fails
+while a marker file exists, so that Kubernetes stops routing new requests to the pod and the
+ones in flight can finish. A second check fails once the drain is over, so that Juju
+dispatches the hook that restarts the service: the hook changing the service returns straight
+away rather than waiting for the drain.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from typing import Dict
+
+from ops.charm import CharmBase
+from ops.framework import Object, StoredState
+from ops.model import Container
+from ops.pebble import CheckDict, CheckStatus, LayerDict, Service
+
+logger = logging.getLogger(__name__)
+
+LIBID = "workload_v0"
+LIBAPI = 0
+LIBPATCH = 3
+
+# Seconds a health request may take, Pebble's default unless the check period is shorter
+HEALTH_CHECK_TIMEOUT = 3.0
+# Seconds between drain checks, which Pebble may take to report the workload not ready
+DRAIN_CHECK_PERIOD = 1.0
+
+
+class PebbleWorkload(Object):
+    """A service in a workload container, with its health check and drained restarts.
+
+    The checks are named after the service: ``<service>-health`` polls its health endpoint,
+    while ``<service>-drain`` and ``<service>-drained`` only run during a drain.
+    """
+
+    _stored = StoredState()
+
+    def __init__(self, charm: CharmBase, container: Container, service: str, port: int):
+        super().__init__(charm, f"{service}-workload")
+        self.container = container
+        self.service = service
+        self.port = port
+        self.health_check = f"{service}-health"
+        self.drain_check = f"{service}-drain"
+        self.drained_check = f"{service}-drained"
+        # While this file exists the workload reports not ready. It holds the time, in
+        # seconds since the epoch, at which the drain is over.
+        self.drain_marker = f"/tmp/{service}.drain"
+        # Hash of the last layer applied, so that an unchanged one leaves the container alone
+        self._stored.set_default(layer_hash="", drain_until=0.0)
+
+    def reset(self):
+        """Forget the layer applied and any drain, which a new workload container has lost."""
+        self._stored.layer_hash = ""
+        self._stored.drain_until = 0.0
+
+    def handles(self, check: str) -> bool:
+        """Return whether a change of ``check`` calls for a reconcile.
+
+        The drained check failing means a drain is over and the service can be restarted.
+        """
+        return check in (self.health_check, self.drained_check)
+
+    def checks(self, period: float, threshold: int, drain: bool = True) -> Dict[str, CheckDict]:
+        """Return the health check polling every ``period`` seconds, and the drain checks."""
+        checks: Dict[str, CheckDict] = {
+            self.health_check: {
+                "override": "replace",
+                "level": "ready",
+                "period": f"{period:g}s",
+                "timeout": f"{min(HEALTH_CHECK_TIMEOUT, period / 2):g}s",
+                "threshold": threshold,
+                "http": {"url": f"http://localhost:{self.port}/health"},
+            }
+        }
+        if not drain:
+            return checks
+        checks[self.drain_check] = {
+            "override": "replace",
+            "level": "ready",
+            "startup": "disabled",
+            "period": f"{DRAIN_CHECK_PERIOD:g}s",
+            "threshold": 1,
+            "exec": {"command": f"test ! -e {self.drain_marker}"},
+        }
+        checks[self.drained_check] = {
+            "override": "replace",
+            "startup": "disabled",
+            "period": f"{DRAIN_CHECK_PERIOD:g}s",
+            "threshold": 1,
+            "exec": {
+                "command": f"sh -c 'test ! -e {self.drain_marker} || "
+                f'test "$(date +%s)" -lt "$(cat {self.drain_marker})"\''
+            },
+        }
+        return checks
+
+    def apply(self, layer: LayerDict, drain_timeout: float = 0.0):
+        """Apply ``layer`` to the container, draining the running service before a restart.
+
+        A change to the running service is applied by draining it first: the workload is
+        reported not ready for ``drain_timeout`` seconds, and the first hook after that
+        restarts it. The hash of the last layer applied is kept, so that the container is
+        left alone while that layer is unchanged, in the plan and running. During a drain the
+        layer is always applied, so that a change reverted before the drain is over replaces
+        the one waiting in the plan, and the drain still ends.
+        """
+        layer_hash = hashlib.sha256(json.dumps(layer, sort_keys=True).encode()).hexdigest()
+        current = self.container.get_plan().services.get(self.service)
+        service = Service(self.service, layer["services"][self.service])
+        if (
+            not self._stored.drain_until
+            and layer_hash == self._stored.layer_hash
+            and current == service
+            and self.is_running()
+        ):
+            logger.debug("Service layer unchanged")
+            return
+
+        self.container.add_layer(self.service, layer, combine=True)
+        changed = self.container.get_plan().services.get(self.service) != current
+        if changed and current is not None:
+            self._start_drain(drain_timeout)
+        if self._stored.drain_until > time.time():
+            logger.debug("Service restart waits for the workload to drain")
+            return
+
+        try:
+            self.container.replan()
+            logger.info("Service layer updated")
+        except Exception as e:
+            logger.error(f"Failed to replan service: {e}")
+            raise
+        if self._stored.drain_until:
+            self._end_drain()
+        self._stored.layer_hash = layer_hash
+
+    def is_running(self) -> bool:
+        """Return whether the workload service exists and is running."""
+        services = self.container.get_services(self.service)
+        return self.service in services and services[self.service].is_running()
+
+    def health_problem(self) -> str:
+        """Return why the workload is not healthy, or an empty string if it is.
+
+        Pebble only reports the check down once it has failed ``threshold`` times in a row. A
+        check that has not run yet says nothing about the workload, so it counts as healthy
+        rather than withdrawing the URL of a workload that has just started.
+        """
+        check = self.container.get_checks(self.health_check).get(self.health_check)
+        if check is not None and check.status == CheckStatus.DOWN:
+            return "Health check failing"
+        return ""
+
+    def is_serving(self) -> bool:
+        """Return whether the workload is running and passing its health check."""
+        return self.container.can_connect() and self.is_running() and not self.health_problem()
+
+    def _start_drain(self, drain_timeout: float):
+        """Take the running workload out of rotation so that in-flight requests can finish."""
+        if drain_timeout <= 0 or self._stored.drain_until or not self.is_running():
+            return
+        logger.info(f"Draining the workload for {drain_timeout:g}s before restarting it")
+        drain_until = time.time() + DRAIN_CHECK_PERIOD + drain_timeout
+        self.container.push(self.drain_marker, str(int(drain_until) + 1), make_dirs=True)
+        self.container.start_checks(self.drain_check, self.drained_check)
+        self._stored.drain_until = drain_until
+
+    def _end_drain(self):
+        """Put the restarted workload back in rotation."""
+        self.container.stop_checks(self.drain_check, self.drained_check)
+        self.container.remove_path(self.drain_marker)
+        self._stored.drain_until = 0.0
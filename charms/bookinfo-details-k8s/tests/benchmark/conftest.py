@@ -0,0 +1,7 @@
+"""Fixtures for details charm hook latency benchmarks."""
+
+from charms.bookinfo_lib.v0.benchmark import benchmark_fixture
+
+CHARM = "bookinfo-details-k8s"
+
+benchmark = benchmark_fixture(CHARM)
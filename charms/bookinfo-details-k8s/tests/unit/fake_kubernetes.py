@@ -0,0 +1,80 @@
+"""Fake Kubernetes API for unit tests that hold hooks to a call budget."""
+
+from typing import Any, Dict, Tuple
+
+
+class FakeKubernetes:
+    """In-process stand-in for a lightkube client.
+
+    Objects are kept by kind and name. Patches merge into the stored object, creating it when
+    missing, and missing objects raise the same 404 a cluster would.
+    """
+
+    def __init__(self):
+        self.objects: Dict[Tuple[str, str], Any] = {}
+
+    @staticmethod
+    def _kind(res: Any, obj: Any = None) -> str:
+        return (res or type(obj)).__name__
+
+    @staticmethod
+    def _name(obj: Any) -> str:
+        if isinstance(obj, dict):
+            return obj["metadata"]["name"]
+        return obj.metadata.name
+
+    def _not_found(self, kind: str, name: str):
+        import httpx
+
+        request = httpx.Request("GET", f"https://kubernetes/{kind}/{name}")
+        response = httpx.Response(404, request=request)
+        return httpx.HTTPStatusError(
+            f"{kind} {name} not found", request=request, response=response
+        )
+
+    def get(self, res: Any, name: str, **_) -> Any:
+        """Return a stored object, or raise a 404 error."""
+        try:
+            return self.objects[self._kind(res), name]
+        except KeyError:
+            raise self._not_found(self._kind(res), name) from None
+
+    def create(self, obj: Any, **_) -> Any:
+        """Store a new object."""
+        self.objects[self._kind(None, obj), self._name(obj)] = obj
+        return obj
+
+    def apply(self, obj: Any, **_) -> Any:
+        """Store an object, replacing any with the same kind and name."""
+        return self.create(obj)
+
+    def patch(self, res: Any, name: str, obj: Any, **_) -> Any:
+        """Merge a patch into a stored object, which is created if missing."""
+        key = (self._kind(res), name)
+        current = self.objects.get(key)
+        if isinstance(obj, dict) and isinstance(current, dict):
+            obj = _merge(current, obj)
+        self.objects[key] = obj
+        return obj
+
+    def delete(self, res: Any, name: str, **_):
+        """Remove a stored object, or raise a 404 error."""
+        if self.objects.pop((self._kind(res), name), None) is None:
+            raise self._not_found(self._kind(res), name)
+
+    def list(self, res: Any, **_) -> list:
+        """Return the stored objects of a kind."""
+        return [obj for (kind, _), obj in self.objects.items() if kind == self._kind(res)]
+
+
+def _merge(current: dict, patch: dict) -> dict:
+    """Merge ``patch`` into ``current`` as a JSON merge patch would."""
+    merged = dict(current)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
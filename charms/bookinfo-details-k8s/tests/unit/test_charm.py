@@ -1,11 +1,27 @@
 """Unit tests for details charm."""
 
+import json
+import os
+import subprocess
+import sys
 import unittest
+from unittest.mock import patch
 
 import ops.testing
+from fake_kubernetes import FakeKubernetes
 
 from charm import DetailsK8sCharm
 
+# Libraries the charm imports only in the hooks that use them
+DEFERRED_MODULES = {
+    "charms.istio_beacon_k8s.v0.service_mesh",
+    "lightkube",
+    "pydantic",
+    "httpx",
+}
+# Calls an update-status hook may make to each API once the workload is running
+UPDATE_STATUS_BUDGET = {"pebble": 5, "hook-tools": 2, "kubernetes": 0}
+
 
 class TestDetailsCharm(unittest.TestCase):
     """Test cases for DetailsK8sCharm."""
@@ -27,3 +43,142 @@ class TestDetailsCharm(unittest.TestCase):
             self.harness.model.unit.status,
             (ops.WaitingStatus, ops.ActiveStatus, ops.MaintenanceStatus),
         )
+
+    def test_config_change_applied_once_drained(self):
+        """Test that a config change drains the workload and restarts it when drained."""
+        self.harness.container_pebble_ready("bookinfo-details")
+        container = self.harness.charm.container
+        with patch("charms.bookinfo_lib.v0.workload.time.time", return_value=1000.0):
+            self.harness.update_config({"log-level": "debug"})
+        self.assertTrue(container.exists("/tmp/details.drain"))
+
+        with patch("charms.bookinfo_lib.v0.workload.time.time", return_value=1007.0):
+            self.harness.charm.on.bookinfo_details_pebble_check_failed.emit(
+                container, "details-drained"
+            )
+        self.assertFalse(container.exists("/tmp/details.drain"))
+        plan = self.harness.get_container_pebble_plan("bookinfo-details")
+        self.assertEqual(plan.services["details"].environment["LOG_LEVEL"], "debug")
+
+    def test_unchanged_state_skips_replan(self):
+        """Test that a hook with the same desired state does not replan the workload."""
+        self.harness.container_pebble_ready("bookinfo-details")
+        with patch.object(ops.Container, "replan") as replan:
+            self.harness.charm.on.update_status.emit()
+        replan.assert_not_called()
+
+        with patch.object(ops.Container, "replan") as replan:
+            self.harness.update_config({"log-level": "debug", "drain-timeout": 0.0})
+        replan.assert_called_once()
+
+    def test_url_published_while_healthy(self):
+        """Test that the URL is published unless the workload fails its health check."""
+        self.harness.set_leader(True)
+        rel_id = self.harness.add_relation("details", "bookinfo-productpage-k8s")
+        self.harness.add_relation_unit(rel_id, "bookinfo-productpage-k8s/0")
+        data = self.harness.get_relation_data(rel_id, self.harness.charm.app)
+        self.assertEqual(data, {"ready": "false"})
+
+        # A check Pebble has just added has not run yet, which does not withdraw the URL
+        self.harness.set_can_connect("bookinfo-details", True)
+        container = self.harness.charm.container
+        container.add_layer("details", self.harness.charm._generate_layer())
+        check = container.get_check("details-health")
+        check.successes = 0
+        self.harness.container_pebble_ready("bookinfo-details")
+        url = "http://bookinfo-details-k8s:9080"
+        self.assertEqual(data, {"url": url, "ready": "true", "generation": "1"})
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus("Ready"))
+
+        # Pebble reports the check down once it has failed the threshold number of times
+        check.status = ops.pebble.CheckStatus.DOWN
+        self.harness.charm.on.bookinfo_details_pebble_check_failed.emit(container, check.name)
+        self.assertEqual(data, {"ready": "false", "generation": "1"})
+
+        check.status = ops.pebble.CheckStatus.UP
+        self.harness.charm.on.bookinfo_details_pebble_check_recovered.emit(container, check.name)
+        self.assertEqual(data, {"url": url, "ready": "true", "generation": "2"})
+
+    def test_import_defers_heavy_libraries(self):
+        """Test that importing the charm leaves out the mesh, Kubernetes and validation libs."""
+        code = "import sys, charm; print(*sys.modules)"
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        result = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+        )
+        self.assertFalse(DEFERRED_MODULES & set(result.stdout.split()))
+
+    def test_mesh_set_up_only_in_its_hooks(self):
+        """Test that the service mesh library is only loaded for the hooks it handles."""
+        for hook, expected in (("update-status", False), ("details-relation-created", True)):
+            with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": f"hooks/{hook}"}):
+                harness = ops.testing.Harness(DetailsK8sCharm)
+                self.addCleanup(harness.cleanup)
+                harness.begin()
+            self.assertEqual(hasattr(harness.charm, "_mesh"), expected, hook)
+
+    def test_update_status_within_call_budget(self):
+        """Test that update-status stays within its budget of API calls."""
+        self.harness.container_pebble_ready("bookinfo-details")
+        calls = self.harness.charm.api_calls
+        calls.reset()
+        self.harness.charm.on.update_status.emit()
+        for api, budget in UPDATE_STATUS_BUDGET.items():
+            self.assertLessEqual(calls.total(api), budget, calls.summary())
+
+    def test_mesh_labels_within_kubernetes_budget(self):
+        """Test that joining the mesh labels the workload with one read and four writes."""
+        # The mesh library looks its relation up when the charm starts
+        harness = ops.testing.Harness(DetailsK8sCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        rel_id = harness.add_relation("service-mesh", "istio-beacon-k8s")
+        kubernetes = FakeKubernetes()
+        with patch.object(DetailsK8sCharm, "_lightkube_client", return_value=kubernetes):
+            harness.begin()
+            calls = harness.charm.api_calls
+            calls.reset()
+
+            labels = {"istio.io/dataplane-mode": "ambient"}
+            harness.update_relation_data(
+                rel_id,
+                "istio-beacon-k8s",
+                {"labels": json.dumps(labels), "mesh_type": json.dumps("istio")},
+            )
+        self.assertEqual(calls.total("kubernetes"), 5, calls.summary())
+        service = kubernetes.objects["Service", "bookinfo-details-k8s"]
+        self.assertEqual(service["metadata"]["labels"], labels)
+
+    def test_unknown_ops_release_skips_hook_tools(self):
+        """Test that the charm runs uncounted on an ops release not known to work."""
+        harness = ops.testing.Harness(DetailsK8sCharm)
+        self.addCleanup(harness.cleanup)
+        with patch.object(ops, "__version__", "3.0.0"), self.assertLogs(level="WARNING") as logs:
+            harness.begin()
+        self.assertIn("Not counting hook tool calls with ops 3.0.0", logs.output[0])
+        calls = harness.charm.api_calls
+        self.assertEqual(calls.uncounted, {"hook-tools"})
+
+        harness.set_can_connect("bookinfo-details", True)
+        harness.container_pebble_ready("bookinfo-details")
+        self.assertEqual(calls.total("hook-tools"), 0)
+        self.assertIsInstance(harness.model.unit.status, ops.ActiveStatus)
+
+    def test_health_check_drives_status(self):
+        """Test that the status follows the health check as soon as it fails or recovers."""
+        self.harness.container_pebble_ready("bookinfo-details")
+        plan = self.harness.get_container_pebble_plan("bookinfo-details")
+        health = plan.checks["details-health"]
+        self.assertEqual(health.http, {"url": "http://localhost:9080/health"})
+        self.assertEqual((health.period, health.threshold), ("10s", 3))
+
+        container = self.harness.charm.container
+        events = self.harness.charm.on
+        check = container.get_check("details-health")
+        check.status = ops.pebble.CheckStatus.DOWN
+        events.bookinfo_details_pebble_check_failed.emit(container, "details-health")
+        self.assertEqual(self.harness.model.unit.status.message, "Health check failing")
+
+        check.status = ops.pebble.CheckStatus.UP
+        events.bookinfo_details_pebble_check_recovered.emit(container, "details-health")
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)
@@ -4,30 +4,50 @@
 
 This library provides a minimal interface for Bookinfo services to communicate
 with each other through Juju relations.
+
+A provider publishes its URL only while its workload is ready, next to a ``ready`` flag and
+a ``generation`` counter that goes up every time the URL is published again after having
+been retracted. Consumers see the URL disappear while the provider is not ready.
+
+The URL is application data, so only the leader writes it, and the readiness it goes by is
+that of the leader's own workload: while the leader is unhealthy the URL is retracted for the
+whole application, even if other units are still serving.
 """
 
 import logging
 import socket
-from typing import Optional
+from typing import Callable, Optional
 
 from ops.charm import CharmBase
-from ops.framework import EventBase, EventSource, Object, ObjectEvents
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
 
 logger = logging.getLogger(__name__)
 
 LIBID = "bookinfo_service_v0"
 LIBAPI = 0
-LIBPATCH = 3
+LIBPATCH = 6
 
 
 class BookinfoServiceProvider(Object):
     """Provider side of a Bookinfo service relation."""
     
-    def __init__(self, charm: CharmBase, relation_name: str, port: int):
+    def __init__(
+        self,
+        charm: CharmBase,
+        relation_name: str,
+        port: int,
+        ready: Optional[Callable[[], bool]] = None,
+    ):
+        """Publish the service URL, gated on ``ready`` if given.
+
+        Charms passing ``ready`` call ``update`` whenever their workload may have become
+        ready or stopped being so.
+        """
         super().__init__(charm, relation_name)
         self._charm = charm
         self._relation_name = relation_name
         self._port = port
+        self._ready = ready
         
         events = self._charm.on[relation_name]
         self.framework.observe(events.relation_joined, self._on_relation_joined)
@@ -41,33 +61,64 @@ class BookinfoServiceProvider(Object):
         """Handle relation changed."""
         self._update_relation_data(event.relation)
     
-    def _update_relation_data(self, relation):
-        """Update relation data with service URL."""
+    def update(self, ready: Optional[bool] = None):
+        """Publish or retract the URL on every relation, per the workload readiness.
+
+        Args:
+            ready: Whether the workload is ready, when the caller already knows; otherwise the
+                ``ready`` callable given at construction is asked.
+        """
+        relations = self._charm.model.relations.get(self._relation_name, [])
+        if not relations:
+            return
+        if ready is None:
+            ready = self._is_ready()
+        for relation in relations:
+            self._update_relation_data(relation, ready)
+
+    def _is_ready(self) -> bool:
+        """Return whether the workload is ready to be sent traffic."""
+        return self._ready is None or self._ready()
+
+    def _update_relation_data(self, relation, ready: Optional[bool] = None):
+        """Update relation data with service URL, or retract it while not ready."""
         if not self._charm.unit.is_leader():
             return
-        
-        # Use socket.getfqdn() to get the FQDN
-        # fqdn = socket.getfqdn()
+        if ready is None:
+            ready = self._is_ready()
+
+        data = relation.data[self._charm.app]
         url = f"http://{self._charm.app.name}:{self._port}"
-        
-        relation.data[self._charm.app]["url"] = url
-        logger.info(f"Published URL: {url}")
+        if not ready:
+            if data.get("ready") != "false":
+                data["ready"] = "false"
+                data.pop("url", None)
+                logger.info(f"Retracted URL: {url}")
+            return
+        if data.get("ready") == "true" and data.get("url") == url:
+            return
+
+        generation = int(data.get("generation") or 0) + 1
+        data.update({"url": url, "ready": "true", "generation": str(generation)})
+        logger.info(f"Published URL: {url} (generation {generation})")
 
 
 class ServiceUrlChangedEvent(EventBase):
-    """Event emitted when service URL changes."""
+    """Event emitted when service URL changes, with the URL seen before it."""
     
-    def __init__(self, handle, url: Optional[str]):
+    def __init__(self, handle, url: Optional[str], old_url: Optional[str] = None):
         super().__init__(handle)
         self.url = url
+        self.old_url = old_url
     
     def snapshot(self):
         """Save event data for persistence across hook executions."""
-        return {"url": self.url}
+        return {"url": self.url, "old_url": self.old_url}
     
     def restore(self, snapshot):
         """Restore event data from snapshot."""
         self.url = snapshot["url"]
+        self.old_url = snapshot.get("old_url")
 
 
 class BookinfoServiceConsumerEvents(ObjectEvents):
@@ -77,14 +128,21 @@ class BookinfoServiceConsumerEvents(ObjectEvents):
 
 
 class BookinfoServiceConsumer(Object):
-    """Consumer side of a Bookinfo service relation."""
+    """Consumer side of a Bookinfo service relation.
+
+    ``url_changed`` is only emitted when the URL of a relation differs from the one last
+    seen, so that changes to other keys of the databag do not cause a reconcile.
+    """
     
     on = BookinfoServiceConsumerEvents()
+    _stored = StoredState()
     
     def __init__(self, charm: CharmBase, relation_name: str):
         super().__init__(charm, relation_name)
         self._charm = charm
         self._relation_name = relation_name
+        # Last URL seen per relation id; keys are strings as stored state requires
+        self._stored.set_default(urls={})
         
         events = self._charm.on[relation_name]
         self.framework.observe(events.relation_joined, self._on_relation_joined)
@@ -101,13 +159,25 @@ class BookinfoServiceConsumer(Object):
             return
         
         data = event.relation.data[event.app]
-        url = data.get("url")
+        url = data.get("url") or None
+        if not url and data.get("ready") != "false":
+            # Nothing published yet
+            return
+
+        key = str(event.relation.id)
+        old_url = self._stored.urls.get(key)
+        if url == old_url:
+            return
+        self._stored.urls[key] = url
         
         if url:
             logger.info(f"Received URL from {event.app.name}: {url}")
-            self.on.url_changed.emit(url)
+        else:
+            logger.info(f"{event.app.name} retracted its URL until it is ready")
+        self.on.url_changed.emit(url, old_url)
     
     def _on_relation_broken(self, event):
         """Handle relation broken."""
         logger.info(f"Broken {self._relation_name} relation")
-        self.on.url_changed.emit(None)
+        old_url = self._stored.urls.pop(str(event.relation.id), None)
+        self.on.url_changed.emit(None, old_url)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""Which hook Juju is dispatching to a Bookinfo charm.
+
+Charms use this library to set up other libraries only in the hooks that need them, so that
+every other hook skips importing them. The service mesh library pulls in lightkube and
+pydantic, and only handles the hooks of a few relations.
+"""
+
+import os
+from typing import Iterable, Tuple
+
+from ops.charm import CharmMeta, RelationRole
+
+LIBID = "dispatch_v0"
+LIBAPI = 0
+LIBPATCH = 1
+
+# Interfaces of the relations the service mesh library manages itself
+MESH_INTERFACES = ("service_mesh", "cross_model_mesh")
+
+
+def dispatching(relations: Iterable[str] = (), hooks: Iterable[str] = ()) -> bool:
+    """Return whether Juju is dispatching one of ``hooks`` or a hook of ``relations``.
+
+    Outside of a Juju dispatch, as in unit tests, any hook may follow.
+    """
+    path = os.environ.get("JUJU_DISPATCH_PATH")
+    if not path:
+        return True
+    hook = path.rpartition("/")[2]
+    return hook in hooks or any(hook.startswith(f"{r}-relation-") for r in relations)
+
+
+def mesh_relations(meta: CharmMeta) -> Tuple[str, ...]:
+    """Return the relations whose hooks the service mesh library may handle.
+
+    Those are the relations of the mesh interfaces and, since mesh policies authorize the
+    traffic that related applications send to the workload, every relation the charm
+    provides or has with its peers. Reading them from the charm's metadata keeps them in
+    step with the policies without a list to maintain by hand.
+    """
+    return tuple(
+        name
+        for name, relation in meta.relations.items()
+        if relation.interface_name in MESH_INTERFACES
+        or relation.role in (RelationRole.provides, RelationRole.peer)
+    )
+
+
+def mesh_dispatching(meta: CharmMeta) -> bool:
+    """Return whether the hook being dispatched may need the service mesh library."""
+    return dispatching(mesh_relations(meta), hooks=("upgrade-charm",))
@@ -0,0 +1,33 @@
+"""Unit tests for the benchmark library."""
+
+import unittest
+from unittest.mock import patch
+
+from charms.bookinfo_lib.v0.benchmark import HookBenchmark, import_time
+
+
+class TestHookBenchmark(unittest.TestCase):
+    """Test cases for HookBenchmark."""
+
+    def test_records_each_event(self):
+        """Test that an event is dispatched once per round, after an untimed warm-up and setup."""
+        calls = []
+        recorder = HookBenchmark(rounds=4)
+        recorder("event", lambda: calls.append("dispatch"), setup=lambda: calls.append("setup"))
+        # One warm-up and one traced dispatch besides the timed ones, each after its setup
+        self.assertEqual(calls, ["setup", "dispatch"] * 6)
+        result = recorder.results["event"]
+        self.assertLessEqual(result["median_seconds"], result["p90_seconds"])
+        self.assertLessEqual(result["p90_seconds"], result["max_seconds"])
+
+    def test_report(self):
+        """Test that the report names the charm and holds its import time."""
+        recorder = HookBenchmark(rounds=1)
+        with patch("charms.bookinfo_lib.v0.benchmark.import_time", return_value=0.1):
+            report = recorder.report("bookinfo-test")
+        self.assertEqual(report["charm"], "bookinfo-test")
+        self.assertEqual(report["import_seconds"], 0.1)
+
+    def test_import_time(self):
+        """Test that the import time of a module is read from a fresh interpreter."""
+        self.assertGreater(import_time("json"), 0)
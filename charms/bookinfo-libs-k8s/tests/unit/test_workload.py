@@ -0,0 +1,167 @@
+"""Unit tests for the workload library."""
+
+import unittest
+from unittest.mock import patch
+
+import ops
+import ops.testing
+from charms.bookinfo_lib.v0.workload import PebbleWorkload
+
+METADATA = """
+name: bookinfo-test
+containers:
+  workload: {}
+"""
+
+
+class WorkloadCharm(ops.CharmBase):
+    """Charm running a test service through ``PebbleWorkload``."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.container = self.unit.get_container("workload")
+        self.workload = PebbleWorkload(self, self.container, "test", 9080)
+        self.log_level = "info"
+        self.drain_timeout = 5.0
+
+    def layer(self) -> ops.pebble.LayerDict:
+        """Return the layer of the test service."""
+        return {
+            "services": {
+                "test": {
+                    "override": "replace",
+                    "command": "test-server",
+                    "startup": "enabled",
+                    "environment": {"LOG_LEVEL": self.log_level},
+                }
+            },
+            "checks": self.workload.checks(10.0, 3),
+        }
+
+    def apply(self):
+        """Apply the layer of the test service."""
+        self.workload.apply(self.layer(), self.drain_timeout)
+
+
+def at(seconds: float):
+    """Patch the time the workload library reads."""
+    return patch("charms.bookinfo_lib.v0.workload.time.time", return_value=seconds)
+
+
+class TestPebbleWorkload(unittest.TestCase):
+    """Test cases for PebbleWorkload."""
+
+    def setUp(self):
+        """Start the test service."""
+        self.harness = ops.testing.Harness(WorkloadCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.harness.set_can_connect("workload", True)
+        self.charm = self.harness.charm
+        self.container = self.charm.container
+        self.charm.apply()
+
+    def plan_log_level(self) -> str:
+        """Return the log level of the service in the plan."""
+        plan = self.harness.get_container_pebble_plan("workload")
+        return plan.services["test"].environment["LOG_LEVEL"]
+
+    def test_checks(self):
+        """Test that the health check polls the service and the drain checks start disabled."""
+        plan = self.harness.get_container_pebble_plan("workload")
+        health = plan.checks["test-health"]
+        self.assertEqual(health.http, {"url": "http://localhost:9080/health"})
+        self.assertEqual((health.period, health.timeout, health.threshold), ("10s", "3s", 3))
+        self.assertEqual(plan.checks["test-drain"].level, ops.pebble.CheckLevel.READY)
+        inactive = ops.pebble.CheckStatus.INACTIVE
+        self.assertEqual(self.container.get_check("test-drain").status, inactive)
+        self.assertEqual(self.container.get_check("test-drained").status, inactive)
+        self.assertEqual(list(self.charm.workload.checks(1.0, 1, drain=False)), ["test-health"])
+
+    def test_change_drains_before_restart(self):
+        """Test that a changed service is reported not ready and restarted once drained."""
+        inactive = ops.pebble.CheckStatus.INACTIVE
+        self.charm.log_level = "debug"
+        with at(1000.0), patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+            self.charm.apply()
+        # The hook returns straight away, leaving the restart to the hook after the drain
+        replan.assert_not_called()
+        self.assertEqual(self.container.pull("/tmp/test.drain").read(), "1007")
+        self.assertNotEqual(self.container.get_check("test-drain").status, inactive)
+
+        with at(1007.0), patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+        replan.assert_called_once()
+        self.assertFalse(self.container.exists("/tmp/test.drain"))
+        self.assertEqual(self.container.get_check("test-drain").status, inactive)
+        self.assertEqual(self.container.get_check("test-drained").status, inactive)
+        self.assertEqual(self.plan_log_level(), "debug")
+
+    def test_change_reverted_during_drain(self):
+        """Test that a drain still ends when its change is reverted before the deadline."""
+        self.charm.log_level = "debug"
+        with at(1000.0):
+            self.charm.apply()
+            self.charm.log_level = "info"
+            self.charm.apply()
+        # The reverted layer replaces the change waiting in the plan
+        self.assertEqual(self.plan_log_level(), "info")
+        self.assertTrue(self.container.exists("/tmp/test.drain"))
+
+        with at(1007.0), patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+        replan.assert_called_once()
+        self.assertFalse(self.container.exists("/tmp/test.drain"))
+        inactive = ops.pebble.CheckStatus.INACTIVE
+        self.assertEqual(self.container.get_check("test-drain").status, inactive)
+
+        with at(1008.0), patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+        replan.assert_not_called()
+
+    def test_plan_drift_is_reapplied(self):
+        """Test that a plan no longer holding the layer applied gets it back."""
+        self.charm.drain_timeout = 0.0
+        self.container.add_layer(
+            "test", {"services": {"test": {"override": "merge", "command": "other"}}}, combine=True
+        )
+        self.charm.apply()
+        plan = self.harness.get_container_pebble_plan("workload")
+        self.assertEqual(plan.services["test"].command, "test-server")
+
+    def test_unchanged_layer_leaves_service_alone(self):
+        """Test that applying the same layer neither drains nor replans the service."""
+        with patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+        replan.assert_not_called()
+        self.assertFalse(self.container.exists("/tmp/test.drain"))
+
+        self.charm.log_level = "debug"
+        self.charm.drain_timeout = 0.0
+        with patch.object(ops.Container, "replan") as replan:
+            self.charm.apply()
+        replan.assert_called_once()
+        self.assertFalse(self.container.exists("/tmp/test.drain"))
+
+    def test_handles_health_and_drained_checks(self):
+        """Test that the health and drained checks call for a reconcile, the drain one not."""
+        workload = self.charm.workload
+        self.assertTrue(workload.handles("test-health"))
+        self.assertTrue(workload.handles("test-drained"))
+        self.assertFalse(workload.handles("test-drain"))
+
+    def test_health_problem_follows_check(self):
+        """Test that the workload is serving unless its health check is down."""
+        workload = self.charm.workload
+        # A check that has not run yet leaves the workload serving
+        check = self.container.get_check("test-health")
+        check.successes = 0
+        self.assertTrue(workload.is_serving())
+
+        check.status = ops.pebble.CheckStatus.DOWN
+        self.assertEqual(workload.health_problem(), "Health check failing")
+        self.assertFalse(workload.is_serving())
+
+        check.status = ops.pebble.CheckStatus.UP
+        self.assertEqual(workload.health_problem(), "")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""Hook latency benchmarks of the Bookinfo charms.
+
+Each charm's benchmarks dispatch its events with ``ops.testing`` and record how long they take
+and how much they allocate, along with the import time of the charm and the setup of hooks in
+fresh interpreters, as Juju dispatches them. The results are written as JSON at the end of the
+run. A charm's ``tests/benchmark/conftest.py`` only names the charm::
+
+    from charms.bookinfo_lib.v0.benchmark import benchmark_fixture
+
+    benchmark = benchmark_fixture("bookinfo-details-k8s")
+
+This library is only used by tests, and imports pytest in the fixture rather than at import.
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import ops
+
+LIBID = "benchmark_v0"
+LIBAPI = 0
+LIBPATCH = 2
+
+# Times each event is dispatched, and where the results are written
+ROUNDS = int(os.environ.get("BENCHMARK_ROUNDS", "50"))
+OUTPUT = Path(os.environ.get("BENCHMARK_OUTPUT", "benchmark.json"))
+# Seconds a fresh interpreter may take to import the charm, which every hook pays. Importing
+# the service mesh library up front takes well over this.
+IMPORT_BUDGET = float(os.environ.get("BENCHMARK_IMPORT_BUDGET", "0.3"))
+# Fresh interpreters each cold hook is dispatched in, which take far longer than a dispatch
+COLD_ROUNDS = int(os.environ.get("BENCHMARK_COLD_ROUNDS", "5"))
+MESH_MODULE = "charms.istio_beacon_k8s.v0.service_mesh"
+# Imports the charm and sets it up for a hook in a fresh interpreter, as Juju dispatches it
+COLD_DISPATCH = """
+import sys, time, ops.testing
+start = time.perf_counter()
+from {module} import {name} as charm_class
+harness = ops.testing.Harness(charm_class)
+harness.begin()
+print(time.perf_counter() - start, {mesh!r} in sys.modules)
+harness.cleanup()
+"""
+
+
+class HookBenchmark:
+    """Records the wall time and memory allocations of dispatching events to a charm."""
+
+    def __init__(self, rounds: int):
+        self.rounds = rounds
+        self.results: Dict[str, Dict[str, float]] = {}
+        self.cold_results: Dict[str, Dict[str, object]] = {}
+        self._import_seconds: Optional[float] = None
+
+    def __call__(
+        self, event: str, dispatch: Callable[[], object], setup: Optional[Callable] = None
+    ):
+        """Dispatch an event ``rounds`` times and record how long it took.
+
+        ``setup`` runs before each dispatch without being timed, for events that need fresh
+        state such as a relation to break. Allocations are traced in one more dispatch, apart
+        from the timed ones that tracing would slow down.
+        """
+        times = []
+        for _ in range(self.rounds + 1):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            dispatch()
+            times.append(time.perf_counter() - start)
+        # The first dispatch imports whatever the event needs and is not representative
+        times = sorted(times[1:])
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            dispatch()
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.results[event] = {
+            "median_seconds": statistics.median(times),
+            "p90_seconds": times[int(0.9 * (len(times) - 1))],
+            "max_seconds": times[-1],
+            "peak_bytes": peak,
+            "retained_bytes": retained,
+        }
+
+    def cold(self, event: str, charm_class: type, hook: str) -> bool:
+        """Set the charm up for ``hook`` in fresh interpreters and record how long it took.
+
+        This is the path of every hook on a deployed unit, which imports the charm and the
+        libraries the hook needs anew. Returns whether the service mesh library was imported.
+        """
+        code = COLD_DISPATCH.format(
+            module=charm_class.__module__, name=charm_class.__name__, mesh=MESH_MODULE
+        )
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(sys.path),
+            "JUJU_DISPATCH_PATH": f"hooks/{hook}",
+        }
+        times = []
+        for _ in range(COLD_ROUNDS):
+            result = subprocess.run(
+                [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+            )
+            elapsed, mesh_imported = result.stdout.split()
+            times.append(float(elapsed))
+        times.sort()
+
+        self.cold_results[event] = {
+            "hook": hook,
+            "median_seconds": statistics.median(times),
+            "max_seconds": times[-1],
+            "mesh_imported": mesh_imported == "True",
+        }
+        return mesh_imported == "True"
+
+    def import_seconds(self) -> float:
+        """Return the seconds a fresh interpreter takes to import the charm, measured once."""
+        if self._import_seconds is None:
+            self._import_seconds = import_time()
+        return self._import_seconds
+
+    def report(self, charm: str) -> Dict[str, object]:
+        """Return the results recorded for ``charm``, with the versions they were taken on."""
+        return {
+            "charm": charm,
+            "python": platform.python_version(),
+            "ops": ops.__version__,
+            "rounds": self.rounds,
+            "import_seconds": self.import_seconds(),
+            "import_budget_seconds": IMPORT_BUDGET,
+            "events": self.results,
+            "cold_rounds": COLD_ROUNDS,
+            "cold_events": self.cold_results,
+        }
+
+
+def import_time(module: str = "charm") -> float:
+    """Return the seconds a fresh interpreter takes to import ``module``, dependencies included."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise RuntimeError(f"{module} was not imported")
+
+
+def benchmark_fixture(charm: str):
+    """Return a session fixture recording the benchmarks of ``charm`` and writing them out."""
+    import pytest
+
+    @pytest.fixture(scope="session")
+    def benchmark():
+        """Collect the results of every benchmark and write them as JSON at the end of the run."""
+        recorder = HookBenchmark(ROUNDS)
+        yield recorder
+        OUTPUT.write_text(json.dumps(recorder.report(charm), indent=2, sort_keys=True) + "\n")
+
+    return benchmark
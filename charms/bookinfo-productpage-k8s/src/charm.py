@@ -1,128 +1,93 @@
 #!/usr/bin/env python3
 """Charm for the Product Page microservice."""
 
+import hashlib
+import json
 import logging
 import socket
-from typing import Dict, Optional
+from functools import cached_property
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional, Tuple
 from urllib.parse import urlparse
 
+from charms.bookinfo_lib.v0.api_calls import ApiCalls
 from charms.bookinfo_lib.v0.bookinfo_service import BookinfoServiceConsumer
-from charms.istio_beacon_k8s.v0.service_mesh import (
-    AppPolicy,
-    Endpoint,
-    Method,
-    ServiceMeshConsumer,
-)
-from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
-from charmlibs.interfaces.istio_request_auth import (
-    ClaimToHeader,
-    IstioRequestAuthRequirer,
-    JWTRule,
-)
+from charms.bookinfo_lib.v0.dispatch import dispatching, mesh_dispatching
+from charms.bookinfo_lib.v0.workload import PebbleWorkload
 from ops.charm import ActionEvent, CharmBase
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
-from ops.pebble import LayerDict
+from ops.pebble import Error as PebbleError
+from ops.pebble import LayerDict, PathError
 
-logger = logging.getLogger(__name__)
-
-
-class ProductPageK8sCharm(CharmBase):
-    """Charm for the Product Page microservice."""
-
-    _stored = StoredState()
-
-    # WSGI wrapper template for handling path prefixes
-    WRAPPER_TEMPLATE = '''#!/usr/bin/env python3
-import re
-from productpage import app as original_app
-
-# Path prefix from ingress
-PREFIX = "{prefix}"
+from sizing import ContainerLimits, GunicornSettings, read_limits, size_gunicorn
 
-class PathPrefixMiddleware:
-    """Middleware to handle path prefixes for hardcoded URLs."""
+if TYPE_CHECKING:
+    from charmlibs.interfaces.istio_request_auth import IstioRequestAuthRequirer
+    from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
 
-    def __init__(self, app, prefix):
-        self.app = app
-        self.prefix = prefix
-
-    def __call__(self, environ, start_response):
-        # Buffer to capture response details
-        response_data = []
-
-        def custom_start_response(status, headers, exc_info=None):
-            response_data.append((status, headers))
-            return start_response(status, headers, exc_info)
-
-        # Get response from app
-        app_iter = self.app(environ, custom_start_response)
-
-        # Check if this is an HTML response
-        if response_data:
-            headers = dict(response_data[0][1])
-            content_type = headers.get('Content-Type', '')
-
-            # Only process HTML responses
-            if 'text/html' in content_type:
-                return self._fix_paths(app_iter)
-
-        return app_iter
+logger = logging.getLogger(__name__)
 
-    def _fix_paths(self, app_iter):
-        """Fix hardcoded paths in HTML responses."""
-        try:
-            # Collect response body
-            response_body = b''.join(app_iter)
+# WSGI wrapper that is pushed into the workload container and serves the upstream app
+WRAPPER_SOURCE = Path(__file__).parent / "productpage_wrapper.py"
+WRAPPER_PATH = "/opt/microservices/productpage_wrapper.py"
+GUNICORN_CONF_SOURCE = Path(__file__).parent / "gunicorn_conf.py"
+GUNICORN_CONF_PATH = "/opt/microservices/gunicorn_conf.py"
+# Environment of the app, read by the gunicorn configuration so that a reload picks it up
+ENVIRONMENT_PATH = "/opt/microservices/productpage-env.json"
+BACKEND_SERVICES = ("details", "reviews", "ratings")
+# Compression levels the workload accepts, from fastest to smallest
+COMPRESSION_LEVELS = range(1, 10)
+# Requests a stress run sends to each backend at most, which bounds a run without a rate
+STRESS_MAX_REQUESTS = 100_000
 
-            # Convert to string for processing
-            body_str = response_body.decode('utf-8')
 
-            # Fix hardcoded paths
-            # Replace href="/logout" with href="{prefix}/logout"
-            body_str = re.sub(r'href="/logout"', f'href="{{self.prefix}}/logout"', body_str)
+class Backend(NamedTuple):
+    """A related backend service, as published in its relation data."""
 
-            # Replace action="login" with absolute path including prefix
-            body_str = re.sub(r'action="login"', f'action="{{self.prefix}}/login"', body_str)
+    url: str
+    hostname: str
+    port: int
 
-            # Replace /static/ paths
-            body_str = re.sub(r'(src|href)="/static/', r'\\1="' + self.prefix + '/static/', body_str)
 
-            # Return modified response
-            yield body_str.encode('utf-8')
-        finally:
-            # Close original iterator
-            if hasattr(app_iter, 'close'):
-                app_iter.close()
+class ProductPageK8sCharm(CharmBase):
+    """Charm for the Product Page microservice."""
 
-# Apply middleware if prefix exists
-if PREFIX:
-    app = PathPrefixMiddleware(original_app, PREFIX)
-else:
-    app = original_app
-'''
+    _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
-        self._stored.set_default(pebble_ready=False)
+        # Pebble, hook tool and Kubernetes calls of the hook, logged once it is handled
+        self.api_calls = ApiCalls(self)
+        self._stored.set_default(
+            pebble_ready=False,
+            desired_hash="",
+            opened_port=0,
+            container_limits=None,
+            backend_hosts={},
+        )
+        self._backend_snapshot: Optional[Dict[str, Backend]] = None
 
         self.container = self.unit.get_container("bookinfo-productpage")
+        self.workload = PebbleWorkload(
+            self, self.container, "productpage", int(self.config["port"])
+        )
 
         # Core event handlers
         self.framework.observe(self.on.bookinfo_productpage_pebble_ready, self._on_pebble_ready)
+        self.framework.observe(
+            self.on.bookinfo_productpage_pebble_check_failed, self._on_pebble_check_changed
+        )
+        self.framework.observe(
+            self.on.bookinfo_productpage_pebble_check_recovered, self._on_pebble_check_changed
+        )
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.update_status, self._on_update_status)
 
-        # Ingress setup
-        self._ingress = IngressPerAppRequirer(
-            charm=self,
-            port=int(self.config["port"]),
-            strip_prefix=True,
-            redirect_https=True,
-            scheme="http",
-        )
-        self.framework.observe(self._ingress.on.ready, self._on_ingress_ready)
+        # Ingress setup, in the hooks the library handles; elsewhere it is loaded on first use
+        if dispatching(["ingress"], hooks=("leader-elected", "upgrade-charm")):
+            self.framework.observe(self._ingress.on.ready, self._on_ingress_ready)
 
         # Service consumers
         self._details_consumer = BookinfoServiceConsumer(self, "details")
@@ -134,7 +99,37 @@ else:
         self._ratings_consumer = BookinfoServiceConsumer(self, "ratings")
         self.framework.observe(self._ratings_consumer.on.url_changed, self._on_relation_changed)
 
-        # Service mesh with authorization policies
+        # The service mesh library imports lightkube and pydantic, so it is only set up in the
+        # hooks it handles
+        if mesh_dispatching(self.meta):
+            self._setup_mesh()
+
+        # Prometheus scrape target for the workload metrics
+        self.framework.observe(
+            self.on["metrics-endpoint"].relation_joined, self._on_metrics_endpoint_joined
+        )
+
+        # Actions
+        self.framework.observe(self.on.get_url_action, self._get_url)
+        self.framework.observe(self.on.stress_action, self._on_stress_action)
+
+        # Request authentication (JWT rules for Istio ingress)
+        self.framework.observe(
+            self.on["istio-request-auth"].relation_joined, self._on_request_auth_joined
+        )
+
+        # Initial port configuration
+        self._set_ports()
+
+    def _setup_mesh(self):
+        """Join the service mesh with authorization policies for the workload."""
+        from charms.istio_beacon_k8s.v0.service_mesh import (
+            AppPolicy,
+            Endpoint,
+            Method,
+            ServiceMeshConsumer,
+        )
+
         self._mesh = ServiceMeshConsumer(
             self,
             policies=[
@@ -147,30 +142,64 @@ else:
                             paths=["/productpage", "/static/*", "/login", "/logout", "/health"],
                         )
                     ],
-                )
+                ),
+                AppPolicy(
+                    relation="metrics-endpoint",
+                    endpoints=[
+                        Endpoint(
+                            ports=[int(self.config["port"])],
+                            methods=[Method.get],
+                            paths=["/metrics"],
+                        )
+                    ],
+                ),
             ],
         )
+        self.api_calls.instrument_mesh(self._mesh, self._lightkube_client)
 
-        # Actions
-        self.framework.observe(self.on.get_url_action, self._get_url)
+    def _lightkube_client(self):
+        """Return a Kubernetes client for the service mesh, as the library would create."""
+        from lightkube import Client
 
-        # Request authentication (JWT rules for Istio ingress)
-        self._request_auth = IstioRequestAuthRequirer(self, relation_name="istio-request-auth")
-        self.framework.observe(
-            self.on["istio-request-auth"].relation_joined, self._on_request_auth_joined
+        return Client(namespace=self.model.name, field_manager=self.app.name)
+
+    @cached_property
+    def _ingress(self) -> "IngressPerAppRequirer":
+        """Return the ingress requirer, importing the library on first use."""
+        from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
+
+        return IngressPerAppRequirer(
+            charm=self,
+            port=int(self.config["port"]),
+            strip_prefix=True,
+            redirect_https=True,
+            scheme="http",
         )
 
-        # Initial port configuration
-        self._set_ports()
+    @cached_property
+    def _request_auth(self) -> "IstioRequestAuthRequirer":
+        """Return the request authentication requirer, importing the library on first use."""
+        from charmlibs.interfaces.istio_request_auth import IstioRequestAuthRequirer
+
+        return IstioRequestAuthRequirer(self, relation_name="istio-request-auth")
 
     def _on_pebble_ready(self, event):
         """Handle the pebble ready event."""
         self._stored.pebble_ready = True
+        # A new workload container starts without the files and layer applied earlier
+        self._stored.desired_hash = ""
+        self._stored.container_limits = None
         self._reconcile()
 
+    def _on_pebble_check_changed(self, event):
+        """Update the status as soon as the health check fails or recovers."""
+        if event.info.name == self.workload.health_check:
+            self._reconcile()
+
     def _on_config_changed(self, event):
         """Handle config changed event."""
         self._publish_request_auth()
+        self._publish_scrape_config()
         self._reconcile()
 
     def _on_update_status(self, event):
@@ -185,6 +214,31 @@ else:
         """Handle any relation changed event."""
         self._reconcile()
 
+    def _on_metrics_endpoint_joined(self, _):
+        """Publish the scrape job when Prometheus relates to the workload metrics."""
+        self._publish_scrape_config()
+
+    def _publish_scrape_config(self):
+        """Publish the scrape job and this unit's address to every related Prometheus.
+
+        This follows the prometheus_scrape interface: the leader publishes the Juju topology
+        and a job whose wildcard target Prometheus expands to each unit's address.
+        """
+        metadata = {
+            "model": self.model.name,
+            "model_uuid": self.model.uuid,
+            "application": self.app.name,
+            "charm_name": self.meta.name,
+        }
+        targets = [f"*:{self.config['port']}"]
+        jobs = [{"metrics_path": "/metrics", "static_configs": [{"targets": targets}]}]
+        for relation in self.model.relations.get("metrics-endpoint", []):
+            relation.data[self.unit]["prometheus_scrape_unit_address"] = socket.getfqdn()
+            relation.data[self.unit]["prometheus_scrape_unit_name"] = self.unit.name
+            if self.unit.is_leader():
+                relation.data[self.app]["scrape_metadata"] = json.dumps(metadata)
+                relation.data[self.app]["scrape_jobs"] = json.dumps(jobs)
+
     def _on_request_auth_joined(self, _):
         """Publish JWT rules when the request-auth relation is established."""
         self._publish_request_auth()
@@ -202,6 +256,8 @@ else:
             logger.info("request-auth: missing config (issuer=%r, jwks_uri=%r)", issuer, jwks_uri)
             return
 
+        from charmlibs.interfaces.istio_request_auth import ClaimToHeader, JWTRule
+
         logger.info("request-auth: publishing JWT rules (issuer=%s)", issuer)
         self._request_auth.publish_data([
             JWTRule(
@@ -221,6 +277,13 @@ else:
         This is the main reconciliation loop that ensures the charm
         converges to the desired state regardless of which event triggered it.
         """
+        # Read relation data afresh, as several events can be emitted on the same charm
+        self._backend_snapshot = None
+
+        if problem := self._config_problem():
+            self.unit.status = BlockedStatus(problem)
+            return
+
         # Update status first
         if not self._stored.pebble_ready:
             self.unit.status = WaitingStatus("Waiting for pebble ready")
@@ -243,28 +306,49 @@ else:
             self._update_layer()
             self._set_ports()
 
-            # Check if service is running
-            service = self.container.get_service("productpage")
-            if service.is_running():
+            # Check if service is running and not failing its health check
+            if not self.workload.is_running():
+                self.unit.status = MaintenanceStatus("Service not running")
+            elif problem := self.workload.health_problem():
+                self.unit.status = MaintenanceStatus(problem)
+            else:
                 self.unit.status = ActiveStatus(
                     f"Ready with {len(available_services)} backend services"
                 )
-            else:
-                self.unit.status = MaintenanceStatus("Service not running")
         except Exception as e:
             logger.error(f"Failed to reconcile: {e}")
             self.unit.status = BlockedStatus(f"Failed to reconcile: {str(e)}")
 
+    def _config_problem(self) -> str:
+        """Return why the configuration cannot be applied, or an empty string if it can."""
+        level = int(self.config["compression-level"])
+        if level not in COMPRESSION_LEVELS:
+            return (
+                f"compression-level must be between {COMPRESSION_LEVELS.start} "
+                f"and {COMPRESSION_LEVELS.stop - 1}"
+            )
+        return ""
+
     def _get_available_services(self) -> list:
         """Get list of available backend services."""
-        services = []
-        if self._get_service_url("details"):
-            services.append("details")
-        if self._get_service_url("reviews"):
-            services.append("reviews")
-        if self._get_service_url("ratings"):
-            services.append("ratings")
-        return services
+        return list(self._backends)
+
+    @property
+    def _backends(self) -> Dict[str, Backend]:
+        """Return the related backend services, reading relation data once per dispatch.
+
+        Status, layer and environment generation all look at the backends, so they share one
+        snapshot rather than each walking the relations and reading their data again.
+        """
+        if self._backend_snapshot is None:
+            self._backend_snapshot = {}
+            for name in BACKEND_SERVICES:
+                if url := self._get_service_url(name):
+                    parsed = urlparse(url)
+                    self._backend_snapshot[name] = Backend(
+                        url, parsed.hostname or name, parsed.port or 9080
+                    )
+        return self._backend_snapshot
 
     def _get_service_url(self, service_name: str) -> Optional[str]:
         """Get a service URL directly from relation data."""
@@ -279,17 +363,33 @@ else:
         return None
 
     def _update_layer(self):
-        """Update the Pebble layer configuration."""
+        """Update the Pebble layer configuration.
+
+        Only changes to the gunicorn command restart the service. Changes to the app, its
+        environment or the gunicorn hooks are applied with a graceful reload instead: gunicorn
+        starts a new generation of workers and lets the old ones finish their requests. A
+        reload sets the variables of the new environment but cannot unset those it no longer
+        has, so an environment that drops variables restarts the service. The
+        hash of the last files and layer applied is kept, so that the container is left alone
+        while they are unchanged and the service is running.
+        """
         if not self.container.can_connect():
             logger.debug("Cannot connect to container")
             return
 
-        # Create wrapper to handle path prefix if we have an ingress
-        if self._ingress.url:
-            self._create_wsgi_wrapper()
-
+        files = self._workload_files()
         layer = self._generate_layer()
+        desired = json.dumps({"files": files, "layer": layer}, sort_keys=True)
+        desired_hash = hashlib.sha256(desired.encode()).hexdigest()
+        if desired_hash == self._stored.desired_hash and self.workload.is_running():
+            logger.debug("Workload files and service layer unchanged")
+            return
+
+        environment_shrunk = self._environment_shrunk(files[ENVIRONMENT_PATH])
+        files_changed = self._push_workload_files(files)
+        current = self.container.get_plan().services.get("productpage")
         self.container.add_layer("productpage", layer, combine=True)
+        layer_changed = self.container.get_plan().services.get("productpage") != current
 
         try:
             self.container.replan()
@@ -298,30 +398,69 @@ else:
             logger.error(f"Failed to replan service: {e}")
             raise
 
-    def _create_wsgi_wrapper(self):
-        """Create a WSGI wrapper that fixes hardcoded URLs for path prefix support."""
-        # Get the path prefix from ingress URL
-        prefix = ""
-        if ingress_url := self._ingress.url:
-            parsed = urlparse(ingress_url)
-            if parsed.path and parsed.path != "/":
-                prefix = parsed.path.rstrip("/")
+        if files_changed and not layer_changed:
+            self._reload_workload(restart=environment_shrunk)
+        self._stored.desired_hash = desired_hash
 
-        # Generate wrapper content from template
-        wrapper_content = self.WRAPPER_TEMPLATE.format(prefix=prefix)
+    def _reload_workload(self, restart: bool = False):
+        """Have the running gunicorn pick up new workload files without dropping requests."""
+        if not self.workload.is_running():
+            return
+        if self.config["preload-app"] or restart:
+            # A preloaded app lives in the master, which a reload does not re-import, and the
+            # master keeps the variables a reload would have to unset
+            logger.info("Restarting the workload")
+            self.container.restart("productpage")
+        else:
+            logger.info("Reloading the workload gracefully")
+            self.container.send_signal("SIGHUP", "productpage")
+
+    def _workload_files(self) -> Dict[str, str]:
+        """Return the WSGI wrapper, gunicorn hooks and app environment, by workload path."""
+        return {
+            WRAPPER_PATH: WRAPPER_SOURCE.read_text(),
+            GUNICORN_CONF_PATH: GUNICORN_CONF_SOURCE.read_text(),
+            ENVIRONMENT_PATH: json.dumps(self._get_environment(), indent=2, sort_keys=True),
+        }
 
+    def _environment_shrunk(self, content: str) -> bool:
+        """Return whether the app environment ``content`` drops variables the workload has."""
         try:
-            self.container.push(
-                "/opt/microservices/productpage_wrapper.py", wrapper_content, make_dirs=True
-            )
-            logger.info(f"Created WSGI wrapper with prefix: {prefix}")
-        except Exception as e:
-            logger.error(f"Failed to create wrapper: {e}")
+            current = json.loads(self.container.pull(ENVIRONMENT_PATH).read())
+        except (PathError, ValueError):
+            return False
+        return bool(current.keys() - json.loads(content).keys())
+
+    def _push_workload_files(self, files: Dict[str, str]) -> bool:
+        """Push workload files into the container, returning whether any of them changed."""
+        changed = False
+        for path, content in files.items():
+            try:
+                if self.container.pull(path).read() == content:
+                    continue
+            except PathError:
+                pass
+            self.container.push(path, content, make_dirs=True)
+            changed = True
+        if changed:
+            logger.info(f"Updated workload files, path prefix: {self._path_prefix!r}")
+        return changed
+
+    @property
+    def _path_prefix(self) -> str:
+        """Return the path prefix the ingress serves the workload under, if any."""
+        if not self.model.relations.get("ingress"):
+            return ""
+        if ingress_url := self._ingress.url:
+            parsed = urlparse(ingress_url)
+            if parsed.path and parsed.path != "/":
+                return parsed.path.rstrip("/")
+        return ""
 
     def _generate_layer(self) -> LayerDict:
         """Generate the Pebble layer configuration."""
-        # Use wrapper if we have ingress (to handle path prefix)
-        app_module = "productpage_wrapper:app" if self._ingress.url else "productpage:app"
+        app_module = "productpage_wrapper:create_app()"
+        gunicorn = self._gunicorn_settings()
         return {
             "summary": "Product Page service layer",
             "description": "Pebble layer for the Product Page microservice",
@@ -329,13 +468,49 @@ else:
                 "productpage": {
                     "override": "replace",
                     "summary": "Product Page service",
-                    "command": f"gunicorn -b \"[::]\":{self.config['port']} {app_module} -w 8 --keep-alive 2 -k gevent --forwarded-allow-ips='*'",
+                    "command": f"gunicorn -c {GUNICORN_CONF_PATH} -b \"[::]\":{self.config['port']} {app_module} {gunicorn.args()} --forwarded-allow-ips='*'",
                     "startup": "enabled",
-                    "environment": self._get_environment(),
+                    "environment": {"WORKLOAD_ENV_FILE": ENVIRONMENT_PATH},
                 }
             },
+            "checks": self.workload.checks(
+                float(self.config["health-check-period"]),
+                int(self.config["health-check-threshold"]),
+                drain=False,
+            ),
         }
 
+    def _gunicorn_settings(self) -> GunicornSettings:
+        """Size gunicorn from the workload container's limits and the explicit overrides."""
+        settings = size_gunicorn(
+            self._container_limits(),
+            workers=int(self.config["workers"]),
+            worker_class=str(self.config["worker-class"]),
+            threads=int(self.config["threads"]),
+            worker_connections=int(self.config["worker-connections"]),
+            keep_alive=int(self.config["keep-alive"]),
+            backlog=int(self.config["backlog"]),
+            preload=bool(self.config["preload-app"]),
+            max_requests=int(self.config["max-requests"]),
+            max_requests_jitter=int(self.config["max-requests-jitter"]),
+        )
+        logger.debug(f"Gunicorn settings: {settings}")
+        return settings
+
+    def _container_limits(self) -> ContainerLimits:
+        """Return the workload container's limits, read once per container start."""
+        if self._stored.container_limits is None:
+            self._stored.container_limits = list(read_limits(self._read_workload_file))
+        return ContainerLimits(*self._stored.container_limits)
+
+    def _read_workload_file(self, path: str) -> Optional[str]:
+        """Return the content of a file in the workload container, or None if unreadable."""
+        try:
+            return self.container.pull(path).read()
+        except (PebbleError, ConnectionError) as e:
+            logger.debug(f"Cannot read {path}: {e}")
+            return None
+
     def _get_environment(self) -> Dict[str, str]:
         """Get environment variables for the service."""
         env = {
@@ -343,35 +518,80 @@ else:
             "SERVICE_VERSION": "v1",
             # Experimental: log level may not actually affect the service logging
             "LOG_LEVEL": self.config["log-level"],
-            "FLOOD_FACTOR": str(self.config["flood-factor"]),
+            "WORKER_MAX_RSS": str(int(self.config["worker-max-rss"]) * 1024 * 1024),
+            "GEVENT_PATCH_MASTER": str(
+                bool(self.config["preload-app"])
+                and (self.config["worker-class"] or "gevent") == "gevent"
+            ).lower(),
+            "PATH_PREFIX": self._path_prefix,
+            "RESPONSE_CACHE_TTL": str(self.config["response-cache-ttl"]),
+            "RESPONSE_CACHE_MAX_ENTRIES": str(self.config["response-cache-max-entries"]),
+            "RESPONSE_CACHE_MAX_BYTES": str(self.config["response-cache-max-bytes"]),
+            "COMPRESSION_ENABLED": str(self.config["compression-enabled"]).lower(),
+            "COMPRESSION_LEVEL": str(self.config["compression-level"]),
+            "COMPRESSION_MIN_SIZE": str(self.config["compression-min-size"]),
+            "BACKEND_POOL_SIZE": str(self.config["backend-pool-size"]),
+            "BACKEND_POOL_IDLE_TIMEOUT": str(self.config["backend-pool-idle-timeout"]),
+            "BACKEND_MAX_CONNECTIONS": str(self.config["backend-max-connections"]),
+            "CONCURRENT_FANOUT": str(self.config["concurrent-fanout"]).lower(),
+            "FANOUT_MAX_CONCURRENCY": str(self.config["fanout-max-concurrency"]),
+            "FANOUT_DEADLINE": str(self.config["fanout-deadline"]),
+            "BACKEND_COALESCING": str(self.config["backend-coalescing"]).lower(),
+            "BACKEND_COALESCING_MAX_WAIT": str(self.config["backend-coalescing-max-wait"]),
+            "BACKEND_CACHE_TTL": str(self.config["backend-cache-ttl"]),
+            "BACKEND_CACHE_STALE_TTL": str(self.config["backend-cache-stale-ttl"]),
+            "BACKEND_CACHE_MAX_ENTRIES": str(self.config["backend-cache-max-entries"]),
+            "CIRCUIT_BREAKER_FAILURE_THRESHOLD": str(
+                self.config["circuit-breaker-failure-threshold"]
+            ),
+            "CIRCUIT_BREAKER_RESET_TIMEOUT": str(self.config["circuit-breaker-reset-timeout"]),
+            "DETAILS_MAX_CONCURRENCY": str(self.config["details-max-concurrency"]),
+            "DETAILS_MAX_QUEUE": str(self.config["details-max-queue"]),
+            "REVIEWS_MAX_CONCURRENCY": str(self.config["reviews-max-concurrency"]),
+            "REVIEWS_MAX_QUEUE": str(self.config["reviews-max-queue"]),
+            "RATINGS_MAX_CONCURRENCY": str(self.config["ratings-max-concurrency"]),
+            "RATINGS_MAX_QUEUE": str(self.config["ratings-max-queue"]),
+            "BULKHEAD_QUEUE_TIMEOUT": str(self.config["bulkhead-queue-timeout"]),
+            "ADMISSION_CONTROL": str(self.config["admission-control"]).lower(),
+            "ADMISSION_MIN_LIMIT": str(self.config["admission-min-limit"]),
+            "ADMISSION_MAX_LIMIT": str(self.config["admission-max-limit"]),
+            "ADMISSION_LATENCY_TARGET": str(self.config["admission-latency-target"]),
+            "ADMISSION_RETRY_AFTER": str(self.config["admission-retry-after"]),
         }
 
-        # Extract hostname and port from URLs for upstream compatibility
-        details_url = self._get_service_url("details")
-        if details_url:
-            parsed = urlparse(details_url)
-            env["DETAILS_HOSTNAME"] = parsed.hostname or "details"
-            env["DETAILS_SERVICE_PORT"] = str(parsed.port or 9080)
-
-        reviews_url = self._get_service_url("reviews")
-        if reviews_url:
-            parsed = urlparse(reviews_url)
-            env["REVIEWS_HOSTNAME"] = parsed.hostname or "reviews"
-            env["REVIEWS_SERVICE_PORT"] = str(parsed.port or 9080)
-
-        ratings_url = self._get_service_url("ratings")
-        if ratings_url:
-            parsed = urlparse(ratings_url)
-            env["RATINGS_HOSTNAME"] = parsed.hostname or "ratings"
-            env["RATINGS_SERVICE_PORT"] = str(parsed.port or 9080)
+        # Hostname and port of each backend for upstream compatibility
+        for name, (hostname, port) in self._backend_hosts().items():
+            env[f"{name.upper()}_HOSTNAME"] = hostname
+            env[f"{name.upper()}_SERVICE_PORT"] = str(port)
 
         return env
 
+    def _backend_hosts(self) -> Dict[str, Tuple[str, int]]:
+        """Return the hostname and port of each related backend.
+
+        A backend withdraws its URL while it is not ready. Its last known hostname and port are
+        kept while it is still related, so that the app environment does not shrink and
+        restart the workload when a backend is only briefly unhealthy.
+        """
+        known = self._stored.backend_hosts
+        hosts = {}
+        for name in BACKEND_SERVICES:
+            if backend := self._backends.get(name):
+                hosts[name] = [backend.hostname, backend.port]
+            elif name in known and self.model.relations.get(name):
+                hosts[name] = list(known[name])
+        if hosts != dict(known):
+            self._stored.backend_hosts = hosts
+        return {name: (hostname, port) for name, (hostname, port) in hosts.items()}
+
     def _set_ports(self):
         """Open the application ports to fix Juju's 65535 placeholder issue."""
+        port = int(self.config["port"])
+        if self._stored.opened_port == port:
+            return
         try:
-            port = int(self.config["port"])
             self.unit.open_port("tcp", port)
+            self._stored.opened_port = port
             logger.info(f"Opened TCP port {port}")
         except Exception as e:
             logger.warning(f"Failed to open port: {e}")
@@ -392,6 +612,59 @@ else:
         output = output + "productpage?u=normal"
         event.set_results({"url": output})
 
+    def _on_stress_action(self, event: ActionEvent):
+        """Drive load against the related backend services and report what they sustained."""
+        wanted = [b.strip() for b in event.params["backends"].split(",") if b.strip()]
+        targets = {
+            name: backend.url
+            for name in wanted or self._backends
+            if (backend := self._backends.get(name))
+        }
+        if not targets:
+            event.fail("No related backend services to stress")
+            return
+
+        if problem := self._action_param_problem("stress", event.params):
+            event.fail(problem)
+            return
+
+        # The load generator needs httpx, which no hook does
+        from stress import stress
+
+        duration = float(event.params["duration"])
+        event.log(f"Stressing {', '.join(targets)} for {duration:g}s")
+        reports = stress(
+            targets,
+            duration,
+            rate=float(event.params["rate"]),
+            concurrency=int(event.params["concurrency"]),
+            timeout=float(event.params["timeout"]),
+            max_requests=STRESS_MAX_REQUESTS,
+        )
+        event.set_results({name: report.results() for name, report in reports.items()})
+
+    def _action_param_problem(self, action: str, params: dict) -> str:
+        """Return why a numeric parameter of ``action`` is out of its schema's bounds, if it is.
+
+        The bounds are only written in the action's schema in charmcraft.yaml, and are read
+        from the charm's metadata to hold the parameters to them here as well as in Juju.
+        """
+        for name, schema in self.meta.actions[action].parameters.items():
+            value = params.get(name)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            bounds = []
+            if "exclusiveMinimum" in schema:
+                low = schema["exclusiveMinimum"]
+                bounds.append((value > low, f"greater than {low}"))
+            if "minimum" in schema:
+                bounds.append((value >= schema["minimum"], f"at least {schema['minimum']}"))
+            if "maximum" in schema:
+                bounds.append((value <= schema["maximum"], f"at most {schema['maximum']}"))
+            if not all(ok for ok, _ in bounds):
+                return f"{name} must be {' and '.join(bound for _, bound in bounds)}"
+        return ""
+
     @property
     def _internal_url(self) -> str:
         """Return the fqdn dns-based in-cluster (private) address of the catalogue server."""
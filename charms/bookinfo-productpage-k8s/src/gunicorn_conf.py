@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Gunicorn configuration for the Product Page workload.
+
+This module is pushed next to the WSGI wrapper by the charm and loaded with ``gunicorn -c``.
+Server settings are given on the command line, which takes precedence over this file. It
+holds the server hooks and the environment of the app, read from the JSON file named by
+``WORKLOAD_ENV_FILE``: gunicorn executes this module again when it receives ``SIGHUP``, so
+a reload applies a new environment to the next generation of workers.
+"""
+
+import json
+import os
+from typing import Dict
+
+
+def load_environment(path: str) -> Dict[str, str]:
+    """Return the app environment written by the charm, or an empty one if unreadable."""
+    try:
+        with open(path) as f:
+            return {str(k): str(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+ENVIRONMENT = load_environment(os.environ.get("WORKLOAD_ENV_FILE", ""))
+raw_env = [f"{k}={v}" for k, v in ENVIRONMENT.items()]
+
+# A preloaded app is imported by the master before gevent workers fork and patch the
+# standard library, so the locks and sockets it creates at import time would block the whole
+# worker instead of a single greenlet. Patch in the master first.
+if ENVIRONMENT.get("GEVENT_PATCH_MASTER") == "true":
+    from gevent import monkey  # pyright: ignore[reportMissingImports]
+
+    monkey.patch_all()
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Resident memory in bytes past which a worker is recycled, 0 for no limit
+WORKER_MAX_RSS = int(ENVIRONMENT.get("WORKER_MAX_RSS") or 0)
+
+
+def worker_rss() -> int:
+    """Return the resident memory of the current process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def post_request(worker, req, environ, resp):
+    """Recycle a worker once its resident memory grows past WORKER_MAX_RSS bytes.
+
+    The worker stops accepting connections, finishes the requests it is serving and exits;
+    the master then forks a fresh one.
+    """
+    if WORKER_MAX_RSS and worker.alive and (rss := worker_rss()) > WORKER_MAX_RSS:
+        worker.log.info(f"Worker RSS {rss} bytes exceeds {WORKER_MAX_RSS} bytes, recycling it")
+        worker.alive = False
+
+
+def worker_exit(server, worker):
+    """Write the metrics of an exiting worker straight away.
+
+    Workers write their metrics at most once a second, so the requests a recycled worker
+    served in its last second would otherwise not be counted.
+    """
+    metrics = getattr(getattr(worker, "wsgi", None), "metrics", None)
+    if metrics is not None:
+        metrics.flush(force=True)
@@ -0,0 +1,1839 @@
+#!/usr/bin/env python3
+"""WSGI wrapper around the upstream Product Page application.
+
+This module is pushed verbatim into the workload container by the charm and served by
+gunicorn as ``productpage_wrapper:create_app()``. It is configured entirely through
+environment variables set in the Pebble layer, so it must only depend on the standard
+library and on what the upstream image already ships.
+"""
+
+import fcntl
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from email.utils import formatdate, parsedate_to_datetime
+from http.cookies import CookieError, SimpleCookie
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import brotli  # pyright: ignore[reportMissingImports]
+except ImportError:
+    brotli = None
+
+# Total size of rewritten HTML kept per worker, and the largest single chunk worth caching
+REWRITE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+REWRITE_CACHE_MAX_ENTRY_BYTES = 512 * 1024
+
+# Total size of precompressed static assets kept per worker
+STATIC_COMPRESSION_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Total size of static assets preloaded into memory, and how long clients may cache them
+STATIC_PRELOAD_MAX_BYTES = 32 * 1024 * 1024
+STATIC_MAX_AGE = 3600
+
+# Backend responses kept for stale-while-revalidate and circuit breaker fallbacks
+BACKEND_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Metric snapshots are shared between gunicorn workers through this directory
+METRICS_DIR = "/tmp/productpage-metrics"
+METRICS_FLUSH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _env_bool(name: str) -> bool:
+    """Read a boolean setting from the environment."""
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a floating point setting from the environment."""
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class PrefixRewriter:
+    """Incrementally rewrite hardcoded absolute paths in an HTML byte stream.
+
+    Matches may be split across chunk boundaries, so the tail of every chunk that could
+    still be the start of a match is held back and prepended to the next one.
+    """
+
+    def __init__(self, prefix: bytes):
+        self._prefix = prefix
+        self._replacements = {
+            b'href="/logout"': b'href="' + prefix + b'/logout"',
+            b'action="login"': b'action="' + prefix + b'/login"',
+            b'src="/static/': b'src="' + prefix + b"/static/",
+            b'href="/static/': b'href="' + prefix + b"/static/",
+        }
+        self._pattern = re.compile(b"|".join(re.escape(k) for k in self._replacements))
+        self._holdback = max(len(k) for k in self._replacements) - 1
+        self._pending = b""
+
+    def _replace(self, match: re.Match) -> bytes:
+        return self._replacements[match.group(0)]
+
+    def feed(self, chunk: bytes, cache: Optional["LRUCache"] = None) -> bytes:
+        """Rewrite a chunk, returning all output that can safely be emitted so far.
+
+        The output and the tail held back only depend on the chunk and the tail held back
+        before it, so with a ``cache`` both are reused for data rewritten before.
+        """
+        data = self._pending + chunk
+        key = None
+        if cache is not None and len(data) <= REWRITE_CACHE_MAX_ENTRY_BYTES:
+            key = rewrite_cache_key(data, self._prefix)
+            if (cached := cache.get(key)) is not None:
+                rewritten, self._pending = cached
+                return rewritten
+        rewritten = self._rewrite(data)
+        if key is not None:
+            cache.put(key, (rewritten, self._pending), len(rewritten) + len(self._pending))
+        return rewritten
+
+    def _rewrite(self, data: bytes) -> bytes:
+        """Rewrite data up to the tail that could start a match, and hold that tail back."""
+        cutoff = len(data) - self._holdback
+        out = []
+        pos = 0
+        for match in self._pattern.finditer(data):
+            if match.start() >= cutoff:
+                break
+            out.append(data[pos : match.start()])
+            out.append(self._replace(match))
+            pos = match.end()
+        split = max(pos, cutoff)
+        out.append(data[pos:split])
+        self._pending = data[split:]
+        return b"".join(out)
+
+    def flush(self) -> bytes:
+        """Rewrite and return whatever is still held back."""
+        data, self._pending = self._pending, b""
+        return self._pattern.sub(self._replace, data)
+
+
+class LRUCache:
+    """Bounded LRU cache, evicted by total size in bytes and optionally by count and age."""
+
+    def __init__(self, max_bytes: int, max_entries: int = 0, ttl: float = 0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[Any, Tuple[Any, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Any:
+        """Return the cached value for a key, marking it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if expires and expires <= time.monotonic():
+                del self._entries[key]
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size: Optional[int] = None):
+        """Store a value, evicting least recently used entries to stay within budget."""
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes or (
+                self.max_entries and len(self._entries) > self.max_entries
+            ):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def __len__(self):
+        """Return the number of cached entries."""
+        return len(self._entries)
+
+
+def rewrite_cache_key(body: bytes, prefix: bytes) -> bytes:
+    """Return the rewrite cache key for upstream HTML served under a prefix."""
+    digest = hashlib.blake2b(prefix + b"\0", digest_size=16)
+    digest.update(body)
+    return digest.digest()
+
+
+class PathPrefixMiddleware:
+    """Middleware to handle path prefixes for hardcoded URLs."""
+
+    def __init__(self, app, prefix: str, cache: Optional[LRUCache] = None):
+        self.app = app
+        self.prefix = prefix.encode("utf-8")
+        self.cache = cache
+
+    def __call__(self, environ, start_response):
+        """Serve a request, rewriting the body of HTML responses."""
+        rewrite = []
+
+        def _start_response(status, headers, exc_info=None):
+            content_type = next((v for k, v in headers if k.lower() == "content-type"), "")
+            if "text/html" in content_type:
+                rewrite.append(True)
+                # The body length changes once rewritten, let the server frame it instead.
+                headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        if not rewrite:
+            return app_iter
+        return self._fix_paths(app_iter)
+
+    def _fix_paths(self, app_iter):
+        """Fix hardcoded paths in HTML responses chunk by chunk, reusing earlier rewrites."""
+        rewriter = PrefixRewriter(self.prefix)
+        try:
+            for chunk in app_iter:
+                if out := rewriter.feed(chunk, self.cache):
+                    yield out
+            if out := rewriter.flush():
+                yield out
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+
+class ResponseCacheMiddleware:
+    """Serve repeated anonymous page views from a TTL cache of complete responses.
+
+    Responses are keyed on the path, the ``u`` query parameter and the negotiated content
+    encoding. Requests that carry a session cookie always reach the upstream app, since the
+    page they render is personal.
+    """
+
+    CACHEABLE_PATHS = ("/productpage",)
+    SESSION_COOKIE = "session"
+
+    def __init__(self, app, cache: LRUCache, encodings: Sequence[str] = ()):
+        self.app = app
+        self.cache = cache
+        self.encodings = encodings
+        self.bypasses = 0
+        self.stores = 0
+
+    def _key(self, environ) -> Optional[Tuple[str, str, str]]:
+        """Return the cache key for a request, or None if it must not be cached."""
+        if environ.get("REQUEST_METHOD") != "GET":
+            return None
+        path = environ.get("PATH_INFO", "")
+        if path not in self.CACHEABLE_PATHS:
+            return None
+        if self.SESSION_COOKIE in _cookies(environ):
+            return None
+        user = parse_qs(environ.get("QUERY_STRING", "")).get("u", [""])[0]
+        return (path, user, negotiate_encoding(environ, self.encodings) or "identity")
+
+    def __call__(self, environ, start_response):
+        """Serve a request from the cache, or forward it and cache the response."""
+        key = self._key(environ)
+        if key is None:
+            self.bypasses += 1
+            return self.app(environ, start_response)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            status, headers, body = cached
+            start_response(status, headers + [("X-Cache", "HIT")])
+            return [body]
+
+        response = []
+
+        def _start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return start_response(status, headers + [("X-Cache", "MISS")], exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        return self._store(key, response, app_iter)
+
+    def _store(self, key, response, app_iter):
+        """Pass the response through while keeping a copy to cache once it completes."""
+        chunks: Optional[list] = []
+        size = 0
+        try:
+            for chunk in app_iter:
+                if chunks is not None:
+                    size += len(chunk)
+                    if size <= self.cache.max_bytes:
+                        chunks.append(chunk)
+                    else:
+                        chunks = None
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+        if chunks is None or not response or not response[0].startswith("200"):
+            return
+        status, headers = response
+        if any(k.lower() == "set-cookie" for k, _ in headers):
+            return
+        body = b"".join(chunks)
+        headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+        headers.append(("Content-Length", str(len(body))))
+        self.cache.put(key, (status, headers, body), len(body))
+        self.stores += 1
+
+
+def negotiate_encoding(environ, available: Sequence[str]) -> Optional[str]:
+    """Pick the preferred content encoding the client accepts, in server preference order."""
+    if not available:
+        return None
+    accepted = {}
+    for item in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _Compressor:
+    """Incremental gzip or brotli compressor that flushes after every chunk."""
+
+    def __init__(self, encoding: str, level: int):
+        self._brotli = encoding == "br"
+        if self._brotli:
+            self._obj = brotli.Compressor(quality=min(level, 11))  # pyright: ignore[reportOptionalMemberAccess]
+        else:
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes) -> bytes:
+        """Compress a chunk, returning everything that can be sent so far."""
+        if self._brotli:
+            return self._obj.process(chunk) + self._obj.flush()
+        return self._obj.compress(chunk) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """Return the end of the compressed stream."""
+        return self._obj.finish() if self._brotli else self._obj.flush()
+
+
+class CompressionMiddleware:
+    """Compress text responses for clients that accept gzip or brotli.
+
+    Pages are compressed on the fly as upstream produces them. Static assets are compressed
+    once per encoding and validator and then served from an in-memory cache.
+    """
+
+    COMPRESSIBLE_TYPES = (
+        "text/",
+        "application/javascript",
+        "application/json",
+        "application/xml",
+        "image/svg+xml",
+    )
+    STATIC_PREFIX = "/static/"
+
+    # Levels gzip accepts, the range brotli qualities are kept to
+    LEVELS = range(1, 10)
+
+    def __init__(self, app, level: int, min_size: int, static_cache: LRUCache):
+        self.app = app
+        # A level out of range would fail every compressed response, so it is clamped
+        self.level = min(max(level, self.LEVELS.start), self.LEVELS.stop - 1)
+        self.min_size = min_size
+        self.static_cache = static_cache
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    def _compressible(self, status: str, headers) -> bool:
+        """Return whether a response should be compressed."""
+        if not status.startswith("200"):
+            return False
+        values = {k.lower(): v for k, v in headers}
+        if "content-encoding" in values:
+            return False
+        if not values.get("content-type", "").startswith(self.COMPRESSIBLE_TYPES):
+            return False
+        length = values.get("content-length", "")
+        return not length.isdigit() or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        """Serve a request, compressing the response if the client accepts it."""
+        encoding = negotiate_encoding(environ, self.encodings)
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            return self.app(environ, start_response)
+
+        response = []
+        written = []
+
+        def _start_response(status, headers, exc_info=None):
+            response.clear()
+            if exc_info is None and self._compressible(status, headers):
+                response[:] = [status, headers]
+                return written.append
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        if not response:
+            return app_iter
+        status, headers = response
+        headers = self._headers(headers, encoding)
+        body = chain(written, app_iter)
+        if environ.get("PATH_INFO", "").startswith(self.STATIC_PREFIX):
+            return self._compress_static(
+                environ, encoding, status, headers, body, app_iter, start_response
+            )
+        return self._compress_stream(encoding, status, headers, body, app_iter, start_response)
+
+    @staticmethod
+    def _headers(headers, encoding: str) -> list:
+        """Return the response headers for the compressed representation."""
+        out = []
+        vary = ["Accept-Encoding"]
+        for name, value in headers:
+            lower = name.lower()
+            if lower == "content-length":
+                continue
+            if lower == "vary":
+                vary.append(value)
+                continue
+            if lower == "etag" and not value.startswith("W/"):
+                value = "W/" + value
+            out.append((name, value))
+        out.append(("Content-Encoding", encoding))
+        out.append(("Vary", ", ".join(vary)))
+        return out
+
+    def _compress_stream(self, encoding, status, headers, body, app_iter, start_response):
+        """Compress a response chunk by chunk."""
+        compressor = _Compressor(encoding, self.level)
+        start_response(status, headers)
+        try:
+            for chunk in body:
+                if out := compressor.compress(chunk):
+                    yield out
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+    def _compress_static(self, environ, encoding, status, headers, body, app_iter, start_response):
+        """Serve a static asset from the precompressed cache, filling it on a miss."""
+        values = {k.lower(): v for k, v in headers}
+        validator = values.get("etag") or values.get("last-modified")
+        key = (environ.get("PATH_INFO"), encoding, validator)
+        try:
+            compressed = self.static_cache.get(key) if validator else None
+            if compressed is None:
+                compressor = _Compressor(encoding, self.level)
+                compressed = b"".join(compressor.compress(c) for c in body) + compressor.finish()
+                if validator:
+                    self.static_cache.put(key, compressed)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+        start_response(status, headers + [("Content-Length", str(len(compressed)))])
+        return [compressed]
+
+
+class StaticAsset(NamedTuple):
+    """A static file held in memory, with its response validators."""
+
+    body: bytes
+    content_type: str
+    etag: str
+    last_modified: str
+    mtime: int
+
+
+def load_static_assets(root: str, max_bytes: int) -> Dict[str, StaticAsset]:
+    """Read the files under a directory into memory, keyed on their relative URL path."""
+    assets = {}
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            try:
+                mtime = int(os.path.getmtime(path))
+                with open(path, "rb") as f:
+                    body = f.read()
+            except OSError:
+                continue
+            if total + len(body) > max_bytes:
+                # Whatever does not fit is still served by the upstream app.
+                continue
+            total += len(body)
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            if content_type.startswith("text/") or content_type == "application/javascript":
+                content_type += "; charset=utf-8"
+            url_path = os.path.relpath(path, root).replace(os.sep, "/")
+            assets[url_path] = StaticAsset(
+                body=body,
+                content_type=content_type,
+                etag='"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest(),
+                last_modified=formatdate(mtime, usegmt=True),
+                mtime=mtime,
+            )
+    return assets
+
+
+class StaticFilesMiddleware:
+    """Answer health probes and static asset requests without going through Flask."""
+
+    STATIC_PREFIX = "/static/"
+    HEALTH_PATH = "/health"
+    HEALTH_BODY = b"Product page is healthy"
+
+    def __init__(self, app, assets: Dict[str, StaticAsset], max_age: int):
+        self.app = app
+        self.assets = assets
+        self.cache_control = f"public, max-age={max_age}"
+
+    def __call__(self, environ, start_response):
+        """Serve a request from memory if possible, otherwise forward it."""
+        method = environ.get("REQUEST_METHOD")
+        path = environ.get("PATH_INFO", "")
+        if method not in ("GET", "HEAD"):
+            return self.app(environ, start_response)
+
+        if path == self.HEALTH_PATH:
+            start_response(
+                "200 OK",
+                [
+                    ("Content-Type", "text/html; charset=utf-8"),
+                    ("Content-Length", str(len(self.HEALTH_BODY))),
+                    ("Cache-Control", "no-store"),
+                ],
+            )
+            return [] if method == "HEAD" else [self.HEALTH_BODY]
+
+        asset = None
+        if path.startswith(self.STATIC_PREFIX):
+            asset = self.assets.get(path[len(self.STATIC_PREFIX) :])
+        if asset is None:
+            return self.app(environ, start_response)
+
+        headers = [
+            ("ETag", asset.etag),
+            ("Last-Modified", asset.last_modified),
+            ("Cache-Control", self.cache_control),
+        ]
+        if self._not_modified(environ, asset):
+            start_response("304 Not Modified", headers)
+            return []
+        headers += [
+            ("Content-Type", asset.content_type),
+            ("Content-Length", str(len(asset.body))),
+        ]
+        start_response("200 OK", headers)
+        return [] if method == "HEAD" else [asset.body]
+
+    @staticmethod
+    def _not_modified(environ, asset: StaticAsset) -> bool:
+        """Return whether the client's cached copy of an asset is still current."""
+        if if_none_match := environ.get("HTTP_IF_NONE_MATCH"):
+            tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+            return "*" in tags or asset.etag in tags
+        if if_modified_since := environ.get("HTTP_IF_MODIFIED_SINCE"):
+            try:
+                return asset.mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class AdaptiveLimit:
+    """Concurrency limit adapted to observed latency by additive increase, multiplicative decrease.
+
+    Every request completed within ``latency_target`` while at least half the limit is in
+    use raises the limit by ``1 / limit``, about one per limit's worth of requests. A slower
+    request multiplies it by ``backoff``, at most once per ``latency_target`` so that a burst
+    of slow requests only counts once. The limit stays within ``min_limit`` and ``max_limit``.
+    """
+
+    def __init__(
+        self, min_limit: int, max_limit: int, latency_target: float, backoff: float = 0.9
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.shed = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Admit a request if the limit allows it, or count it as shed."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float):
+        """Record the latency of an admitted request that has completed."""
+        with self._lock:
+            in_use = self.in_flight
+            self.in_flight -= 1
+            if latency > self.latency_target:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif in_use * 2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class _ClosingIterable:
+    """WSGI response body that calls a function once the server has closed it."""
+
+    def __init__(self, app_iter: Iterable[bytes], on_close: Callable[[], None]):
+        self.app_iter = app_iter
+        self.on_close = on_close
+
+    def __iter__(self):
+        """Iterate the wrapped body."""
+        return iter(self.app_iter)
+
+    def close(self):
+        """Close the wrapped body, then call on_close."""
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            self.on_close()
+
+
+class AdmissionControlMiddleware:
+    """Shed requests over an adaptive concurrency limit, so latency stays bounded.
+
+    Requests the limit does not admit are answered at once with ``503 Service Unavailable``
+    and a ``Retry-After`` header instead of queueing behind those in progress.
+    """
+
+    BODY = b"Service overloaded, please retry later.\n"
+
+    def __init__(self, app, limit: AdaptiveLimit, retry_after: int):
+        self.app = app
+        self.limit = limit
+        self.retry_after = retry_after
+
+    def __call__(self, environ, start_response):
+        """Serve a request if it is admitted."""
+        if not self.limit.acquire():
+            start_response(
+                "503 Service Unavailable",
+                [
+                    ("Content-Type", "text/plain; charset=utf-8"),
+                    ("Content-Length", str(len(self.BODY))),
+                    ("Retry-After", str(self.retry_after)),
+                ],
+            )
+            return [self.BODY]
+        start = time.perf_counter()
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            self.limit.release(time.perf_counter() - start)
+            raise
+        return _ClosingIterable(app_iter, lambda: self.limit.release(time.perf_counter() - start))
+
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+
+class Metrics:
+    """Metric samples of one worker, shared with its sibling workers through a directory.
+
+    Every worker periodically writes a snapshot of its samples to
+    ``<directory>/<master pid>/<worker pid>.json``. A scrape merges the snapshots of all
+    workers of the running master, keeping the counters of workers that have exited but
+    only the gauges of live ones. The snapshots of exited workers are folded into a single
+    one as they are found, so that recycled workers do not pile up files for every scrape
+    to read again.
+    """
+
+    EXITED_SNAPSHOT = "exited.json"
+
+    def __init__(self, directory: str, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._types: Dict[str, Tuple[str, str]] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._last_flush = 0.0
+        self._cleaned = False
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str):
+        """Declare a counter."""
+        self._types[name] = ("counter", documentation)
+
+    def gauge(self, name: str, documentation: str):
+        """Declare a gauge."""
+        self._types[name] = ("gauge", documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float]):
+        """Declare a histogram with the given upper bucket bounds."""
+        self._types[name] = ("histogram", documentation)
+        self._buckets[name] = buckets
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """Register a callable returning current values of declared counters and gauges."""
+        self._collectors.append(collector)
+
+    def inc(self, name: str, labels: Labels, value: float = 1):
+        """Increase a counter or a gauge."""
+        samples = self._gauges if self._types[name][0] == "gauge" else self._counters
+        with self._lock:
+            samples[(name, labels)] = samples.get((name, labels), 0) + value
+
+    def observe(self, name: str, labels: Labels, value: float):
+        """Record an observation in a histogram."""
+        buckets = self._buckets[name]
+        with self._lock:
+            counts = self._histograms.get((name, labels))
+            if counts is None:
+                counts = self._histograms[(name, labels)] = [0.0] * (len(buckets) + 3)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self) -> dict:
+        """Return the samples of this worker in a JSON serializable form."""
+        counters = dict(self._counters)
+        gauges = dict(self._gauges)
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                target = gauges if self._types[name][0] == "gauge" else counters
+                target[(name, labels)] = value
+        with self._lock:
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        return {
+            "counters": _sample_list(counters),
+            "gauges": _sample_list(gauges),
+            "histograms": _sample_list(histograms),
+        }
+
+    def _worker_dir(self) -> str:
+        return os.path.join(self.directory, str(os.getppid()))
+
+    def flush(self, force: bool = False):
+        """Write this worker's snapshot for the other workers, at most once per interval."""
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        worker_dir = self._worker_dir()
+        try:
+            if not self._cleaned:
+                # Snapshots left behind by a previous master are stale.
+                for entry in os.listdir(self.directory) if os.path.isdir(self.directory) else ():
+                    if entry != os.path.basename(worker_dir):
+                        shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+                self._cleaned = True
+            os.makedirs(worker_dir, exist_ok=True)
+            path = os.path.join(worker_dir, f"{os.getpid()}.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def collect(self) -> dict:
+        """Merge the snapshots of all workers of the running master."""
+        self.flush(force=True)
+        merged: Dict[str, Dict[Tuple[str, Labels], Any]] = {
+            "counters": {},
+            "gauges": {},
+            "histograms": {},
+        }
+        worker_dir = self._worker_dir()
+        if not os.path.isdir(worker_dir):
+            return merged
+        try:
+            self._fold_exited(worker_dir)
+        except OSError:
+            pass
+        for filename in os.listdir(worker_dir):
+            if not filename.endswith(".json"):
+                continue
+            snapshot = _read_snapshot(os.path.join(worker_dir, filename))
+            if snapshot is None:
+                continue
+            pid = filename[: -len(".json")]
+            alive = pid.isdigit() and _pid_alive(int(pid))
+            kinds = ("counters", "gauges", "histograms") if alive else ("counters", "histograms")
+            _add_samples(merged, snapshot, kinds)
+        return merged
+
+    def _fold_exited(self, worker_dir: str):
+        """Add the snapshots of exited workers to the exited snapshot, then delete them."""
+        with open(os.path.join(worker_dir, ".lock"), "a") as lock:
+            # Workers scraped at the same time must not fold the same snapshot twice
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = [
+                os.path.join(worker_dir, filename)
+                for filename in os.listdir(worker_dir)
+                if filename.endswith(".json")
+                and filename[: -len(".json")].isdigit()
+                and not _pid_alive(int(filename[: -len(".json")]))
+            ]
+            if not exited:
+                return
+            path = os.path.join(worker_dir, self.EXITED_SNAPSHOT)
+            folded: Dict[str, Dict[Tuple[str, Labels], Any]] = {"counters": {}, "histograms": {}}
+            for snapshot_path in [path, *exited]:
+                if (snapshot := _read_snapshot(snapshot_path)) is not None:
+                    _add_samples(folded, snapshot, ("counters", "histograms"))
+            with open(path + ".tmp", "w") as f:
+                json.dump({kind: _sample_list(samples) for kind, samples in folded.items()}, f)
+            os.replace(path + ".tmp", path)
+            for snapshot_path in exited:
+                os.remove(snapshot_path)
+
+    def render(self) -> str:
+        """Render the merged samples of all workers in the Prometheus text format."""
+        merged = self.collect()
+        lines = []
+        for name, (kind, documentation) in sorted(self._types.items()):
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                samples = merged["counters" if kind == "counter" else "gauges"]
+                for (sample, labels), value in sorted(samples.items()):
+                    if sample == name:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            buckets = self._buckets[name]
+            for (sample, labels), counts in sorted(merged["histograms"].items()):
+                if sample != name:
+                    continue
+                cumulative = 0.0
+                for bound, count in zip([*buckets, "+Inf"], counts):
+                    cumulative += count
+                    le = (("le", bound if bound == "+Inf" else _number(bound)),)
+                    lines.append(f"{name}_bucket{_labels(labels + le)} {_number(cumulative)}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(counts[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {_number(counts[-1])}")
+        return "\n".join(lines) + "\n"
+
+
+def _read_snapshot(path: str) -> Optional[dict]:
+    """Return a worker snapshot read from a file, or None if it cannot be read."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _sample_list(samples: Dict[Tuple[str, Labels], Any]) -> list:
+    """Convert samples keyed on name and labels to the JSON form of a snapshot."""
+    return [[name, list(map(list, labels)), value] for (name, labels), value in samples.items()]
+
+
+def _add_samples(merged: Dict[str, dict], snapshot: dict, kinds: Sequence[str]):
+    """Add the samples of the given kinds of a snapshot to merged samples."""
+    for kind in kinds:
+        for name, labels, value in snapshot.get(kind, []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if kind == "histograms":
+                total = merged[kind].setdefault(key, [0.0] * len(value))
+                merged[kind][key] = [a + b for a, b in zip(total, value)]
+            else:
+                merged[kind][key] = merged[kind].get(key, 0) + value
+
+
+def _pid_alive(pid: int) -> bool:
+    """Return whether a process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _labels(labels: Labels) -> str:
+    """Format a label set for the Prometheus text format."""
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(value) -> str:
+    """Format a sample value for the Prometheus text format."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def cache_collector(name: str, cache: LRUCache) -> Callable[[], Iterable[Sample]]:
+    """Return a metrics collector for the counters of a cache."""
+    labels = (("cache", name),)
+
+    def collect() -> Iterable[Sample]:
+        return [
+            ("productpage_cache_hits_total", labels, cache.hits),
+            ("productpage_cache_misses_total", labels, cache.misses),
+            ("productpage_cache_evictions_total", labels, cache.evictions + cache.expirations),
+            ("productpage_cache_entries", labels, len(cache)),
+            ("productpage_cache_bytes", labels, cache.size),
+        ]
+
+    return collect
+
+
+class MetricsMiddleware:
+    """Record per-route request metrics and serve the metrics of all workers."""
+
+    METRICS_PATH = "/metrics"
+    ROUTES = ("/", "/productpage", "/login", "/logout", "/health")
+    METHODS = ("GET", "HEAD", "POST")
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+        metrics.counter("productpage_http_requests_total", "Requests served, by route and status.")
+        metrics.gauge("productpage_http_requests_in_flight", "Requests currently being served.")
+        metrics.histogram(
+            "productpage_http_request_duration_seconds",
+            "Time to serve a request, including sending the body.",
+            LATENCY_BUCKETS,
+        )
+        metrics.histogram(
+            "productpage_http_response_size_bytes", "Size of response bodies.", SIZE_BUCKETS
+        )
+        metrics.counter("productpage_cache_hits_total", "Cache hits, by cache.")
+        metrics.counter("productpage_cache_misses_total", "Cache misses, by cache.")
+        metrics.counter("productpage_cache_evictions_total", "Entries evicted or expired.")
+        metrics.gauge("productpage_cache_entries", "Entries currently cached.")
+        metrics.gauge("productpage_cache_bytes", "Bytes currently cached.")
+
+    @classmethod
+    def route(cls, path: str) -> str:
+        """Map a request path to a route label of bounded cardinality."""
+        if path.startswith("/static/"):
+            return "/static"
+        if path.startswith("/api/v1/products"):
+            return "/api/v1/products"
+        return path if path in cls.ROUTES else "other"
+
+    def __call__(self, environ, start_response):
+        """Serve a request, recording its metrics."""
+        path = environ.get("PATH_INFO", "")
+        method = environ.get("REQUEST_METHOD", "GET")
+        if path == self.METRICS_PATH and method == "GET":
+            body = self.metrics.render().encode("utf-8")
+            start_response(
+                "200 OK",
+                [
+                    ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                    ("Content-Length", str(len(body))),
+                ],
+            )
+            return [body]
+
+        route = (("route", self.route(path)),)
+        labels = route + (("method", method if method in self.METHODS else "other"),)
+        status = ["500"]
+        self.metrics.inc("productpage_http_requests_in_flight", route)
+        start = time.perf_counter()
+
+        def _start_response(code, headers, exc_info=None):
+            status[0] = code.split(" ", 1)[0]
+            return start_response(code, headers, exc_info)
+
+        try:
+            app_iter = self.app(environ, _start_response)
+        except BaseException:
+            self._finish(route, labels, status[0], start, 0)
+            raise
+        return self._track(app_iter, route, labels, status, start)
+
+    def _track(self, app_iter, route: Labels, labels: Labels, status: List[str], start: float):
+        """Pass the response body through, recording metrics once it has been sent."""
+        size = 0
+        try:
+            for chunk in app_iter:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self._finish(route, labels, status[0], start, size)
+
+    def _finish(self, route: Labels, labels: Labels, status: str, start: float, size: int):
+        metrics = self.metrics
+        metrics.inc("productpage_http_requests_total", labels + (("code", status),))
+        metrics.observe(
+            "productpage_http_request_duration_seconds", route, time.perf_counter() - start
+        )
+        metrics.observe("productpage_http_response_size_bytes", route, size)
+        metrics.inc("productpage_http_requests_in_flight", route, -1)
+        metrics.flush()
+
+
+# Backend services the upstream app calls, and the environment variables naming their hosts
+BACKENDS = ("details", "reviews", "ratings")
+
+
+def backends_from_env() -> Dict[str, str]:
+    """Map the backend hostnames set by the charm to backend names."""
+    domain = os.environ.get("SERVICES_DOMAIN")
+    hosts = {}
+    for name in BACKENDS:
+        host = os.environ.get(f"{name.upper()}_HOSTNAME", name)
+        hosts[f"{host}.{domain}" if domain else host] = name
+    return hosts
+
+
+def backend_name(hosts: Dict[str, str], url: str) -> str:
+    """Return the name of the backend a URL points to."""
+    return hosts.get(urlsplit(url).hostname or "", "other")
+
+
+def _is_timeout(error: BaseException) -> bool:
+    """Return whether an exception raised by an HTTP client is a timeout."""
+    return isinstance(error, TimeoutError) or "Timeout" in type(error).__name__
+
+
+class BackendClient:
+    """Outbound HTTP calls from the upstream app to the backend services.
+
+    Installed in place of the upstream ``send_request`` helper, it attributes every call to
+    the backend it targets and records its latency, errors, timeouts and bytes received.
+    """
+
+    def __init__(self, send: Callable[..., Any], hosts: Dict[str, str], metrics: Metrics):
+        self._send = send
+        self.hosts = hosts
+        self.metrics = metrics
+        metrics.counter("productpage_backend_requests_total", "Backend calls, by status code.")
+        metrics.counter("productpage_backend_errors_total", "Backend calls that failed.")
+        metrics.counter("productpage_backend_timeouts_total", "Backend calls that timed out.")
+        metrics.counter("productpage_backend_response_bytes_total", "Bytes received.")
+        metrics.histogram(
+            "productpage_backend_request_duration_seconds",
+            "Time taken by backend calls.",
+            LATENCY_BUCKETS,
+        )
+
+    def backend_for(self, url: str) -> str:
+        """Return the name of the backend a URL points to."""
+        return backend_name(self.hosts, url)
+
+    def __call__(self, url: str, **kwargs):
+        """Send a request to a backend, recording its metrics."""
+        backend = (("backend", self.backend_for(url)),)
+        start = time.perf_counter()
+        try:
+            response = self._send(url, **kwargs)
+        except Exception as e:
+            self._record(backend, start, "timeout" if _is_timeout(e) else "error")
+            raise
+        code = str(getattr(response, "status_code", ""))
+        size = 0 if kwargs.get("stream") else len(getattr(response, "content", b"") or b"")
+        self._record(backend, start, code, size)
+        return response
+
+    def _record(self, backend: Labels, start: float, code: str, size: int = 0):
+        metrics = self.metrics
+        metrics.observe(
+            "productpage_backend_request_duration_seconds", backend, time.perf_counter() - start
+        )
+        metrics.inc("productpage_backend_requests_total", backend + (("code", code),))
+        if code == "timeout":
+            metrics.inc("productpage_backend_timeouts_total", backend)
+        if code in ("timeout", "error") or code.startswith("5"):
+            metrics.inc("productpage_backend_errors_total", backend)
+        if size:
+            metrics.inc("productpage_backend_response_bytes_total", backend, size)
+
+
+class SessionPool:
+    """Shared keep-alive HTTP sessions, one per backend.
+
+    The upstream app opens a fresh connection for every backend call, paying for the TCP
+    and, behind the mesh, the mTLS handshake each time. Sessions idle for longer than
+    ``idle_timeout`` are replaced so connections the peer has since closed are not reused.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Any],
+        hosts: Dict[str, str],
+        max_connections: int = 0,
+        idle_timeout: float = 0,
+    ):
+        self._factory = session_factory
+        self.hosts = hosts
+        self.idle_timeout = idle_timeout
+        self.created: Dict[str, int] = {}
+        self._sessions: Dict[str, Tuple[Any, float]] = {}
+        self._limits = {}
+        if max_connections:
+            self._limits = {b: threading.BoundedSemaphore(max_connections) for b in BACKENDS}
+        self._lock = threading.Lock()
+
+    def _session(self, backend: str):
+        """Return the session for a backend, replacing it if it has been idle too long."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(backend)
+            if entry is not None and self.idle_timeout and now - entry[1] > self.idle_timeout:
+                entry[0].close()
+                entry = None
+            if entry is None:
+                session = self._factory()
+                self.created[backend] = self.created.get(backend, 0) + 1
+            else:
+                session = entry[0]
+            self._sessions[backend] = (session, now)
+        return session
+
+    def send(self, url: str, **kwargs):
+        """Send a GET request over the pooled session of the backend the URL points to."""
+        backend = self.hosts.get(urlsplit(url).hostname or "", "other")
+        session = self._session(backend)
+        limit = self._limits.get(backend)
+        if limit is None:
+            return session.get(url, **kwargs)
+        with limit:
+            return session.get(url, **kwargs)
+
+
+# Headers that differ on every page render without changing the backend response
+TRACING_HEADERS = frozenset(
+    {
+        "x-request-id",
+        "traceparent",
+        "tracestate",
+        "b3",
+        "x-b3-traceid",
+        "x-b3-spanid",
+        "x-b3-parentspanid",
+        "x-b3-sampled",
+        "x-b3-flags",
+        "x-ot-span-context",
+        "x-cloud-trace-context",
+        "x-datadog-trace-id",
+        "x-datadog-parent-id",
+        "x-datadog-sampling-priority",
+        "grpc-trace-bin",
+        "sw8",
+    }
+)
+
+
+def request_key(url: str, kwargs: dict) -> Optional[tuple]:
+    """Return what makes two backend requests identical, or None if one must not be shared."""
+    if kwargs.get("stream") or set(kwargs) - {"headers", "timeout"}:
+        return None
+    headers = kwargs.get("headers") or {}
+    relevant = ((k.lower(), v) for k, v in headers.items())
+    return (url, tuple(sorted(kv for kv in relevant if kv[0] not in TRACING_HEADERS)))
+
+
+class SingleFlight:
+    """Coalesce identical in-flight backend requests within a worker.
+
+    The first caller of a request becomes its leader and performs it; callers that ask for
+    the same URL with the same headers meanwhile wait up to ``max_wait`` and share the
+    leader's response, or make their own call if it takes longer than that. Tracing headers
+    are unique per page render and are left out of the comparison.
+    """
+
+    def __init__(self, max_wait: float):
+        self.max_wait = max_wait
+        self.coalesced = 0
+        self.wait_timeouts = 0
+        self._inflight: Dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, send: Callable[..., Any]) -> Callable[..., Any]:
+        """Return a sender that coalesces identical concurrent calls to ``send``."""
+
+        def coalesced_send(url: str, **kwargs):
+            key = request_key(url, kwargs)
+            if key is None:
+                return send(url, **kwargs)
+            with self._lock:
+                leader = self._inflight.get(key)
+                if leader is None:
+                    future = self._inflight[key] = Future()
+            if leader is not None:
+                try:
+                    response = leader.result(timeout=self.max_wait)
+                except FutureTimeoutError:
+                    self.wait_timeouts += 1
+                    return send(url, **kwargs)
+                self.coalesced += 1
+                return response
+            try:
+                response = send(url, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(response)
+                return response
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+        return coalesced_send
+
+
+class BackendRejectedError(Exception):
+    """Raised when a backend call is refused locally, without being sent."""
+
+
+class BulkheadFullError(BackendRejectedError):
+    """Raised instead of calling a backend whose bulkhead and queue are full."""
+
+
+class Bulkhead:
+    """Bound the concurrent calls to one backend, so a slow one cannot hold every greenlet.
+
+    Up to ``max_concurrent`` calls run at once; up to ``max_queue`` more wait for a free slot
+    for at most ``queue_timeout`` seconds. Any further call is rejected straight away with
+    :class:`BulkheadFullError`.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.rejections = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        """Take a slot, waiting in the queue if there is room in it."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.queued >= self.max_queue:
+                    self.rejections += 1
+                    raise BulkheadFullError("too many concurrent calls")
+                self.queued += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout or None)
+            finally:
+                with self._lock:
+                    self.queued -= 1
+            if not acquired:
+                with self._lock:
+                    self.rejections += 1
+                raise BulkheadFullError("timed out waiting for a free slot")
+        with self._lock:
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        """Give the slot back."""
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+
+def isolate_backends(
+    send: Callable[..., Any], bulkheads: Dict[str, Bulkhead], backend_for: Callable[[str], str]
+) -> Callable[..., Any]:
+    """Return a sender running each call to ``send`` in the bulkhead of its backend."""
+
+    def isolated_send(url: str, **kwargs):
+        bulkhead = bulkheads.get(backend_for(url))
+        if bulkhead is None:
+            return send(url, **kwargs)
+        with bulkhead:
+            return send(url, **kwargs)
+
+    return isolated_send
+
+
+class CircuitOpenError(BackendRejectedError):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Circuit breaker for the calls to one backend.
+
+    It opens after ``failure_threshold`` consecutive failures and then rejects calls for
+    ``reset_timeout`` seconds, after which a single trial call is let through: its success
+    closes the breaker again, its failure keeps it open for another period.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opens = 0
+        self.rejections = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are currently being rejected or waiting on a trial call."""
+        return self.failures >= self.failure_threshold
+
+    def allow(self) -> bool:
+        """Return whether a call may be sent to the backend now."""
+        with self._lock:
+            if not self.is_open:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejections += 1
+                return False
+            self._trial = True
+            return True
+
+    def cancel(self):
+        """Forget an allowed call that was not sent after all."""
+        with self._lock:
+            self._trial = False
+
+    def record(self, success: bool):
+        """Record the outcome of an allowed call."""
+        with self._lock:
+            trial, self._trial = self._trial, False
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures == self.failure_threshold or trial:
+                self.opens += 1
+            if self.is_open:
+                self._opened_at = time.monotonic()
+
+
+class BackendCache:
+    """Stale-while-revalidate cache of backend responses, with a circuit breaker per backend.
+
+    Successful responses are served from the cache for ``fresh_ttl`` seconds, then for up
+    to ``stale_ttl`` more seconds while a background call refreshes them. While the breaker
+    of a backend is open its calls are answered with the last good response, however old,
+    or fail fast with :class:`CircuitOpenError` if there is none.
+    """
+
+    def __init__(
+        self,
+        cache: LRUCache,
+        fresh_ttl: float,
+        stale_ttl: float,
+        breakers: Dict[str, CircuitBreaker],
+        backend_for: Callable[[str], str],
+    ):
+        self.cache = cache
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.breakers = breakers
+        self.backend_for = backend_for
+        self.served: Dict[Tuple[str, str], int] = {}
+        self._refreshing: set = set()
+        self._lock = threading.Lock()
+
+    def _count(self, backend: str, result: str):
+        self.served[(backend, result)] = self.served.get((backend, result), 0) + 1
+
+    def wrap(self, send: Callable[..., Any]) -> Callable[..., Any]:
+        """Return a sender that serves calls to ``send`` from the cache when possible."""
+
+        def cached_send(url: str, **kwargs):
+            backend = self.backend_for(url)
+            breaker = self.breakers.get(backend)
+            key = request_key(url, kwargs)
+            entry = self.cache.get(key) if key is not None else None
+            age = time.monotonic() - entry[1] if entry is not None else 0.0
+            if entry is not None and age < self.fresh_ttl:
+                self._count(backend, "fresh")
+                return entry[0]
+            if breaker is not None and not breaker.allow():
+                if entry is None:
+                    raise CircuitOpenError(f"circuit breaker open for {backend}")
+                self._count(backend, "fallback")
+                return entry[0]
+            if entry is not None and age < self.fresh_ttl + self.stale_ttl:
+                self._count(backend, "stale")
+                self._refresh(key, send, url, kwargs, breaker)
+                return entry[0]
+            try:
+                return self._fetch(key, send, url, kwargs, breaker)
+            except BackendRejectedError:
+                if entry is None:
+                    raise
+                self._count(backend, "fallback")
+                return entry[0]
+
+        return cached_send
+
+    def _fetch(self, key, send, url: str, kwargs: dict, breaker: Optional[CircuitBreaker]):
+        try:
+            response = send(url, **kwargs)
+        except BackendRejectedError:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        except Exception:
+            if breaker is not None:
+                breaker.record(False)
+            raise
+        status = getattr(response, "status_code", 0)
+        if breaker is not None:
+            breaker.record(status < 500)
+        if status == 200 and key is not None:
+            size = len(getattr(response, "content", b"") or b"")
+            self.cache.put(key, (response, time.monotonic()), size=size)
+        return response
+
+    def _refresh(self, key, send, url: str, kwargs: dict, breaker: Optional[CircuitBreaker]):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, send, url, kwargs, breaker)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        spawn(refresh)
+
+
+def requests_session_factory(pool_size: int) -> Callable[[], Any]:
+    """Return a factory of requests sessions keeping up to pool_size idle connections."""
+    import requests  # pyright: ignore[reportMissingModuleSource]
+    from requests.adapters import HTTPAdapter  # pyright: ignore[reportMissingModuleSource]
+
+    def factory():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    return factory
+
+
+def install_backend_client(upstream, client_factory: Callable[[Callable[..., Any]], Any]):
+    """Route the upstream app's backend calls through a client built around its sender."""
+    if hasattr(upstream, "send_request"):
+        upstream.send_request = client_factory(upstream.send_request)
+    else:
+        upstream.requests.get = client_factory(upstream.requests.get)
+
+
+def spawn(fn: Callable[..., Any], *args) -> Future:
+    """Run a function in the background, returning a future for its result.
+
+    Under the gevent worker, threading is monkey patched and this spawns a greenlet on the
+    hub rather than an OS thread.
+    """
+    future: Future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class ConcurrentFanOut:
+    """Fetch the details and reviews of a page render concurrently.
+
+    The upstream page handler fetches product details and then product reviews, one after
+    the other. While a ``/productpage`` render is in progress, requesting the details starts
+    the reviews for the same product and headers alongside them, and the reviews call that
+    follows picks up that result instead of making a second, sequential backend call. Other
+    routes, such as the product API, only fetch what they ask for. At most
+    ``max_concurrency`` reviews fetches run in the background per worker, 0 for no limit;
+    renders past it fetch their reviews sequentially.
+    """
+
+    PAGE_PATH = "/productpage"
+    REVIEWS_UNAVAILABLE = {
+        "error": "Sorry, product reviews are currently unavailable for this book."
+    }
+
+    def __init__(
+        self,
+        fetch_details: Callable[[Any, dict], Any],
+        fetch_reviews: Callable[[Any, dict], Any],
+        max_concurrency: int,
+        deadline: float,
+    ):
+        self._fetch_details = fetch_details
+        self._fetch_reviews = fetch_reviews
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self.fanouts = 0
+        self.timeouts = 0
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._local = threading.local()
+
+    @staticmethod
+    def _key(product_id, headers) -> tuple:
+        return (product_id, tuple(sorted((headers or {}).items())))
+
+    def wrap(self, app):
+        """Return the upstream WSGI app, prefetching reviews only while it renders the page."""
+
+        def render(environ, start_response):
+            self._local.page = environ.get("PATH_INFO") == self.PAGE_PATH
+            try:
+                return app(environ, start_response)
+            finally:
+                # A prefetch the handler did not pick up is dropped with the render
+                self._local.page = False
+                self._local.reviews = None
+
+        return render
+
+    def details(self, product_id, headers):
+        """Fetch product details, starting the matching reviews fetch alongside on renders."""
+        self._local.reviews = None
+        if getattr(self._local, "page", False) and self._acquire():
+            pending = spawn(self._prefetch, product_id, headers)
+            started = (self._key(product_id, headers), pending, time.monotonic() + self.deadline)
+            self._local.reviews = started
+            self.fanouts += 1
+        return self._fetch_details(product_id, headers)
+
+    def reviews(self, product_id, headers):
+        """Return the reviews started alongside the details, or fetch them now."""
+        started = getattr(self._local, "reviews", None)
+        self._local.reviews = None
+        if started is None or started[0] != self._key(product_id, headers):
+            return self._fetch_reviews(product_id, headers)
+        _, pending, deadline = started
+        try:
+            return pending.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self.timeouts += 1
+            return 504, dict(self.REVIEWS_UNAVAILABLE)
+
+    def _acquire(self) -> bool:
+        """Take a background fetch slot, returning False if all of them are in use."""
+        return self._slots is None or self._slots.acquire(blocking=False)
+
+    def _prefetch(self, product_id, headers):
+        """Fetch reviews in the background, giving the slot back once done."""
+        try:
+            return self._fetch_reviews(product_id, headers)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+def install_fan_out(upstream, max_concurrency: int, deadline: float) -> Optional[ConcurrentFanOut]:
+    """Make the upstream page handler fetch details and reviews concurrently."""
+    if not hasattr(upstream, "getProductDetails") or not hasattr(upstream, "getProductReviews"):
+        return None
+    fan_out = ConcurrentFanOut(
+        upstream.getProductDetails, upstream.getProductReviews, max_concurrency, deadline
+    )
+    upstream.getProductDetails = fan_out.details
+    upstream.getProductReviews = fan_out.reviews
+    upstream.app.wsgi_app = fan_out.wrap(upstream.app.wsgi_app)
+    return fan_out
+
+
+def backend_cache_collector(cache: BackendCache) -> Callable[[], Iterable[Sample]]:
+    """Return a metrics collector for a backend cache and its circuit breakers."""
+
+    def collect() -> Iterable[Sample]:
+        samples: List[Sample] = [
+            ("productpage_backend_cache_served_total", (("backend", b), ("result", r)), n)
+            for (b, r), n in list(cache.served.items())
+        ]
+        for name, breaker in cache.breakers.items():
+            labels = (("backend", name),)
+            samples += [
+                ("productpage_backend_circuit_open", labels, int(breaker.is_open)),
+                ("productpage_backend_circuit_opens_total", labels, breaker.opens),
+                ("productpage_backend_circuit_rejections_total", labels, breaker.rejections),
+            ]
+        return samples
+
+    return collect
+
+
+def _bulkheads_from_env(metrics: Metrics) -> Dict[str, Bulkhead]:
+    """Build the bulkheads of the backends the charm set a concurrency limit for."""
+    queue_timeout = _env_float("BULKHEAD_QUEUE_TIMEOUT", 1.0)
+    bulkheads = {
+        name: Bulkhead(limit, _env_int(f"{name.upper()}_MAX_QUEUE", 0), queue_timeout)
+        for name in BACKENDS
+        if (limit := _env_int(f"{name.upper()}_MAX_CONCURRENCY", 0))
+    }
+    if bulkheads:
+        metrics.gauge("productpage_backend_bulkhead_active", "Backend calls holding a slot.")
+        metrics.gauge("productpage_backend_bulkhead_queued", "Backend calls waiting for a slot.")
+        metrics.counter("productpage_backend_bulkhead_rejections_total", "Calls not sent.")
+        metrics.add_collector(
+            lambda: [
+                sample
+                for name, bulkhead in bulkheads.items()
+                for sample in (
+                    ("productpage_backend_bulkhead_active", (("backend", name),), bulkhead.active),
+                    ("productpage_backend_bulkhead_queued", (("backend", name),), bulkhead.queued),
+                    (
+                        "productpage_backend_bulkhead_rejections_total",
+                        (("backend", name),),
+                        bulkhead.rejections,
+                    ),
+                )
+            ]
+        )
+    return bulkheads
+
+
+def _backend_cache_from_env(hosts: Dict[str, str], metrics: Metrics) -> Optional[BackendCache]:
+    """Build the backend cache and circuit breakers configured by the charm, if any."""
+    fresh_ttl = _env_float("BACKEND_CACHE_TTL", 0)
+    failure_threshold = _env_int("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 0)
+    if not fresh_ttl and not failure_threshold:
+        return None
+    breakers = {}
+    if failure_threshold:
+        reset_timeout = _env_float("CIRCUIT_BREAKER_RESET_TIMEOUT", 10.0)
+        breakers = {name: CircuitBreaker(failure_threshold, reset_timeout) for name in BACKENDS}
+    cache = BackendCache(
+        LRUCache(BACKEND_CACHE_MAX_BYTES, max_entries=_env_int("BACKEND_CACHE_MAX_ENTRIES", 256)),
+        fresh_ttl=fresh_ttl,
+        stale_ttl=_env_float("BACKEND_CACHE_STALE_TTL", 30.0) if fresh_ttl else 0,
+        breakers=breakers,
+        backend_for=lambda url: backend_name(hosts, url),
+    )
+    metrics.counter("productpage_backend_cache_served_total", "Backend calls served cached.")
+    metrics.gauge("productpage_backend_circuit_open", "Whether a circuit breaker is open.")
+    metrics.counter("productpage_backend_circuit_opens_total", "Circuit breaker trips.")
+    metrics.counter("productpage_backend_circuit_rejections_total", "Calls not sent.")
+    metrics.add_collector(cache_collector("backend", cache.cache))
+    metrics.add_collector(backend_cache_collector(cache))
+    return cache
+
+
+def _install_backend_calls(upstream, metrics: Metrics):
+    """Wrap the upstream app's backend calls in the layers configured by the charm."""
+    hosts = backends_from_env()
+    pool = None
+    if pool_size := _env_int("BACKEND_POOL_SIZE", 0):
+        pool = sessions = SessionPool(
+            requests_session_factory(pool_size),
+            hosts,
+            max_connections=_env_int("BACKEND_MAX_CONNECTIONS", 0),
+            idle_timeout=_env_int("BACKEND_POOL_IDLE_TIMEOUT", 60),
+        )
+        metrics.counter("productpage_backend_sessions_created_total", "Pooled sessions opened.")
+        metrics.add_collector(
+            lambda: [
+                ("productpage_backend_sessions_created_total", (("backend", b),), n)
+                for b, n in sessions.created.items()
+            ]
+        )
+    single_flight = None
+    if _env_bool("BACKEND_COALESCING"):
+        single_flight = coalescer = SingleFlight(_env_float("BACKEND_COALESCING_MAX_WAIT", 1.0))
+        metrics.counter("productpage_backend_coalesced_total", "Calls served by a shared call.")
+        metrics.counter(
+            "productpage_backend_coalesce_wait_timeouts_total", "Calls that stopped waiting."
+        )
+        metrics.add_collector(
+            lambda: [
+                ("productpage_backend_coalesced_total", (), coalescer.coalesced),
+                ("productpage_backend_coalesce_wait_timeouts_total", (), coalescer.wait_timeouts),
+            ]
+        )
+    bulkheads = _bulkheads_from_env(metrics)
+    backend_cache = _backend_cache_from_env(hosts, metrics)
+
+    def backend_client(send: Callable[..., Any]) -> Callable[..., Any]:
+        send = BackendClient(pool.send if pool else send, hosts, metrics)
+        if bulkheads:
+            send = isolate_backends(send, bulkheads, lambda url: backend_name(hosts, url))
+        if single_flight is not None:
+            send = single_flight.wrap(send)
+        return backend_cache.wrap(send) if backend_cache is not None else send
+
+    install_backend_client(upstream, backend_client)
+
+
+def _cookies(environ) -> SimpleCookie:
+    """Parse the cookies sent with a request."""
+    cookies = SimpleCookie()
+    try:
+        cookies.load(environ.get("HTTP_COOKIE", ""))
+    except CookieError:
+        pass
+    return cookies
+
+
+def create_app():
+    """Build the WSGI application served by gunicorn."""
+    import productpage as upstream  # pyright: ignore[reportMissingImports]
+
+    app = upstream.app
+    static_folder = getattr(app, "static_folder", None)
+    metrics = Metrics(os.environ.get("METRICS_DIR", METRICS_DIR))
+
+    # Calls to details, reviews and ratings: pooled, instrumented, isolated in bulkheads,
+    # coalesced and cached per backend, behind a circuit breaker
+    _install_backend_calls(upstream, metrics)
+
+    # Details and reviews fetched concurrently on each page render
+    if _env_bool("CONCURRENT_FANOUT"):
+        fan_out = install_fan_out(
+            upstream,
+            max_concurrency=_env_int("FANOUT_MAX_CONCURRENCY", 0),
+            deadline=_env_float("FANOUT_DEADLINE", 3.0),
+        )
+        if fan_out is not None:
+            metrics.counter("productpage_fanout_total", "Page renders with concurrent fan-out.")
+            metrics.counter("productpage_fanout_timeouts_total", "Fan-outs past the deadline.")
+            metrics.add_collector(
+                lambda: [
+                    ("productpage_fanout_total", (), fan_out.fanouts),
+                    ("productpage_fanout_timeouts_total", (), fan_out.timeouts),
+                ]
+            )
+
+    # Path prefix from ingress
+    prefix = os.environ.get("PATH_PREFIX", "")
+    if prefix:
+        rewrite_cache = LRUCache(REWRITE_CACHE_MAX_BYTES)
+        metrics.add_collector(cache_collector("rewrite", rewrite_cache))
+        app = PathPrefixMiddleware(app, prefix, rewrite_cache)
+
+    # Load shedding for page renders, ahead of static assets, health probes and cached pages
+    if _env_bool("ADMISSION_CONTROL"):
+        app = admission = AdmissionControlMiddleware(
+            app,
+            AdaptiveLimit(
+                min_limit=_env_int("ADMISSION_MIN_LIMIT", 10),
+                max_limit=_env_int("ADMISSION_MAX_LIMIT", 200),
+                latency_target=_env_float("ADMISSION_LATENCY_TARGET", 1.0),
+            ),
+            retry_after=_env_int("ADMISSION_RETRY_AFTER", 1),
+        )
+        metrics.gauge("productpage_admission_limit", "Current adaptive concurrency limit.")
+        metrics.gauge("productpage_admission_in_flight", "Admitted requests in progress.")
+        metrics.counter("productpage_admission_shed_total", "Requests rejected with a 503.")
+        metrics.add_collector(
+            lambda: [
+                ("productpage_admission_limit", (), admission.limit.limit),
+                ("productpage_admission_in_flight", (), admission.limit.in_flight),
+                ("productpage_admission_shed_total", (), admission.limit.shed),
+            ]
+        )
+
+    # Static assets and health probes served from memory
+    assets = load_static_assets(static_folder, STATIC_PRELOAD_MAX_BYTES) if static_folder else {}
+    app = StaticFilesMiddleware(app, assets, STATIC_MAX_AGE)
+
+    # Response compression, negotiated per request
+    encodings: Sequence[str] = ()
+    if _env_bool("COMPRESSION_ENABLED"):
+        static_cache = LRUCache(STATIC_COMPRESSION_CACHE_MAX_BYTES)
+        metrics.add_collector(cache_collector("compressed-static", static_cache))
+        app = CompressionMiddleware(
+            app,
+            level=_env_int("COMPRESSION_LEVEL", 6),
+            min_size=_env_int("COMPRESSION_MIN_SIZE", 1024),
+            static_cache=static_cache,
+        )
+        encodings = app.encodings
+
+    # Full response cache for anonymous page views
+    if ttl := _env_int("RESPONSE_CACHE_TTL", 0):
+        response_cache = LRUCache(
+            max_bytes=_env_int("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+            max_entries=_env_int("RESPONSE_CACHE_MAX_ENTRIES", 128),
+            ttl=ttl,
+        )
+        metrics.add_collector(cache_collector("response", response_cache))
+        app = response_cached = ResponseCacheMiddleware(app, response_cache, encodings)
+        metrics.counter("productpage_response_cache_bypasses_total", "Requests not cacheable.")
+        metrics.counter("productpage_response_cache_stores_total", "Responses stored.")
+        metrics.add_collector(
+            lambda: [
+                ("productpage_response_cache_bypasses_total", (), response_cached.bypasses),
+                ("productpage_response_cache_stores_total", (), response_cached.stores),
+            ]
+        )
+
+    # Request metrics for every route, served on /metrics
+    return MetricsMiddleware(app, metrics)
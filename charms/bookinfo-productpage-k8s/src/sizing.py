@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Sizing of the gunicorn server from the CPU and memory limits of the workload container."""
+
+import math
+from typing import Callable, NamedTuple, Optional
+
+# Memory taken by one productpage worker once the upstream app has been imported
+WORKER_MEMORY = 96 * 1024 * 1024
+# Memory taken by one idle greenlet serving a connection, buffers included
+CONNECTION_MEMORY = 256 * 1024
+# Share of the memory limit left for gunicorn workers, the rest goes to the master process
+# and to the page cache of the container
+WORKER_MEMORY_SHARE = 0.8
+
+# Worker count when the container has no CPU limit, as before auto-sizing
+DEFAULT_WORKERS = 8
+MIN_WORKER_CONNECTIONS = 100
+MAX_WORKER_CONNECTIONS = 1000
+DEFAULT_BACKLOG = 2048
+
+# cgroup v2 files first, then their cgroup v1 equivalents
+CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CPU_QUOTA_V1 = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CPU_PERIOD_V1 = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+MEMORY_MAX = "/sys/fs/cgroup/memory.max"
+MEMORY_LIMIT_V1 = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+# cgroup v1 reports no memory limit as a huge page-aligned number instead of "max"
+UNLIMITED_V1 = 1 << 62
+
+
+class ContainerLimits(NamedTuple):
+    """CPU and memory limits of a container, None where it has none."""
+
+    cpus: Optional[float]
+    memory: Optional[int]
+
+
+class GunicornSettings(NamedTuple):
+    """Command-line settings of the gunicorn server."""
+
+    workers: int
+    worker_class: str
+    threads: int
+    worker_connections: int
+    keep_alive: int
+    backlog: int
+    preload: bool = False
+    max_requests: int = 0
+    max_requests_jitter: int = 0
+
+    def args(self) -> str:
+        """Return the settings as gunicorn command-line arguments."""
+        args = (
+            f"-w {self.workers} -k {self.worker_class} --threads {self.threads} "
+            f"--worker-connections {self.worker_connections} --keep-alive {self.keep_alive} "
+            f"--backlog {self.backlog}"
+        )
+        if self.preload:
+            args += " --preload"
+        if self.max_requests:
+            args += (
+                f" --max-requests {self.max_requests}"
+                f" --max-requests-jitter {self.max_requests_jitter}"
+            )
+        return args
+
+
+def read_limits(read: Callable[[str], Optional[str]]) -> ContainerLimits:
+    """Read the cgroup limits of a container with ``read``, which returns None for no file."""
+    cpus = None
+    if (cpu_max := read(CPU_MAX)) is not None:
+        quota, _, period = cpu_max.strip().partition(" ")
+        if quota != "max":
+            cpus = int(quota) / int(period or 100000)
+    elif (quota_v1 := read(CPU_QUOTA_V1)) is not None and int(quota_v1) > 0:
+        cpus = int(quota_v1) / int(read(CPU_PERIOD_V1) or 100000)
+
+    memory = None
+    if (memory_max := read(MEMORY_MAX)) is not None:
+        memory = None if memory_max.strip() == "max" else int(memory_max)
+    elif (limit_v1 := read(MEMORY_LIMIT_V1)) is not None and int(limit_v1) < UNLIMITED_V1:
+        memory = int(limit_v1)
+    return ContainerLimits(cpus, memory)
+
+
+def size_gunicorn(
+    limits: ContainerLimits,
+    workers: int = 0,
+    worker_class: str = "",
+    threads: int = 0,
+    worker_connections: int = 0,
+    keep_alive: int = 0,
+    backlog: int = 0,
+    preload: bool = False,
+    max_requests: int = 0,
+    max_requests_jitter: int = 0,
+) -> GunicornSettings:
+    """Derive the gunicorn settings from container limits, except those given explicitly.
+
+    Workers follow the ``2 * CPUs + 1`` rule of the gunicorn documentation, capped by how
+    many fit in the memory limit. Each gevent worker then gets as many connections as its
+    share of the remaining memory allows, and small pods keep idle connections open for
+    less time so that they do not hold on to those connections. Workers recycled after
+    ``max_requests`` get a tenth of it as jitter unless told otherwise, so that they do not
+    all restart at once.
+    """
+    memory = limits.memory * WORKER_MEMORY_SHARE if limits.memory else None
+    if not workers:
+        workers = DEFAULT_WORKERS if limits.cpus is None else int(2 * limits.cpus) + 1
+        if memory is not None:
+            workers = min(workers, int(memory // WORKER_MEMORY))
+        workers = max(1, workers)
+
+    if not worker_connections:
+        worker_connections = MAX_WORKER_CONNECTIONS
+        if memory is not None:
+            spare = memory / workers - WORKER_MEMORY
+            worker_connections = int(spare // CONNECTION_MEMORY)
+        worker_connections = min(
+            MAX_WORKER_CONNECTIONS, max(MIN_WORKER_CONNECTIONS, worker_connections)
+        )
+
+    worker_class = worker_class or "gevent"
+    if not threads:
+        threads = max(2, math.ceil(limits.cpus or 1) * 2) if worker_class == "gthread" else 1
+    if not keep_alive:
+        keep_alive = 5 if worker_connections >= MAX_WORKER_CONNECTIONS else 2
+    return GunicornSettings(
+        workers=workers,
+        worker_class=worker_class,
+        threads=threads,
+        worker_connections=worker_connections,
+        keep_alive=keep_alive,
+        backlog=backlog or DEFAULT_BACKLOG,
+        preload=preload,
+        max_requests=max_requests,
+        max_requests_jitter=max_requests_jitter or max_requests // 10,
+    )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Load generator behind the stress action, measuring the capacity of the backend services."""
+
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import httpx
+
+# Path requested from each backend service, as the productpage does for product 0
+BACKEND_PATHS = {
+    "details": "/details/0",
+    "reviews": "/reviews/0",
+    "ratings": "/ratings/0",
+}
+
+
+class StressReport(NamedTuple):
+    """Outcome of driving load against one backend service."""
+
+    requests: int
+    errors: int
+    elapsed: float
+    latencies: List[float]
+
+    @property
+    def throughput(self) -> float:
+        """Completed requests per second."""
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Return the latency in seconds below which ``p`` percent of the requests completed."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+    def results(self) -> Dict[str, str]:
+        """Format the report as action results, with latencies in milliseconds."""
+        return {
+            "requests": str(self.requests),
+            "errors": str(self.errors),
+            "throughput": f"{self.throughput:.1f}",
+            "latency-p50": f"{self.percentile(50) * 1000:.1f}",
+            "latency-p90": f"{self.percentile(90) * 1000:.1f}",
+            "latency-p99": f"{self.percentile(99) * 1000:.1f}",
+            "latency-max": f"{max(self.latencies, default=0) * 1000:.1f}",
+        }
+
+
+class _Schedule:
+    """Hands out send times at a fixed rate, or as fast as possible if the rate is 0.
+
+    No more than ``max_requests`` are handed out, unless it is 0.
+    """
+
+    def __init__(self, rate: float, start: float, deadline: float, max_requests: int = 0):
+        self.rate = rate
+        self.start = start
+        self.deadline = deadline
+        self.max_requests = max_requests
+        self._sent = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> Optional[float]:
+        """Return when to send the next request, or None once the deadline or limit is hit."""
+        with self._lock:
+            if self.max_requests and self._sent >= self.max_requests:
+                return None
+            at = self.start + self._sent / self.rate if self.rate else time.monotonic()
+            if at >= self.deadline:
+                return None
+            self._sent += 1
+            return at
+
+
+def stress_backend(
+    url: str,
+    duration: float,
+    rate: float = 0,
+    concurrency: int = 1,
+    timeout: float = 3.0,
+    max_requests: int = 0,
+    client_factory: Callable[..., httpx.Client] = httpx.Client,
+) -> StressReport:
+    """Send requests to ``url`` for ``duration`` seconds from ``concurrency`` threads.
+
+    With a ``rate``, requests are spread evenly at that many per second, as far as the
+    threads keep up; without one every thread sends its next request as soon as the
+    previous one completes. The run stops early once ``max_requests`` have been sent.
+    """
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    start = time.monotonic()
+    schedule = _Schedule(rate, start, start + duration, max_requests)
+
+    with client_factory(timeout=timeout) as client:
+
+        def run():
+            while (at := schedule.next()) is not None:
+                if (delay := at - time.monotonic()) > 0:
+                    time.sleep(delay)
+                sent = time.perf_counter()
+                try:
+                    ok = client.get(url).status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                latency = time.perf_counter() - sent
+                with lock:
+                    latencies.append(latency)
+                    errors[0] += not ok
+
+        threads = [threading.Thread(target=run) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return StressReport(len(latencies), errors[0], time.monotonic() - start, latencies)
+
+
+def stress(targets: Dict[str, str], duration: float, **kwargs) -> Dict[str, StressReport]:
+    """Drive load against the backend services at the given base URLs, all at once."""
+    reports: Dict[str, StressReport] = {}
+
+    def run(name: str, url: str):
+        reports[name] = stress_backend(
+            url.rstrip("/") + BACKEND_PATHS.get(name, "/"), duration, **kwargs
+        )
+
+    threads = [threading.Thread(target=run, args=item) for item in targets.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return reports
@@ -0,0 +1,93 @@
+"""Hook latency benchmarks for the productpage charm.
+
+Each event is dispatched to a charm whose workload is already running, as on a deployed unit.
+The cold hooks are set up in fresh interpreters instead, to measure the imports they skip.
+Run them with ``tox -e benchmark``, which writes the results to ``benchmark.json``.
+"""
+
+import itertools
+
+import ops
+import ops.testing
+import pytest
+from charms.bookinfo_lib.v0.benchmark import IMPORT_BUDGET
+
+from charm import ProductPageK8sCharm
+
+REMOTE_APP = "bookinfo-details-k8s"
+
+
+@pytest.fixture
+def harness():
+    """Start the charm with its workload running and a details backend."""
+    harness = ops.testing.Harness(ProductPageK8sCharm)
+    harness.set_leader(True)
+    harness.begin()
+    rel_id = harness.add_relation("details", REMOTE_APP)
+    harness.update_relation_data(rel_id, REMOTE_APP, {"url": "http://details:9080"})
+    harness.container_pebble_ready("bookinfo-productpage")
+    yield harness
+    harness.cleanup()
+
+
+def test_pebble_ready(benchmark, harness):
+    benchmark("pebble-ready", lambda: harness.container_pebble_ready("bookinfo-productpage"))
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_config_changed(benchmark, harness):
+    # Alternate the configuration so that every dispatch has a new layer to apply
+    levels = itertools.cycle(["debug", "info"])
+    benchmark("config-changed", lambda: harness.update_config({"log-level": next(levels)}))
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_update_status(benchmark, harness):
+    benchmark("update-status", harness.charm.on.update_status.emit)
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_relation_changed(benchmark, harness):
+    # Move reviews between two addresses so that every dispatch changes the environment
+    rel_id = harness.add_relation("reviews", "bookinfo-reviews-k8s")
+    urls = itertools.cycle(["http://reviews:9080", "http://reviews-v2:9080"])
+    benchmark(
+        "relation-changed",
+        lambda: harness.update_relation_data(rel_id, "bookinfo-reviews-k8s", {"url": next(urls)}),
+    )
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_relation_broken(benchmark, harness):
+    rel_ids = []
+
+    def relate():
+        rel_ids.append(harness.add_relation("ratings", "bookinfo-ratings-k8s"))
+        harness.update_relation_data(
+            rel_ids[-1], "bookinfo-ratings-k8s", {"url": "http://ratings:9080"}
+        )
+
+    benchmark("relation-broken", lambda: harness.remove_relation(rel_ids.pop()), setup=relate)
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_get_url(benchmark, harness):
+    benchmark("get-url", lambda: harness.run_action("get-url"))
+    assert harness.run_action("get-url").results["url"].endswith("/productpage?u=normal")
+
+
+def test_import_within_budget(benchmark):
+    # Every hook imports the charm anew, so a slower import fails the run
+    seconds = benchmark.import_seconds()
+    assert seconds < IMPORT_BUDGET, f"charm import took {seconds:.3f}s"
+
+
+def test_cold_update_status(benchmark):
+    # A hook the service mesh library does not handle leaves it unimported
+    assert not benchmark.cold("cold-update-status", ProductPageK8sCharm, "update-status")
+
+
+def test_cold_mesh_relation_changed(benchmark):
+    assert benchmark.cold(
+        "cold-service-mesh-relation-changed", ProductPageK8sCharm, "service-mesh-relation-changed"
+    )
@@ -1,10 +1,27 @@
 """Unit tests for productpage charm."""
 
+import json
+import os
+import subprocess
+import sys
 import unittest
+from unittest.mock import patch
 
 import ops.testing
+from fake_kubernetes import FakeKubernetes
 
-from charm import ProductPageK8sCharm
+from charm import ENVIRONMENT_PATH, ProductPageK8sCharm
+from stress import StressReport
+
+# Libraries the charm imports only in the hooks that use them
+DEFERRED_MODULES = {
+    "charms.istio_beacon_k8s.v0.service_mesh",
+    "lightkube",
+    "pydantic",
+    "httpx",
+}
+# Calls an update-status hook may make to each API once the workload is running
+UPDATE_STATUS_BUDGET = {"pebble": 5, "hook-tools": 2, "kubernetes": 0}
 
 
 class TestProductPageCharm(unittest.TestCase):
@@ -16,6 +33,12 @@ class TestProductPageCharm(unittest.TestCase):
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
+    def start_workload(self):
+        """Relate a backend and start the workload."""
+        rel_id = self.harness.add_relation("details", "details")
+        self.harness.update_relation_data(rel_id, "details", {"url": "http://details:9080"})
+        self.harness.container_pebble_ready("bookinfo-productpage")
+
     def test_charm_initializes(self):
         """Test that charm initializes without errors."""
         self.assertIsInstance(self.harness.charm, ProductPageK8sCharm)
@@ -27,3 +50,275 @@ class TestProductPageCharm(unittest.TestCase):
             self.harness.model.unit.status,
             (ops.WaitingStatus, ops.ActiveStatus, ops.MaintenanceStatus),
         )
+
+    def test_retracted_backend_is_dropped(self):
+        """Test that a backend retracting its URL until it is ready is no longer used."""
+        self.start_workload()
+        rel_id = self.harness.model.get_relation("details").id
+        self.harness.update_relation_data(rel_id, "details", {"url": "", "ready": "false"})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ops.WaitingStatus("Waiting for at least 1 backend service relation"),
+        )
+
+    def test_url_changed_only_on_new_url(self):
+        """Test that a backend databag update keeping the same URL does not reconcile."""
+        self.start_workload()
+        rel_id = self.harness.model.get_relation("details").id
+        charm = self.harness.charm
+
+        with patch.object(charm, "_reconcile") as reconcile:
+            self.harness.update_relation_data(rel_id, "details", {"generation": "2"})
+            reconcile.assert_not_called()
+            self.harness.update_relation_data(rel_id, "details", {"url": "http://details:9081"})
+        reconcile.assert_called_once()
+
+        with patch.object(charm, "_on_relation_changed") as changed:
+            self.harness.update_relation_data(rel_id, "details", {"url": "", "ready": "false"})
+        event = changed.call_args.args[0]
+        self.assertEqual((event.url, event.old_url), (None, "http://details:9081"))
+
+    def test_gunicorn_sized_from_container_limits(self):
+        """Test that the gunicorn command follows the cgroup limits of the workload container."""
+        self.harness.set_can_connect("bookinfo-productpage", True)
+        container = self.harness.charm.container
+        container.push("/sys/fs/cgroup/cpu.max", "100000 100000", make_dirs=True)
+        container.push("/sys/fs/cgroup/memory.max", str(1024 * 1024 * 1024))
+        self.harness.update_config({"backlog": 128})
+
+        command = self.harness.charm._generate_layer()["services"]["productpage"]["command"]
+        self.assertIn("-w 3 -k gevent", command)
+        self.assertIn("--backlog 128", command)
+
+    def test_preload_patches_gevent_in_master(self):
+        """Test that a preloaded gevent app has the master patch the standard library."""
+        self.harness.update_config({"preload-app": True, "worker-max-rss": 256})
+
+        service = self.harness.charm._generate_layer()["services"]["productpage"]
+        self.assertIn("--preload", service["command"])
+        self.assertIn("-c /opt/microservices/gunicorn_conf.py", service["command"])
+        environment = self.harness.charm._get_environment()
+        self.assertEqual(environment["GEVENT_PATCH_MASTER"], "true")
+        self.assertEqual(environment["WORKER_MAX_RSS"], str(256 * 1024 * 1024))
+
+    def test_environment_change_reloads_gracefully(self):
+        """Test that a new app environment is applied with SIGHUP rather than a restart."""
+        self.start_workload()
+        container = self.harness.charm.container
+
+        with patch.object(ops.Container, "send_signal") as send_signal:
+            self.harness.update_config({"log-level": "debug"})
+        send_signal.assert_called_once_with("SIGHUP", "productpage")
+        environment = json.loads(container.pull("/opt/microservices/productpage-env.json").read())
+        self.assertEqual(environment["LOG_LEVEL"], "debug")
+
+        with patch.object(ops.Container, "send_signal") as send_signal:
+            self.harness.update_config({"log-level": "debug"})
+        send_signal.assert_not_called()
+
+    def test_dropped_environment_restarts(self):
+        """Test that a backend withdrawing its URL keeps the environment, and removing it not."""
+        self.start_workload()
+        rel_id = self.harness.add_relation("reviews", "reviews")
+        with patch.object(ops.Container, "send_signal") as send_signal:
+            self.harness.update_relation_data(rel_id, "reviews", {"url": "http://reviews:9080"})
+        send_signal.assert_called_once_with("SIGHUP", "productpage")
+
+        # A backend that is not ready keeps its hostname, leaving the workload alone
+        with (
+            patch.object(ops.Container, "send_signal") as send_signal,
+            patch.object(ops.Container, "restart") as restart,
+        ):
+            self.harness.update_relation_data(rel_id, "reviews", {"url": "", "ready": "false"})
+        send_signal.assert_not_called()
+        restart.assert_not_called()
+        container = self.harness.charm.container
+        environment = json.loads(container.pull(ENVIRONMENT_PATH).read())
+        self.assertEqual(environment["REVIEWS_HOSTNAME"], "reviews")
+
+        # A reload cannot unset the variables of a removed backend
+        with (
+            patch.object(ops.Container, "send_signal") as send_signal,
+            patch.object(ops.Container, "restart") as restart,
+        ):
+            self.harness.remove_relation(rel_id)
+        send_signal.assert_not_called()
+        restart.assert_called_once_with("productpage")
+
+    def test_invalid_compression_level_blocks(self):
+        """Test that a compression level the workload rejects blocks rather than being applied."""
+        self.start_workload()
+        with patch.object(ops.Container, "push") as push:
+            self.harness.update_config({"compression-level": 12})
+        push.assert_not_called()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ops.BlockedStatus("compression-level must be between 1 and 9"),
+        )
+
+        self.harness.update_config({"compression-level": 9})
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)
+
+    def test_command_change_restarts(self):
+        """Test that a change to the gunicorn command goes through a replan."""
+        self.start_workload()
+
+        with patch.object(ops.Container, "send_signal") as send_signal:
+            self.harness.update_config({"workers": 3})
+        send_signal.assert_not_called()
+        plan = self.harness.get_container_pebble_plan("bookinfo-productpage")
+        self.assertIn("-w 3 ", plan.services["productpage"].command)
+
+    def test_unchanged_state_leaves_container_alone(self):
+        """Test that a hook with the same desired state does not touch the workload."""
+        self.start_workload()
+
+        with (
+            patch.object(ops.Container, "push") as push,
+            patch.object(ops.Container, "replan") as replan,
+        ):
+            self.harness.charm.on.update_status.emit()
+        push.assert_not_called()
+        replan.assert_not_called()
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)
+
+    def test_relation_data_read_once_per_dispatch(self):
+        """Test that status, layer and environment share one read of the backend relations."""
+        self.start_workload()
+        charm = self.harness.charm
+
+        with patch.object(charm, "_get_service_url", wraps=charm._get_service_url) as read:
+            charm.on.update_status.emit()
+        self.assertEqual(read.call_count, 3)
+        environment = charm._get_environment()
+        self.assertEqual(environment["DETAILS_HOSTNAME"], "details")
+        self.assertEqual(environment["DETAILS_SERVICE_PORT"], "9080")
+        self.assertNotIn("REVIEWS_HOSTNAME", environment)
+
+    def test_metrics_endpoint_publishes_scrape_job(self):
+        """Test that the leader publishes a scrape job for the workload metrics."""
+        self.harness.set_leader(True)
+        rel_id = self.harness.add_relation("metrics-endpoint", "prometheus")
+        self.harness.add_relation_unit(rel_id, "prometheus/0")
+
+        app_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        jobs = json.loads(app_data["scrape_jobs"])
+        self.assertEqual(jobs[0]["metrics_path"], "/metrics")
+        self.assertEqual(jobs[0]["static_configs"][0]["targets"], ["*:9080"])
+        self.assertEqual(
+            json.loads(app_data["scrape_metadata"])["application"], "bookinfo-productpage-k8s"
+        )
+        unit_data = self.harness.get_relation_data(rel_id, self.harness.charm.unit.name)
+        self.assertIn("prometheus_scrape_unit_address", unit_data)
+
+    def test_stress_action_fails_without_backends(self):
+        """Test that the stress action fails when no backend service is related."""
+        with self.assertRaises(ops.testing.ActionFailed) as raised:
+            self.harness.run_action("stress")
+        self.assertIn("No related backend", raised.exception.message)
+
+    @patch("stress.stress")
+    def test_stress_action_rejects_params_out_of_bounds(self, stress):
+        """Test that the stress action refuses parameters outside the bounds of its schema."""
+        rel_id = self.harness.add_relation("details", "details")
+        self.harness.update_relation_data(rel_id, "details", {"url": "http://details:9080"})
+
+        for params, message in (
+            ({"duration": 61}, "duration must be greater than 0 and at most 60"),
+            ({"rate": 5000}, "rate must be at least 0 and at most 1000"),
+            ({"concurrency": 0}, "concurrency must be at least 1 and at most 64"),
+            ({"timeout": 0}, "timeout must be greater than 0 and at most 30"),
+        ):
+            with self.assertRaises(ops.testing.ActionFailed) as raised:
+                self.harness.run_action("stress", params)
+            self.assertEqual(raised.exception.message, message)
+        stress.assert_not_called()
+
+    @patch("stress.stress")
+    def test_stress_action_reports_per_backend(self, stress):
+        """Test that the stress action drives the related backends and reports each."""
+        rel_id = self.harness.add_relation("details", "details")
+        self.harness.update_relation_data(rel_id, "details", {"url": "http://details:9080"})
+        stress.return_value = {"details": StressReport(4, 1, 2.0, [0.01, 0.02, 0.03, 0.04])}
+
+        output = self.harness.run_action("stress", {"duration": 2, "rate": 2})
+        stress.assert_called_once_with(
+            {"details": "http://details:9080"},
+            2.0,
+            rate=2.0,
+            concurrency=4,
+            timeout=3.0,
+            max_requests=100_000,
+        )
+        self.assertEqual(output.results["details"]["throughput"], "2.0")
+        self.assertEqual(output.results["details"]["latency-p50"], "20.0")
+        self.assertEqual(output.results["details"]["errors"], "1")
+
+    def test_import_defers_heavy_libraries(self):
+        """Test that importing the charm leaves out the mesh, Kubernetes and validation libs."""
+        code = "import sys, charm; print(*sys.modules)"
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        result = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+        )
+        self.assertFalse(DEFERRED_MODULES & set(result.stdout.split()))
+
+    def test_mesh_set_up_only_in_its_hooks(self):
+        """Test that the service mesh library is only loaded for the hooks it handles."""
+        for hook, expected in (("update-status", False), ("website-relation-created", True)):
+            with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": f"hooks/{hook}"}):
+                harness = ops.testing.Harness(ProductPageK8sCharm)
+                self.addCleanup(harness.cleanup)
+                harness.begin()
+            self.assertEqual(hasattr(harness.charm, "_mesh"), expected, hook)
+
+    def test_update_status_within_call_budget(self):
+        """Test that update-status stays within its budget of API calls."""
+        self.start_workload()
+        calls = self.harness.charm.api_calls
+        calls.reset()
+        self.harness.charm.on.update_status.emit()
+        for api, budget in UPDATE_STATUS_BUDGET.items():
+            self.assertLessEqual(calls.total(api), budget, calls.summary())
+
+    def test_mesh_labels_within_kubernetes_budget(self):
+        """Test that joining the mesh labels the workload with one read and four writes."""
+        # The mesh library looks its relation up when the charm starts
+        harness = ops.testing.Harness(ProductPageK8sCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        rel_id = harness.add_relation("service-mesh", "istio-beacon-k8s")
+        kubernetes = FakeKubernetes()
+        with patch.object(ProductPageK8sCharm, "_lightkube_client", return_value=kubernetes):
+            harness.begin()
+            calls = harness.charm.api_calls
+            calls.reset()
+
+            labels = {"istio.io/dataplane-mode": "ambient"}
+            harness.update_relation_data(
+                rel_id,
+                "istio-beacon-k8s",
+                {"labels": json.dumps(labels), "mesh_type": json.dumps("istio")},
+            )
+        self.assertEqual(calls.total("kubernetes"), 5, calls.summary())
+        service = kubernetes.objects["Service", "bookinfo-productpage-k8s"]
+        self.assertEqual(service["metadata"]["labels"], labels)
+
+    def test_health_check_drives_status(self):
+        """Test that the status follows the health check as soon as it fails or recovers."""
+        self.start_workload()
+        plan = self.harness.get_container_pebble_plan("bookinfo-productpage")
+        health = plan.checks["productpage-health"]
+        self.assertEqual(health.http, {"url": "http://localhost:9080/health"})
+        self.assertEqual((health.period, health.threshold), ("10s", 3))
+
+        container = self.harness.charm.container
+        events = self.harness.charm.on
+        check = container.get_check("productpage-health")
+        check.status = ops.pebble.CheckStatus.DOWN
+        events.bookinfo_productpage_pebble_check_failed.emit(container, "productpage-health")
+        self.assertEqual(self.harness.model.unit.status.message, "Health check failing")
+
+        check.status = ops.pebble.CheckStatus.UP
+        events.bookinfo_productpage_pebble_check_recovered.emit(container, "productpage-health")
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)
@@ -0,0 +1,80 @@
+"""Unit tests for the gunicorn configuration hooks."""
+
+import json
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import gunicorn_conf
+
+
+class TestPostRequest(unittest.TestCase):
+    """Test cases for the post_request hook."""
+
+    def worker(self):
+        """Return a stand-in for a live gunicorn worker."""
+        return SimpleNamespace(alive=True, log=MagicMock())
+
+    @patch.object(gunicorn_conf, "WORKER_MAX_RSS", 100)
+    @patch.object(gunicorn_conf, "worker_rss", return_value=101)
+    def test_worker_over_the_limit_is_recycled(self, _):
+        """Test that a worker whose RSS exceeds the limit stops after its requests."""
+        worker = self.worker()
+        gunicorn_conf.post_request(worker, None, {}, None)
+        self.assertFalse(worker.alive)
+
+    @patch.object(gunicorn_conf, "WORKER_MAX_RSS", 100)
+    @patch.object(gunicorn_conf, "worker_rss", return_value=99)
+    def test_worker_under_the_limit_keeps_running(self, _):
+        """Test that a worker within the limit is left alone."""
+        worker = self.worker()
+        gunicorn_conf.post_request(worker, None, {}, None)
+        self.assertTrue(worker.alive)
+
+    @patch.object(gunicorn_conf, "WORKER_MAX_RSS", 0)
+    def test_no_limit(self):
+        """Test that workers are never recycled without a limit."""
+        worker = self.worker()
+        with patch.object(gunicorn_conf, "worker_rss") as worker_rss:
+            gunicorn_conf.post_request(worker, None, {}, None)
+        worker_rss.assert_not_called()
+        self.assertTrue(worker.alive)
+
+    def test_worker_rss(self):
+        """Test that the RSS of the current process is read."""
+        self.assertGreater(gunicorn_conf.worker_rss(), 0)
+
+
+class TestWorkerExit(unittest.TestCase):
+    """Test cases for the worker_exit hook."""
+
+    def test_metrics_flushed(self):
+        """Test that an exiting worker writes its metrics regardless of the flush interval."""
+        metrics = MagicMock()
+        gunicorn_conf.worker_exit(None, SimpleNamespace(wsgi=SimpleNamespace(metrics=metrics)))
+        metrics.flush.assert_called_once_with(force=True)
+
+    def test_worker_without_app(self):
+        """Test that a worker that never loaded the app exits quietly."""
+        gunicorn_conf.worker_exit(None, SimpleNamespace())
+
+
+class TestLoadEnvironment(unittest.TestCase):
+    """Test cases for load_environment."""
+
+    def test_environment_file(self):
+        """Test that the app environment is read from the file written by the charm."""
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            json.dump({"LOG_LEVEL": "debug", "FANOUT_DEADLINE": 3.0}, f)
+            f.flush()
+            environment = gunicorn_conf.load_environment(f.name)
+        self.assertEqual(environment, {"LOG_LEVEL": "debug", "FANOUT_DEADLINE": "3.0"})
+
+    def test_missing_or_invalid_file(self):
+        """Test that an unreadable environment file gives an empty environment."""
+        self.assertEqual(gunicorn_conf.load_environment("/nonexistent.json"), {})
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            f.write("[]")
+            f.flush()
+            self.assertEqual(gunicorn_conf.load_environment(f.name), {})
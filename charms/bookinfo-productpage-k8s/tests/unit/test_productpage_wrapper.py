@@ -0,0 +1,891 @@
+"""Unit tests for the productpage WSGI wrapper."""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from productpage_wrapper import (
+    AdaptiveLimit,
+    AdmissionControlMiddleware,
+    BackendCache,
+    BackendClient,
+    Bulkhead,
+    BulkheadFullError,
+    CircuitBreaker,
+    CircuitOpenError,
+    CompressionMiddleware,
+    ConcurrentFanOut,
+    LRUCache,
+    Metrics,
+    MetricsMiddleware,
+    PathPrefixMiddleware,
+    PrefixRewriter,
+    ResponseCacheMiddleware,
+    SessionPool,
+    SingleFlight,
+    StaticFilesMiddleware,
+    install_fan_out,
+    isolate_backends,
+    load_static_assets,
+    negotiate_encoding,
+)
+
+PAGE = (
+    b'<link href="/static/bootstrap.css"><script src="/static/jquery.js"></script>'
+    b'<a href="/logout">Sign out</a><form action="login" method="post"></form>'
+)
+EXPECTED = (
+    b'<link href="/bookinfo/static/bootstrap.css"><script src="/bookinfo/static/jquery.js">'
+    b'</script><a href="/bookinfo/logout">Sign out</a>'
+    b'<form action="/bookinfo/login" method="post"></form>'
+)
+
+
+def html_app(chunks, content_type="text/html; charset=utf-8"):
+    """Return a WSGI app that serves the given body chunks and counts its calls."""
+
+    def app(environ, start_response):
+        app.calls += 1
+        length = sum(len(c) for c in chunks)
+        start_response("200 OK", [("Content-Type", content_type), ("Content-Length", str(length))])
+        return iter(chunks)
+
+    app.calls = 0
+    return app
+
+
+def call(app, environ):
+    """Call a WSGI app and return its status, headers and body."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"], response["headers"] = status, dict(headers)
+
+    app_iter = app(environ, start_response)
+    body = b"".join(app_iter)
+    if hasattr(app_iter, "close"):
+        app_iter.close()
+    return response["status"], response["headers"], body
+
+
+class TestPrefixRewriter(unittest.TestCase):
+    """Test cases for PrefixRewriter."""
+
+    def test_rewrites_whole_body(self):
+        """Test that all known paths are rewritten in a single chunk."""
+        rewriter = PrefixRewriter(b"/bookinfo")
+        self.assertEqual(rewriter.feed(PAGE) + rewriter.flush(), EXPECTED)
+
+    def test_rewrites_matches_split_across_chunks(self):
+        """Test that every possible chunk split yields the same output."""
+        for size in range(1, 20):
+            rewriter = PrefixRewriter(b"/bookinfo")
+            chunks = [PAGE[i : i + size] for i in range(0, len(PAGE), size)]
+            out = b"".join(rewriter.feed(c) for c in chunks) + rewriter.flush()
+            self.assertEqual(out, EXPECTED, f"chunk size {size}")
+
+
+class TestPathPrefixMiddleware(unittest.TestCase):
+    """Test cases for PathPrefixMiddleware."""
+
+    def call(self, app, cache=None):
+        """Call the wrapped app and return its status, headers and body chunks."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"], response["headers"] = status, dict(headers)
+
+        chunks = list(PathPrefixMiddleware(app, "/bookinfo", cache)({}, start_response))
+        return response["status"], response["headers"], chunks
+
+    def test_html_is_streamed_without_content_length(self):
+        """Test that HTML is rewritten chunk by chunk and the stale length is dropped."""
+        _, headers, chunks = self.call(html_app([PAGE[:40], PAGE[40:]]))
+        self.assertNotIn("Content-Length", headers)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), EXPECTED)
+
+    def test_non_html_is_passed_through(self):
+        """Test that non-HTML responses are untouched."""
+        _, headers, chunks = self.call(html_app([PAGE], content_type="text/css"))
+        self.assertEqual(headers["Content-Length"], str(len(PAGE)))
+        self.assertEqual(b"".join(chunks), PAGE)
+
+    def test_rewritten_chunks_are_cached(self):
+        """Test that a repeated body is streamed from the rewrite cache, chunk by chunk."""
+        cache = LRUCache(1024)
+        for _ in range(3):
+            _, _, chunks = self.call(html_app([PAGE[:40], PAGE[40:]]), cache)
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(b"".join(chunks), EXPECTED)
+        self.assertEqual((cache.misses, cache.hits, len(cache)), (2, 4, 2))
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test cases for LRUCache."""
+
+    def test_evicts_least_recently_used_by_size(self):
+        """Test that the oldest entries are evicted once the byte budget is exceeded."""
+        cache = LRUCache(10)
+        cache.put(b"a", b"1234")
+        cache.put(b"b", b"1234")
+        cache.get(b"a")
+        cache.put(b"c", b"1234")
+        self.assertIsNone(cache.get(b"b"))
+        self.assertEqual(cache.get(b"a"), b"1234")
+        self.assertEqual((cache.size, cache.evictions), (8, 1))
+
+    def test_expired_entries_are_dropped(self):
+        """Test that entries older than the TTL are treated as misses."""
+        cache = LRUCache(10, ttl=60)
+        cache.put(b"a", b"1234")
+        with patch("productpage_wrapper.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(b"a"))
+        self.assertEqual((cache.size, cache.expirations), (0, 1))
+
+
+class TestResponseCacheMiddleware(unittest.TestCase):
+    """Test cases for ResponseCacheMiddleware."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.upstream = html_app([PAGE])
+        self.app = ResponseCacheMiddleware(self.upstream, LRUCache(1024, max_entries=8, ttl=60))
+
+    def environ(self, query="u=normal", cookie=""):
+        """Return a GET /productpage environ."""
+        return {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": "/productpage",
+            "QUERY_STRING": query,
+            "HTTP_COOKIE": cookie,
+        }
+
+    def test_anonymous_views_are_cached_per_user_type(self):
+        """Test that repeated views are served from cache, keyed on the u parameter."""
+        _, headers, body = call(self.app, self.environ())
+        self.assertEqual((headers["X-Cache"], body), ("MISS", PAGE))
+        _, headers, body = call(self.app, self.environ())
+        self.assertEqual((headers["X-Cache"], body), ("HIT", PAGE))
+        self.assertEqual(headers["Content-Length"], str(len(PAGE)))
+        call(self.app, self.environ(query="u=test"))
+        self.assertEqual(self.upstream.calls, 2)
+        self.assertEqual((self.app.cache.hits, self.app.stores), (1, 2))
+
+    def test_session_holders_bypass_the_cache(self):
+        """Test that requests with a session cookie always reach the upstream app."""
+        for _ in range(2):
+            call(self.app, self.environ(cookie="session=abc"))
+        self.assertEqual(self.upstream.calls, 2)
+        self.assertEqual(self.app.bypasses, 2)
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+    """Test cases for CompressionMiddleware."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.upstream = html_app([PAGE[:40], PAGE[40:]])
+        self.app = CompressionMiddleware(self.upstream, 6, 16, LRUCache(1024))
+        self.app.encodings = ("gzip",)
+
+    def environ(self, path="/productpage", accept="gzip, deflate"):
+        """Return a GET environ."""
+        return {"REQUEST_METHOD": "GET", "PATH_INFO": path, "HTTP_ACCEPT_ENCODING": accept}
+
+    def test_negotiates_encoding(self):
+        """Test that the preferred acceptable encoding is chosen."""
+        available = ("br", "gzip")
+        self.assertEqual(negotiate_encoding({"HTTP_ACCEPT_ENCODING": "gzip, br"}, available), "br")
+        self.assertEqual(
+            negotiate_encoding({"HTTP_ACCEPT_ENCODING": "br;q=0, *"}, available), "gzip"
+        )
+        self.assertIsNone(negotiate_encoding({"HTTP_ACCEPT_ENCODING": "identity"}, available))
+        self.assertIsNone(negotiate_encoding({}, available))
+
+    def test_pages_are_compressed(self):
+        """Test that HTML is gzip compressed for clients that accept it."""
+        _, headers, body = call(self.app, self.environ())
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual(gzip.decompress(body), PAGE)
+
+    def test_uncompressed_without_accept_encoding(self):
+        """Test that clients that do not accept gzip get the original response."""
+        _, headers, body = call(self.app, self.environ(accept=""))
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(body, PAGE)
+
+    def test_small_responses_are_not_compressed(self):
+        """Test that responses below the minimum size are sent as is."""
+        self.app.min_size = len(PAGE) + 1
+        _, headers, body = call(self.app, self.environ())
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(body, PAGE)
+
+    def test_level_out_of_range_is_clamped(self):
+        """Test that a compression level gzip does not accept still compresses pages."""
+        for level, clamped in ((0, 1), (12, 9)):
+            app = CompressionMiddleware(self.upstream, level, 16, LRUCache(1024))
+            app.encodings = ("gzip",)
+            self.assertEqual(app.level, clamped)
+            _, headers, body = call(app, self.environ())
+            self.assertEqual(gzip.decompress(body), PAGE)
+
+    def test_static_assets_are_served_precompressed(self):
+        """Test that compressed static assets are cached per validator."""
+
+        def static_app(environ, start_response):
+            static_app.calls += 1
+            start_response("200 OK", [("Content-Type", "text/css"), ("ETag", '"v1"')])
+            return iter([PAGE])
+
+        static_app.calls = 0
+        self.app.app = static_app
+        for _ in range(2):
+            _, headers, body = call(self.app, self.environ(path="/static/site.css"))
+            self.assertEqual(gzip.decompress(body), PAGE)
+            self.assertEqual(headers["Content-Length"], str(len(body)))
+            self.assertEqual(headers["ETag"], 'W/"v1"')
+        self.assertEqual((self.app.static_cache.misses, self.app.static_cache.hits), (1, 1))
+
+
+class TestStaticFilesMiddleware(unittest.TestCase):
+    """Test cases for StaticFilesMiddleware."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.makedirs(os.path.join(tmp.name, "css"))
+        with open(os.path.join(tmp.name, "css", "site.css"), "wb") as f:
+            f.write(b"body { color: red; }")
+        self.upstream = html_app([PAGE])
+        self.app = StaticFilesMiddleware(self.upstream, load_static_assets(tmp.name, 1024), 60)
+
+    def environ(self, path, **headers):
+        """Return a GET environ."""
+        return {"REQUEST_METHOD": "GET", "PATH_INFO": path, **headers}
+
+    def test_health_is_answered_directly(self):
+        """Test that health probes never reach the upstream app."""
+        status, _, body = call(self.app, self.environ("/health"))
+        self.assertEqual((status, body), ("200 OK", b"Product page is healthy"))
+        self.assertEqual(self.upstream.calls, 0)
+
+    def test_static_assets_are_served_from_memory(self):
+        """Test that preloaded assets are served with caching headers."""
+        status, headers, body = call(self.app, self.environ("/static/css/site.css"))
+        self.assertEqual((status, body), ("200 OK", b"body { color: red; }"))
+        self.assertEqual(headers["Content-Type"], "text/css; charset=utf-8")
+        self.assertEqual(headers["Cache-Control"], "public, max-age=60")
+        self.assertIn("Last-Modified", headers)
+        self.assertEqual(self.upstream.calls, 0)
+
+    def test_conditional_requests_get_not_modified(self):
+        """Test that matching validators result in a 304 without a body."""
+        _, headers, _ = call(self.app, self.environ("/static/css/site.css"))
+        for validator in (
+            {"HTTP_IF_NONE_MATCH": "W/" + headers["ETag"]},
+            {"HTTP_IF_MODIFIED_SINCE": headers["Last-Modified"]},
+        ):
+            status, _, body = call(self.app, self.environ("/static/css/site.css", **validator))
+            self.assertEqual((status, body), ("304 Not Modified", b""))
+
+    def test_unknown_paths_reach_the_upstream_app(self):
+        """Test that pages and unknown assets are forwarded."""
+        call(self.app, self.environ("/static/missing.js"))
+        call(self.app, self.environ("/productpage"))
+        self.assertEqual(self.upstream.calls, 2)
+
+
+class TestAdmissionControlMiddleware(unittest.TestCase):
+    """Test cases for AdmissionControlMiddleware and AdaptiveLimit."""
+
+    def test_requests_over_the_limit_are_shed(self):
+        """Test that a request over the limit gets a 503 with Retry-After."""
+        limit = AdaptiveLimit(min_limit=1, max_limit=1, latency_target=1)
+        app = AdmissionControlMiddleware(html_app([PAGE]), limit, retry_after=2)
+
+        body = app({"PATH_INFO": "/productpage"}, lambda status, headers: None)
+        status, headers, _ = call(app, {"PATH_INFO": "/productpage"})
+        self.assertTrue(status.startswith("503"))
+        self.assertEqual(headers["Retry-After"], "2")
+        self.assertEqual((limit.in_flight, limit.shed), (1, 1))
+
+        body.close()
+        self.assertEqual(call(app, {"PATH_INFO": "/productpage"})[0], "200 OK")
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_limit_grows_with_fast_requests_in_use(self):
+        """Test that fast completions raise the limit only while it is being used."""
+        limit = AdaptiveLimit(min_limit=4, max_limit=5, latency_target=1)
+        limit.acquire()
+        limit.release(0.01)
+        self.assertEqual(limit.limit, 4)
+
+        for _ in range(10):
+            for _ in range(4):
+                limit.acquire()
+            for _ in range(4):
+                limit.release(0.01)
+        self.assertEqual(limit.limit, 5)
+
+    @patch("productpage_wrapper.time.monotonic")
+    def test_limit_backs_off_once_per_latency_target(self, monotonic):
+        """Test that slow completions lower the limit, at most once per target interval."""
+        monotonic.return_value = 100.0
+        limit = AdaptiveLimit(min_limit=5, max_limit=100, latency_target=1)
+        limit.limit = 50.0
+        for _ in range(3):
+            limit.acquire()
+            limit.release(2.0)
+        self.assertEqual(limit.limit, 45)
+
+        monotonic.return_value = 101.0
+        limit.acquire()
+        limit.release(2.0)
+        self.assertEqual(limit.limit, 40.5)
+
+
+class TestMetricsMiddleware(unittest.TestCase):
+    """Test cases for MetricsMiddleware."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.metrics_dir = tmp.name
+        self.app = MetricsMiddleware(html_app([PAGE]), Metrics(self.metrics_dir))
+
+    def scrape(self):
+        """Return the lines served on /metrics."""
+        status, headers, body = call(self.app, {"REQUEST_METHOD": "GET", "PATH_INFO": "/metrics"})
+        self.assertEqual(status, "200 OK")
+        self.assertTrue(headers["Content-Type"].startswith("text/plain"))
+        return body.decode().splitlines()
+
+    def test_requests_are_recorded_per_route(self):
+        """Test that counts, latencies, sizes and in-flight requests are exported."""
+        for path in ("/productpage", "/productpage", "/static/a.css", "/unknown"):
+            call(self.app, {"REQUEST_METHOD": "GET", "PATH_INFO": path})
+        lines = self.scrape()
+        self.assertIn(
+            'productpage_http_requests_total{route="/productpage",method="GET",code="200"} 2',
+            lines,
+        )
+        self.assertIn(
+            'productpage_http_requests_total{route="other",method="GET",code="200"} 1', lines
+        )
+        self.assertIn(
+            'productpage_http_request_duration_seconds_bucket{route="/static",le="+Inf"} 1',
+            lines,
+        )
+        self.assertIn(
+            f'productpage_http_response_size_bytes_sum{{route="/productpage"}} {2 * len(PAGE)}',
+            lines,
+        )
+        self.assertIn('productpage_http_requests_in_flight{route="/productpage"} 0', lines)
+
+    def test_samples_are_merged_across_workers(self):
+        """Test that counters of all workers are summed and gauges of exited ones dropped."""
+        call(self.app, {"REQUEST_METHOD": "GET", "PATH_INFO": "/productpage"})
+        exited_pid = 2**22 + 1
+        labels = [["route", "/productpage"]]
+        snapshot = {
+            "counters": [
+                [
+                    "productpage_http_requests_total",
+                    labels + [["method", "GET"], ["code", "200"]],
+                    5,
+                ]
+            ],
+            "gauges": [["productpage_http_requests_in_flight", labels, 3]],
+            "histograms": [],
+        }
+        worker_dir = os.path.join(self.metrics_dir, str(os.getppid()))
+        with open(os.path.join(worker_dir, f"{exited_pid}.json"), "w") as f:
+            json.dump(snapshot, f)
+        for _ in range(2):
+            lines = self.scrape()
+            self.assertIn(
+                'productpage_http_requests_total{route="/productpage",method="GET",code="200"} 6',
+                lines,
+            )
+            self.assertIn('productpage_http_requests_in_flight{route="/productpage"} 0', lines)
+            # The exited worker's snapshot is folded into one shared by all exited workers
+            self.assertEqual(
+                sorted(f for f in os.listdir(worker_dir) if f.endswith(".json")),
+                sorted(["exited.json", f"{os.getpid()}.json"]),
+            )
+
+
+class ReadTimeout(Exception):  # noqa: N818
+    """Stand-in for the timeout raised by requests."""
+
+
+class TestBackendClient(unittest.TestCase):
+    """Test cases for BackendClient."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.metrics = Metrics(tmp.name)
+        self.hosts = {"details": "details", "reviews": "reviews", "ratings": "ratings"}
+
+    def sample(self, name, **labels):
+        """Return the current value of a counter."""
+        return self.metrics.collect()["counters"].get((name, tuple(labels.items())), 0)
+
+    def test_calls_are_attributed_per_backend(self):
+        """Test that status, bytes and latency are recorded under the backend's name."""
+
+        def send(url, **kwargs):
+            return SimpleNamespace(status_code=200, content=b"{}")
+
+        client = BackendClient(send, self.hosts, self.metrics)
+        client("http://details:9080/details/0", timeout=3.0)
+        client("http://reviews:9080/reviews/0", timeout=3.0)
+        self.assertEqual(
+            self.sample("productpage_backend_requests_total", backend="details", code="200"), 1
+        )
+        self.assertEqual(
+            self.sample("productpage_backend_response_bytes_total", backend="reviews"), 2
+        )
+        histograms = self.metrics.collect()["histograms"]
+        key = ("productpage_backend_request_duration_seconds", (("backend", "details"),))
+        self.assertEqual(histograms[key][-1], 1)
+
+    def test_timeouts_and_errors_are_counted(self):
+        """Test that failed calls are counted and the error is propagated."""
+
+        def send(url, **kwargs):
+            raise ReadTimeout()
+
+        client = BackendClient(send, self.hosts, self.metrics)
+        with self.assertRaises(ReadTimeout):
+            client("http://ratings:9080/ratings/0")
+        self.assertEqual(self.sample("productpage_backend_timeouts_total", backend="ratings"), 1)
+        self.assertEqual(self.sample("productpage_backend_errors_total", backend="ratings"), 1)
+
+
+class FakeSession:
+    """Stand-in for a requests session."""
+
+    def __init__(self):
+        self.urls = []
+        self.closed = False
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return SimpleNamespace(status_code=200, content=b"{}")
+
+    def close(self):
+        self.closed = True
+
+
+class TestSessionPool(unittest.TestCase):
+    """Test cases for SessionPool."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.sessions = []
+
+        def factory():
+            self.sessions.append(FakeSession())
+            return self.sessions[-1]
+
+        hosts = {"details": "details", "reviews": "reviews"}
+        self.pool = SessionPool(factory, hosts, max_connections=2, idle_timeout=60)
+
+    def test_one_session_is_shared_per_backend(self):
+        """Test that calls to the same backend reuse its session."""
+        for _ in range(3):
+            self.pool.send("http://details:9080/details/0")
+        self.pool.send("http://reviews:9080/reviews/0")
+        self.assertEqual(len(self.sessions), 2)
+        self.assertEqual(len(self.sessions[0].urls), 3)
+        self.assertEqual(self.pool.created, {"details": 1, "reviews": 1})
+
+    def test_idle_sessions_are_replaced(self):
+        """Test that a session unused for longer than the idle timeout is closed."""
+        self.pool.send("http://details:9080/details/0")
+        later = time.monotonic() + 61
+        with patch("productpage_wrapper.time.monotonic", return_value=later):
+            self.pool.send("http://details:9080/details/0")
+        self.assertTrue(self.sessions[0].closed)
+        self.assertEqual(self.pool.created, {"details": 2})
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test cases for SingleFlight."""
+
+    def slow_send(self, delay):
+        """Return a send function that takes a while and counts its calls."""
+
+        def send(url, **kwargs):
+            send.calls += 1
+            time.sleep(delay)
+            return f"response {send.calls}"
+
+        send.calls = 0
+        return send
+
+    def concurrently(self, send, *headers):
+        """Call send from one thread per headers dict and return the responses."""
+        results = [None] * len(headers)
+
+        def run(i):
+            results[i] = send("http://reviews:9080/reviews/0", headers=headers[i], timeout=3)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(headers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_share_one_response(self):
+        """Test that concurrent calls differing only in tracing headers are coalesced."""
+        send = self.slow_send(0.1)
+        single_flight = SingleFlight(max_wait=1.0)
+
+        results = self.concurrently(
+            single_flight.wrap(send), *({"x-request-id": str(i)} for i in range(4))
+        )
+        self.assertEqual(send.calls, 1)
+        self.assertEqual(results, ["response 1"] * 4)
+        self.assertEqual(single_flight.coalesced, 3)
+
+    def test_different_headers_are_not_coalesced(self):
+        """Test that calls for different users are sent separately."""
+        send = self.slow_send(0.05)
+        single_flight = SingleFlight(max_wait=1.0)
+
+        self.concurrently(single_flight.wrap(send), {"end-user": "jason"}, {"end-user": "alice"})
+        self.assertEqual(send.calls, 2)
+        self.assertEqual(single_flight.coalesced, 0)
+
+    def test_follower_stops_waiting_after_max_wait(self):
+        """Test that a follower makes its own call when the leader is too slow."""
+        send = self.slow_send(0.2)
+        single_flight = SingleFlight(max_wait=0.01)
+
+        self.concurrently(single_flight.wrap(send), {}, {})
+        self.assertEqual(send.calls, 2)
+        self.assertEqual(single_flight.wait_timeouts, 1)
+
+    def test_failures_are_shared_and_not_remembered(self):
+        """Test that followers see the leader's error and later calls go upstream again."""
+
+        def send(url, **kwargs):
+            send.calls += 1
+            time.sleep(0.05)
+            raise ReadTimeout()
+
+        send.calls = 0
+        wrapped = SingleFlight(max_wait=1.0).wrap(send)
+        errors = []
+
+        def run():
+            try:
+                wrapped("http://details:9080/details/0")
+            except ReadTimeout as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((send.calls, len(errors)), (1, 3))
+        self.assertRaises(ReadTimeout, wrapped, "http://details:9080/details/0")
+        self.assertEqual(send.calls, 2)
+
+
+class TestBulkhead(unittest.TestCase):
+    """Test cases for Bulkhead and isolate_backends."""
+
+    def hold(self, bulkhead, release):
+        """Take a slot of the bulkhead in a thread until release is set."""
+        taken = threading.Event()
+
+        def run():
+            with bulkhead:
+                taken.set()
+                release.wait(1)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        taken.wait(1)
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+
+    def test_full_bulkhead_rejects_immediately(self):
+        """Test that a call is rejected without waiting when slots and queue are full."""
+        bulkhead = Bulkhead(max_concurrent=1, max_queue=0, queue_timeout=5)
+        self.hold(bulkhead, threading.Event())
+
+        start = time.monotonic()
+        with self.assertRaises(BulkheadFullError):
+            with bulkhead:
+                pass
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual((bulkhead.active, bulkhead.rejections), (1, 1))
+
+    def test_queued_call_runs_when_a_slot_frees(self):
+        """Test that a queued call takes the slot released by another."""
+        bulkhead = Bulkhead(max_concurrent=1, max_queue=1, queue_timeout=1)
+        release = threading.Event()
+        self.hold(bulkhead, release)
+        threading.Timer(0.05, release.set).start()
+
+        with bulkhead:
+            self.assertEqual((bulkhead.active, bulkhead.queued), (1, 0))
+        self.assertEqual(bulkhead.rejections, 0)
+
+    def test_queued_call_is_rejected_after_timeout(self):
+        """Test that a call waiting longer than the queue timeout is rejected."""
+        bulkhead = Bulkhead(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        self.hold(bulkhead, threading.Event())
+
+        with self.assertRaises(BulkheadFullError):
+            with bulkhead:
+                pass
+        self.assertEqual((bulkhead.queued, bulkhead.rejections), (0, 1))
+
+    def test_slow_backend_does_not_limit_others(self):
+        """Test that only calls to the backend with a full bulkhead are rejected."""
+        bulkheads = {"reviews": Bulkhead(max_concurrent=1, max_queue=0, queue_timeout=1)}
+        send = isolate_backends(
+            lambda url, **kwargs: url, bulkheads, lambda url: url.split("/")[2]
+        )
+        self.hold(bulkheads["reviews"], threading.Event())
+
+        self.assertRaises(BulkheadFullError, send, "http://reviews/reviews/0")
+        self.assertEqual(send("http://details/details/0"), "http://details/details/0")
+
+
+class TestBackendCache(unittest.TestCase):
+    """Test cases for BackendCache and CircuitBreaker."""
+
+    URL = "http://reviews:9080/reviews/0"
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch("productpage_wrapper.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sender(self, *outcomes):
+        """Return a send function producing the given responses or raising the errors."""
+
+        def send(url, **kwargs):
+            send.calls += 1
+            outcome = outcomes[min(send.calls, len(outcomes)) - 1]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return SimpleNamespace(status_code=outcome, content=b"{}", call=send.calls)
+
+        send.calls = 0
+        return send
+
+    def backend_cache(self, fresh_ttl=10, stale_ttl=30, threshold=0):
+        """Return a backend cache with a breaker for reviews if a threshold is given."""
+        breakers = {"reviews": CircuitBreaker(threshold, reset_timeout=5)} if threshold else {}
+        return BackendCache(
+            LRUCache(1024), fresh_ttl, stale_ttl, breakers, backend_for=lambda url: "reviews"
+        )
+
+    def test_fresh_responses_are_reused(self):
+        """Test that identical calls within the fresh TTL reach the backend once."""
+        send = self.sender(200)
+        cache = self.backend_cache()
+        cached_send = cache.wrap(send)
+
+        first = cached_send(self.URL, headers={"x-request-id": "1"}, timeout=3)
+        self.now += 5
+        self.assertIs(cached_send(self.URL, headers={"x-request-id": "2"}, timeout=3), first)
+        self.assertEqual(send.calls, 1)
+        self.assertEqual(cache.served, {("reviews", "fresh"): 1})
+
+    def test_stale_responses_are_served_while_refreshed(self):
+        """Test that an expired response is returned at once and refreshed in the background."""
+        send = self.sender(200)
+        cache = self.backend_cache()
+        cached_send = cache.wrap(send)
+
+        first = cached_send(self.URL)
+        self.now += 15
+        with patch("productpage_wrapper.spawn", side_effect=lambda fn: fn()) as spawn:
+            self.assertIs(cached_send(self.URL), first)
+        spawn.assert_called_once()
+        self.assertEqual(send.calls, 2)
+        self.assertEqual(cached_send(self.URL).call, 2)
+
+    def test_errors_are_not_cached(self):
+        """Test that failed calls are sent to the backend every time."""
+        send = self.sender(503)
+        cached_send = self.backend_cache().wrap(send)
+
+        cached_send(self.URL)
+        cached_send(self.URL)
+        self.assertEqual(send.calls, 2)
+
+    def test_open_breaker_serves_last_good_response(self):
+        """Test that an open breaker answers from the cache, however old the response."""
+        send = self.sender(200, ReadTimeout(), ReadTimeout(), 200)
+        cache = self.backend_cache(fresh_ttl=1, stale_ttl=0, threshold=2)
+        cached_send = cache.wrap(send)
+        breaker = cache.breakers["reviews"]
+
+        good = cached_send(self.URL)
+        for _ in range(2):
+            self.now += 2
+            self.assertRaises(ReadTimeout, cached_send, self.URL)
+        self.assertTrue(breaker.is_open)
+        self.now += 3
+        self.assertIs(cached_send(self.URL), good)
+        self.assertEqual(send.calls, 3)
+        self.assertEqual((breaker.opens, cache.served[("reviews", "fallback")]), (1, 1))
+
+    def test_open_breaker_without_response_fails_fast(self):
+        """Test that an open breaker rejects calls it has no response for."""
+        send = self.sender(500)
+        cached_send = self.backend_cache(threshold=1).wrap(send)
+
+        cached_send(self.URL)
+        self.assertRaises(CircuitOpenError, cached_send, self.URL)
+        self.assertEqual(send.calls, 1)
+
+    def test_rejected_calls_fall_back_without_tripping_the_breaker(self):
+        """Test that a call rejected by a bulkhead is served cached and counts as no failure."""
+        send = self.sender(200, BulkheadFullError(), BulkheadFullError())
+        cache = self.backend_cache(fresh_ttl=1, stale_ttl=0, threshold=1)
+        cached_send = cache.wrap(send)
+
+        good = cached_send(self.URL)
+        self.now += 2
+        self.assertIs(cached_send(self.URL), good)
+        self.assertRaises(BulkheadFullError, cached_send, "http://reviews:9080/reviews/1")
+        self.assertFalse(cache.breakers["reviews"].is_open)
+
+    def test_breaker_closes_after_successful_trial(self):
+        """Test that one call is let through after the reset timeout and closes the breaker."""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        self.now += 5
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        self.now += 5
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+        self.assertEqual((breaker.opens, breaker.rejections), (2, 3))
+
+
+class TestConcurrentFanOut(unittest.TestCase):
+    """Test cases for ConcurrentFanOut."""
+
+    def fetcher(self, delay, result):
+        """Return a fetch function that takes a while and records its calls."""
+
+        def fetch(product_id, headers):
+            fetch.calls += 1
+            time.sleep(delay)
+            return result
+
+        fetch.calls = 0
+        return fetch
+
+    def render(self, fan_out, path="/productpage", reviews=True, headers=None):
+        """Serve a request the way the upstream page handler does, returning its fetches."""
+        results = []
+
+        def app(environ, start_response):
+            results.append(fan_out.details(0, headers or {}))
+            if reviews:
+                results.append(fan_out.reviews(0, headers or {}))
+            return [b""]
+
+        fan_out.wrap(app)({"PATH_INFO": path}, None)
+        return results
+
+    def test_details_and_reviews_overlap(self):
+        """Test that a render takes about as long as the slowest backend."""
+        details = self.fetcher(0.2, (200, {"id": 0}))
+        reviews = self.fetcher(0.2, (200, {"reviews": []}))
+        fan_out = ConcurrentFanOut(details, reviews, max_concurrency=0, deadline=1.0)
+
+        start = time.monotonic()
+        results = self.render(fan_out, headers={"x-request-id": "1"})
+        self.assertEqual(results, [(200, {"id": 0}), (200, {"reviews": []})])
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual((details.calls, reviews.calls, fan_out.fanouts), (1, 1, 1))
+
+    def test_reviews_past_the_deadline_are_reported_unavailable(self):
+        """Test that a slow reviews backend does not hold the page past the deadline."""
+        details = self.fetcher(0, (200, {"id": 0}))
+        reviews = self.fetcher(0.5, (200, {"reviews": []}))
+        fan_out = ConcurrentFanOut(details, reviews, max_concurrency=0, deadline=0.05)
+
+        _, (status, body) = self.render(fan_out)
+        self.assertEqual(status, 504)
+        self.assertIn("error", body)
+        self.assertEqual(fan_out.timeouts, 1)
+
+    def test_only_page_renders_prefetch_reviews(self):
+        """Test that routes which only read details, such as the API, do not fetch reviews."""
+        details = self.fetcher(0, (200, {}))
+        reviews = self.fetcher(0, (200, {}))
+        fan_out = ConcurrentFanOut(details, reviews, max_concurrency=0, deadline=1.0)
+
+        self.render(fan_out, path="/api/v1/products/0", reviews=False)
+        fan_out.details(0, {})
+        self.assertEqual((details.calls, reviews.calls, fan_out.fanouts), (2, 0, 0))
+
+    def test_sequential_past_the_concurrency_limit(self):
+        """Test that renders past the background fetch limit keep the upstream call order."""
+        details = self.fetcher(0, (200, {}))
+        reviews = self.fetcher(0.3, (200, {}))
+        fan_out = ConcurrentFanOut(details, reviews, max_concurrency=1, deadline=1.0)
+
+        # The first render leaves its prefetch unused but still in flight
+        self.render(fan_out, reviews=False)
+        self.assertIsNone(fan_out._local.reviews)
+        self.render(fan_out)
+        self.assertEqual((reviews.calls, fan_out.fanouts), (2, 1))
+
+    def test_installed_around_the_upstream_app(self):
+        """Test that the upstream product API fetches details only once fan-out is installed."""
+        details = self.fetcher(0, (200, {}))
+        reviews = self.fetcher(0, (200, {}))
+
+        def wsgi_app(environ, start_response):
+            upstream.getProductDetails(0, {})
+            if environ["PATH_INFO"] == "/productpage":
+                upstream.getProductReviews(0, {})
+            return [b""]
+
+        upstream = SimpleNamespace(
+            getProductDetails=details,
+            getProductReviews=reviews,
+            app=SimpleNamespace(wsgi_app=wsgi_app),
+        )
+        fan_out = install_fan_out(upstream, max_concurrency=0, deadline=1.0)
+        upstream.app.wsgi_app({"PATH_INFO": "/api/v1/products/0"}, None)
+        self.assertEqual((details.calls, reviews.calls, fan_out.fanouts), (1, 0, 0))
+        upstream.app.wsgi_app({"PATH_INFO": "/productpage"}, None)
+        self.assertEqual((details.calls, reviews.calls, fan_out.fanouts), (2, 1, 1))
@@ -0,0 +1,94 @@
+"""Unit tests for the gunicorn sizing."""
+
+import unittest
+
+from sizing import (
+    DEFAULT_WORKERS,
+    ContainerLimits,
+    GunicornSettings,
+    read_limits,
+    size_gunicorn,
+)
+
+MiB = 1024 * 1024
+
+
+class TestReadLimits(unittest.TestCase):
+    """Test cases for read_limits."""
+
+    def test_cgroup_v2(self):
+        """Test that cgroup v2 quotas and limits are read."""
+        files = {
+            "/sys/fs/cgroup/cpu.max": "150000 100000\n",
+            "/sys/fs/cgroup/memory.max": "536870912\n",
+        }
+        self.assertEqual(read_limits(files.get), ContainerLimits(1.5, 512 * MiB))
+
+    def test_cgroup_v2_unlimited(self):
+        """Test that "max" means no limit."""
+        files = {"/sys/fs/cgroup/cpu.max": "max 100000\n", "/sys/fs/cgroup/memory.max": "max\n"}
+        self.assertEqual(read_limits(files.get), ContainerLimits(None, None))
+
+    def test_cgroup_v1(self):
+        """Test that cgroup v1 quotas and limits are read, and their unlimited values ignored."""
+        files = {
+            "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000\n",
+            "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000\n",
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes": "9223372036854771712\n",
+        }
+        self.assertEqual(read_limits(files.get), ContainerLimits(0.5, None))
+        files["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"] = "-1\n"
+        self.assertEqual(read_limits(files.get), ContainerLimits(None, None))
+
+    def test_no_cgroup_files(self):
+        """Test that unreadable cgroup files mean no limits."""
+        self.assertEqual(read_limits(lambda path: None), ContainerLimits(None, None))
+
+
+class TestSizeGunicorn(unittest.TestCase):
+    """Test cases for size_gunicorn."""
+
+    def test_unlimited_container_keeps_previous_defaults(self):
+        """Test that a container without limits gets the previous fixed worker count."""
+        settings = size_gunicorn(ContainerLimits(None, None))
+        self.assertEqual(settings, GunicornSettings(DEFAULT_WORKERS, "gevent", 1, 1000, 5, 2048))
+
+    def test_workers_follow_cpus(self):
+        """Test that workers follow 2 * CPUs + 1 when memory allows it."""
+        self.assertEqual(size_gunicorn(ContainerLimits(2, 4096 * MiB)).workers, 5)
+
+    def test_small_pod_is_not_overcommitted(self):
+        """Test that memory caps the workers and their connections in small pods."""
+        settings = size_gunicorn(ContainerLimits(2, 256 * MiB))
+        self.assertEqual(settings.workers, 2)
+        self.assertEqual(settings.worker_connections, 100)
+        self.assertEqual(settings.keep_alive, 2)
+
+    def test_tiny_pod_gets_one_worker(self):
+        """Test that at least one worker runs however small the pod."""
+        self.assertEqual(size_gunicorn(ContainerLimits(0.1, 64 * MiB)).workers, 1)
+
+    def test_overrides(self):
+        """Test that explicit settings are used as given."""
+        settings = size_gunicorn(
+            ContainerLimits(1, 256 * MiB),
+            workers=3,
+            worker_class="gthread",
+            threads=8,
+            worker_connections=50,
+            keep_alive=10,
+            backlog=64,
+        )
+        self.assertEqual(settings, GunicornSettings(3, "gthread", 8, 50, 10, 64))
+        self.assertEqual(
+            settings.args(),
+            "-w 3 -k gthread --threads 8 --worker-connections 50 --keep-alive 10 --backlog 64",
+        )
+
+    def test_recycling_gets_jitter(self):
+        """Test that recycled workers get a tenth of max-requests as jitter by default."""
+        settings = size_gunicorn(ContainerLimits(1, None), preload=True, max_requests=1000)
+        self.assertEqual(settings.max_requests_jitter, 100)
+        self.assertTrue(
+            settings.args().endswith("--preload --max-requests 1000 --max-requests-jitter 100")
+        )
@@ -0,0 +1,84 @@
+"""Unit tests for the stress action load generator."""
+
+import unittest
+
+import httpx
+
+from stress import StressReport, stress, stress_backend
+
+
+def mock_client(handler):
+    """Return an httpx client factory whose requests are answered by handler."""
+    return lambda **kwargs: httpx.Client(transport=httpx.MockTransport(handler), **kwargs)
+
+
+class TestStress(unittest.TestCase):
+    """Test cases for the stress load generator."""
+
+    def test_rate_limits_requests(self):
+        """Test that a rate spreads requests evenly over the duration."""
+        report = stress_backend(
+            "http://details:9080/details/0",
+            duration=0.5,
+            rate=20,
+            concurrency=2,
+            client_factory=mock_client(lambda request: httpx.Response(200)),
+        )
+        self.assertEqual((report.requests, report.errors), (10, 0))
+        self.assertAlmostEqual(report.throughput, 20, delta=4)
+
+    def test_max_requests_ends_run_early(self):
+        """Test that a run without a rate stops once the request limit is reached."""
+        report = stress_backend(
+            "http://details:9080/details/0",
+            duration=10,
+            concurrency=4,
+            max_requests=25,
+            client_factory=mock_client(lambda request: httpx.Response(200)),
+        )
+        self.assertEqual(report.requests, 25)
+        self.assertLess(report.elapsed, 10)
+
+    def test_errors_and_timeouts_are_counted(self):
+        """Test that 5xx responses and transport errors count as errors."""
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if len(calls) % 2:
+                raise httpx.ReadTimeout("timed out", request=request)
+            return httpx.Response(503)
+
+        report = stress_backend(
+            "http://ratings:9080/ratings/0",
+            duration=0.1,
+            rate=40,
+            client_factory=mock_client(handler),
+        )
+        self.assertEqual(report.errors, report.requests)
+        self.assertEqual(report.requests, 4)
+
+    def test_each_backend_gets_its_own_path(self):
+        """Test that every backend is sent the request the productpage would send."""
+        seen = set()
+
+        def handler(request):
+            seen.add(str(request.url))
+            return httpx.Response(200)
+
+        reports = stress(
+            {"details": "http://details:9080", "reviews": "http://reviews:9080/"},
+            0.05,
+            rate=20,
+            client_factory=mock_client(handler),
+        )
+        self.assertEqual(set(reports), {"details", "reviews"})
+        self.assertEqual(seen, {"http://details:9080/details/0", "http://reviews:9080/reviews/0"})
+
+    def test_percentiles(self):
+        """Test that percentiles use the nearest rank of the recorded latencies."""
+        report = StressReport(100, 0, 1.0, [i / 1000 for i in range(100, 0, -1)])
+        self.assertEqual(report.percentile(50), 0.05)
+        self.assertEqual(report.percentile(99), 0.099)
+        self.assertEqual(report.results()["latency-max"], "100.0")
+        self.assertEqual(StressReport(0, 0, 0, []).results()["throughput"], "0.0")
@@ -4,13 +4,10 @@
 import logging
 from typing import Dict
 
+from charms.bookinfo_lib.v0.api_calls import ApiCalls
 from charms.bookinfo_lib.v0.bookinfo_service import BookinfoServiceProvider
-from charms.istio_beacon_k8s.v0.service_mesh import (
-    AppPolicy,
-    Endpoint,
-    Method,
-    ServiceMeshConsumer,
-)
+from charms.bookinfo_lib.v0.dispatch import mesh_dispatching
+from charms.bookinfo_lib.v0.workload import PebbleWorkload
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
@@ -29,19 +26,46 @@ class RatingsK8sCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self._stored.set_default(pebble_ready=False)
+        # Pebble, hook tool and Kubernetes calls of the hook, logged once it is handled
+        self.api_calls = ApiCalls(self)
+        self._stored.set_default(pebble_ready=False, opened_port=0)
 
         self.container = self.unit.get_container("bookinfo-ratings")
+        self.workload = PebbleWorkload(self, self.container, "ratings", PORT)
 
         # Core event handlers
         self.framework.observe(self.on.bookinfo_ratings_pebble_ready, self._on_pebble_ready)
+        self.framework.observe(
+            self.on.bookinfo_ratings_pebble_check_failed, self._on_pebble_check_changed
+        )
+        self.framework.observe(
+            self.on.bookinfo_ratings_pebble_check_recovered, self._on_pebble_check_changed
+        )
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.update_status, self._on_update_status)
 
         # Service provider
-        self.service_provider = BookinfoServiceProvider(self, "ratings", PORT)
+        self.service_provider = BookinfoServiceProvider(
+            self, "ratings", PORT, ready=self.workload.is_serving
+        )
+
+        # The service mesh library imports lightkube and pydantic, so it is only set up in the
+        # hooks it handles
+        if mesh_dispatching(self.meta):
+            self._setup_mesh()
+
+        # Initial port configuration
+        self._set_ports()
+
+    def _setup_mesh(self):
+        """Join the service mesh with authorization policies for the workload."""
+        from charms.istio_beacon_k8s.v0.service_mesh import (
+            AppPolicy,
+            Endpoint,
+            Method,
+            ServiceMeshConsumer,
+        )
 
-        # Service mesh with authorization policies
         self._mesh = ServiceMeshConsumer(
             self,
             policies=[
@@ -55,15 +79,25 @@ class RatingsK8sCharm(CharmBase):
                 )
             ],
         )
+        self.api_calls.instrument_mesh(self._mesh, self._lightkube_client)
 
-        # Initial port configuration
-        self._set_ports()
+    def _lightkube_client(self):
+        """Return a Kubernetes client for the service mesh, as the library would create."""
+        from lightkube import Client
+
+        return Client(namespace=self.model.name, field_manager=self.app.name)
 
     def _on_pebble_ready(self, event):
         """Handle the pebble ready event."""
         self._stored.pebble_ready = True
+        self.workload.reset()
         self._reconcile()
 
+    def _on_pebble_check_changed(self, event):
+        """Update the status as soon as the health check fails or recovers, or a drain ends."""
+        if self.workload.handles(event.info.name):
+            self._reconcile()
+
     def _on_config_changed(self, event):
         """Handle config changed event."""
         self._reconcile()
@@ -78,45 +112,46 @@ class RatingsK8sCharm(CharmBase):
         This is the main reconciliation loop that ensures the charm
         converges to the desired state regardless of which event triggered it.
         """
+        serving = self._reconcile_workload()
+        # Consumers lose the URL while the workload is down or failing its health check. Only
+        # the leader writes it, from the health of its own workload.
+        self.service_provider.update(ready=serving)
+
+    def _reconcile_workload(self) -> bool:
+        """Converge the workload and status, returning whether the workload is serving."""
         # Update status first
         if not self._stored.pebble_ready:
             self.unit.status = WaitingStatus("Waiting for pebble ready")
-            return
+            return False
 
         if not self.container.can_connect():
             self.unit.status = MaintenanceStatus("Waiting for container")
-            return
+            return False
 
         # Update configuration
         try:
             self._update_layer()
             self._set_ports()
 
-            # Check if service is running
-            service = self.container.get_service("ratings")
-            if service.is_running():
-                self.unit.status = ActiveStatus("Ready")
-            else:
+            # Check if service is running and not failing its health check
+            if not self.workload.is_running():
                 self.unit.status = MaintenanceStatus("Service not running")
+            elif problem := self.workload.health_problem():
+                self.unit.status = MaintenanceStatus(problem)
+            else:
+                self.unit.status = ActiveStatus("Ready")
+                return True
         except Exception as e:
             logger.error(f"Failed to reconcile: {e}")
             self.unit.status = BlockedStatus(f"Failed to reconcile: {str(e)}")
+        return False
 
     def _update_layer(self):
-        """Update the Pebble layer configuration."""
-        if not self.container.can_connect():
-            logger.debug("Cannot connect to container")
-            return
-
-        layer = self._generate_layer()
-        self.container.add_layer("ratings", layer, combine=True)
+        """Update the Pebble layer configuration, draining the service before a restart.
 
-        try:
-            self.container.replan()
-            logger.info("Service layer updated")
-        except Exception as e:
-            logger.error(f"Failed to replan service: {e}")
-            raise
+        Only called once the container is known to be reachable.
+        """
+        self.workload.apply(self._generate_layer(), float(self.config["drain-timeout"]))
 
     def _generate_layer(self) -> LayerDict:
         """Generate the Pebble layer configuration."""
@@ -132,6 +167,10 @@ class RatingsK8sCharm(CharmBase):
                     "environment": self._get_environment(),
                 }
             },
+            "checks": self.workload.checks(
+                float(self.config["health-check-period"]),
+                int(self.config["health-check-threshold"]),
+            ),
         }
 
     def _get_environment(self) -> Dict[str, str]:
@@ -146,8 +185,11 @@ class RatingsK8sCharm(CharmBase):
 
     def _set_ports(self):
         """Open the application ports to fix Juju's 65535 placeholder issue."""
+        if self._stored.opened_port == PORT:
+            return
         try:
             self.unit.open_port("tcp", PORT)
+            self._stored.opened_port = PORT
             logger.info(f"Opened TCP port {PORT}")
         except Exception as e:
             logger.warning(f"Failed to open port: {e}")
@@ -0,0 +1,83 @@
+"""Hook latency benchmarks for the ratings charm.
+
+Each event is dispatched to a charm whose workload is already running, as on a deployed unit.
+The cold hooks are set up in fresh interpreters instead, to measure the imports they skip.
+Run them with ``tox -e benchmark``, which writes the results to ``benchmark.json``.
+"""
+
+import itertools
+
+import ops
+import ops.testing
+import pytest
+from charms.bookinfo_lib.v0.benchmark import IMPORT_BUDGET
+
+from charm import RatingsK8sCharm
+
+REMOTE_APP = "bookinfo-reviews-k8s"
+
+
+@pytest.fixture
+def harness():
+    """Start the charm with its workload running."""
+    harness = ops.testing.Harness(RatingsK8sCharm)
+    harness.set_leader(True)
+    harness.begin()
+    harness.container_pebble_ready("bookinfo-ratings")
+    yield harness
+    harness.cleanup()
+
+
+def test_pebble_ready(benchmark, harness):
+    benchmark("pebble-ready", lambda: harness.container_pebble_ready("bookinfo-ratings"))
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_config_changed(benchmark, harness):
+    # Alternate the configuration so that every dispatch has a new layer to apply. The hook
+    # drains the workload rather than restarting it, and leaves the restart to a later hook.
+    levels = itertools.cycle(["debug", "info"])
+    benchmark("config-changed", lambda: harness.update_config({"log-level": next(levels)}))
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_update_status(benchmark, harness):
+    benchmark("update-status", harness.charm.on.update_status.emit)
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_relation_changed(benchmark, harness):
+    rel_id = harness.add_relation("ratings", REMOTE_APP)
+    nonces = itertools.count()
+    benchmark(
+        "relation-changed",
+        lambda: harness.update_relation_data(rel_id, REMOTE_APP, {"nonce": str(next(nonces))}),
+    )
+    assert harness.get_relation_data(rel_id, harness.charm.app)["url"]
+
+
+def test_relation_broken(benchmark, harness):
+    rel_ids = []
+    benchmark(
+        "relation-broken",
+        lambda: harness.remove_relation(rel_ids.pop()),
+        setup=lambda: rel_ids.append(harness.add_relation("ratings", REMOTE_APP)),
+    )
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+
+
+def test_import_within_budget(benchmark):
+    # Every hook imports the charm anew, so a slower import fails the run
+    seconds = benchmark.import_seconds()
+    assert seconds < IMPORT_BUDGET, f"charm import took {seconds:.3f}s"
+
+
+def test_cold_update_status(benchmark):
+    # A hook the service mesh library does not handle leaves it unimported
+    assert not benchmark.cold("cold-update-status", RatingsK8sCharm, "update-status")
+
+
+def test_cold_mesh_relation_changed(benchmark):
+    assert benchmark.cold(
+        "cold-service-mesh-relation-changed", RatingsK8sCharm, "service-mesh-relation-changed"
+    )
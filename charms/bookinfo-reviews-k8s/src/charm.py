@@ -2,19 +2,16 @@
 """Charm for the Reviews microservice."""
 
 import logging
-from typing import Dict, Optional
+from typing import Dict, NamedTuple, Optional, Tuple
 from urllib.parse import urlparse
 
+from charms.bookinfo_lib.v0.api_calls import ApiCalls
 from charms.bookinfo_lib.v0.bookinfo_service import (
     BookinfoServiceConsumer,
     BookinfoServiceProvider,
 )
-from charms.istio_beacon_k8s.v0.service_mesh import (
-    AppPolicy,
-    Endpoint,
-    Method,
-    ServiceMeshConsumer,
-)
+from charms.bookinfo_lib.v0.dispatch import mesh_dispatching
+from charms.bookinfo_lib.v0.workload import PebbleWorkload
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
@@ -27,6 +24,14 @@ PORT = 9080
 SUPPORTED_VERSIONS = ["v1", "v2", "v3"]
 
 
+class Backend(NamedTuple):
+    """A related backend service, as published in its relation data."""
+
+    url: str
+    hostname: str
+    port: int
+
+
 class ReviewsK8sCharm(CharmBase):
     """Charm for the Reviews microservice."""
 
@@ -34,23 +39,51 @@ class ReviewsK8sCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self._stored.set_default(pebble_ready=False)
+        # Pebble, hook tool and Kubernetes calls of the hook, logged once it is handled
+        self.api_calls = ApiCalls(self)
+        self._stored.set_default(pebble_ready=False, opened_port=0, backend_hosts={})
+        self._backend_snapshot: Optional[Dict[str, Backend]] = None
 
         self.container = self.unit.get_container("bookinfo-reviews")
+        self.workload = PebbleWorkload(self, self.container, "reviews", PORT)
 
         # Core event handlers
         self.framework.observe(self.on.bookinfo_reviews_pebble_ready, self._on_pebble_ready)
+        self.framework.observe(
+            self.on.bookinfo_reviews_pebble_check_failed, self._on_pebble_check_changed
+        )
+        self.framework.observe(
+            self.on.bookinfo_reviews_pebble_check_recovered, self._on_pebble_check_changed
+        )
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.update_status, self._on_update_status)
 
         # Service provider
-        self.service_provider = BookinfoServiceProvider(self, "reviews", PORT)
+        self.service_provider = BookinfoServiceProvider(
+            self, "reviews", PORT, ready=self.workload.is_serving
+        )
 
         # Service consumer
         self.ratings_consumer = BookinfoServiceConsumer(self, "ratings")
         self.framework.observe(self.ratings_consumer.on.url_changed, self._on_relation_changed)
 
-        # Service mesh with authorization policies
+        # The service mesh library imports lightkube and pydantic, so it is only set up in the
+        # hooks it handles
+        if mesh_dispatching(self.meta):
+            self._setup_mesh()
+
+        # Initial port configuration
+        self._set_ports()
+
+    def _setup_mesh(self):
+        """Join the service mesh with authorization policies for the workload."""
+        from charms.istio_beacon_k8s.v0.service_mesh import (
+            AppPolicy,
+            Endpoint,
+            Method,
+            ServiceMeshConsumer,
+        )
+
         self._mesh = ServiceMeshConsumer(
             self,
             policies=[
@@ -64,15 +97,25 @@ class ReviewsK8sCharm(CharmBase):
                 )
             ],
         )
+        self.api_calls.instrument_mesh(self._mesh, self._lightkube_client)
 
-        # Initial port configuration
-        self._set_ports()
+    def _lightkube_client(self):
+        """Return a Kubernetes client for the service mesh, as the library would create."""
+        from lightkube import Client
+
+        return Client(namespace=self.model.name, field_manager=self.app.name)
 
     def _on_pebble_ready(self, event):
         """Handle the pebble ready event."""
         self._stored.pebble_ready = True
+        self.workload.reset()
         self._reconcile()
 
+    def _on_pebble_check_changed(self, event):
+        """Update the status as soon as the health check fails or recovers, or a drain ends."""
+        if self.workload.handles(event.info.name):
+            self._reconcile()
+
     def _on_config_changed(self, event):
         """Handle config changed event."""
         self._reconcile()
@@ -91,19 +134,29 @@ class ReviewsK8sCharm(CharmBase):
         This is the main reconciliation loop that ensures the charm
         converges to the desired state regardless of which event triggered it.
         """
+        serving = self._reconcile_workload()
+        # Consumers lose the URL while the workload is down or failing its health check. Only
+        # the leader writes it, from the health of its own workload.
+        self.service_provider.update(ready=serving)
+
+    def _reconcile_workload(self) -> bool:
+        """Converge the workload and status, returning whether the workload is serving."""
+        # Read relation data afresh, as several events can be emitted on the same charm
+        self._backend_snapshot = None
+
         # Validate configuration first
         if not self._validate_config():
             self.unit.status = BlockedStatus(f"Invalid version: {self.config['version']}")
-            return
+            return False
 
         # Check if pebble is ready
         if not self._stored.pebble_ready:
             self.unit.status = WaitingStatus("Waiting for pebble ready")
-            return
+            return False
 
         if not self.container.can_connect():
             self.unit.status = MaintenanceStatus("Waiting for container")
-            return
+            return False
 
         # Check if required relations are available
         version = self.config["version"]
@@ -111,31 +164,51 @@ class ReviewsK8sCharm(CharmBase):
 
         if version in ["v2", "v3"] and not ratings_url:
             self.unit.status = WaitingStatus(f"Version {version} requires ratings service")
-            return
+            return False
 
         # Update configuration
         try:
             self._update_layer()
             self._set_ports()
 
-            # Check if service is running
-            service = self.container.get_service("reviews")
-            if service.is_running():
+            # Check if service is running and not failing its health check
+            if not self.workload.is_running():
+                self.unit.status = MaintenanceStatus("Service not running")
+            elif problem := self.workload.health_problem():
+                self.unit.status = MaintenanceStatus(problem)
+            else:
                 status_msg = f"Running version {version}"
                 if ratings_url:
                     status_msg += " with ratings"
                 self.unit.status = ActiveStatus(status_msg)
-            else:
-                self.unit.status = MaintenanceStatus("Service not running")
+                return True
         except Exception as e:
             logger.error(f"Failed to reconcile: {e}")
             self.unit.status = BlockedStatus(f"Failed to reconcile: {str(e)}")
+        return False
 
     def _validate_config(self) -> bool:
         """Validate configuration."""
         return self.config["version"] in SUPPORTED_VERSIONS
 
     def _get_ratings_url(self) -> Optional[str]:
+        """Get the ratings service URL from the relation snapshot."""
+        ratings = self._backends.get("ratings")
+        return ratings.url if ratings else None
+
+    @property
+    def _backends(self) -> Dict[str, Backend]:
+        """Return the related backend services, reading relation data once per dispatch."""
+        if self._backend_snapshot is None:
+            self._backend_snapshot = {}
+            if url := self._read_ratings_url():
+                parsed = urlparse(url)
+                self._backend_snapshot["ratings"] = Backend(
+                    url, parsed.hostname or "ratings", parsed.port or PORT
+                )
+        return self._backend_snapshot
+
+    def _read_ratings_url(self) -> Optional[str]:
         """Get the ratings service URL directly from relation data."""
         try:
             # Get the first relation for ratings (typically only one)
@@ -148,20 +221,11 @@ class ReviewsK8sCharm(CharmBase):
         return None
 
     def _update_layer(self):
-        """Update the Pebble layer configuration."""
-        if not self.container.can_connect():
-            logger.debug("Cannot connect to container")
-            return
-
-        layer = self._generate_layer()
-        self.container.add_layer("reviews", layer, combine=True)
+        """Update the Pebble layer configuration, draining the service before a restart.
 
-        try:
-            self.container.replan()
-            logger.info("Service layer updated")
-        except Exception as e:
-            logger.error(f"Failed to replan service: {e}")
-            raise
+        Only called once the container is known to be reachable.
+        """
+        self.workload.apply(self._generate_layer(), float(self.config["drain-timeout"]))
 
     def _generate_layer(self) -> LayerDict:
         """Generate the Pebble layer configuration."""
@@ -177,6 +241,10 @@ class ReviewsK8sCharm(CharmBase):
                     "environment": self._get_environment(),
                 }
             },
+            "checks": self.workload.checks(
+                float(self.config["health-check-period"]),
+                int(self.config["health-check-threshold"]),
+            ),
         }
 
     def _get_environment(self) -> Dict[str, str]:
@@ -190,12 +258,11 @@ class ReviewsK8sCharm(CharmBase):
             "LOG_LEVEL": self.config["log-level"],
         }
 
-        # Extract hostname and port from URL for upstream compatibility
-        ratings_url = self._get_ratings_url()
-        if ratings_url:
-            parsed = urlparse(ratings_url)
-            env["RATINGS_HOSTNAME"] = parsed.hostname or "ratings"
-            env["RATINGS_SERVICE_PORT"] = str(parsed.port or PORT)
+        # Hostname and port of ratings for upstream compatibility
+        if ratings := self._backend_hosts().get("ratings"):
+            hostname, port = ratings
+            env["RATINGS_HOSTNAME"] = hostname
+            env["RATINGS_SERVICE_PORT"] = str(port)
             env["ENABLE_RATINGS"] = "true"
 
         # Add star color based on version
@@ -206,10 +273,30 @@ class ReviewsK8sCharm(CharmBase):
 
         return env
 
+    def _backend_hosts(self) -> Dict[str, Tuple[str, int]]:
+        """Return the hostname and port of each related backend.
+
+        Ratings withdraws its URL while it is not ready. Its last known hostname and port are
+        kept while it is still related, so that the environment does not change and drain and
+        restart the service when ratings is only briefly unhealthy.
+        """
+        known = self._stored.backend_hosts
+        hosts = {}
+        if ratings := self._backends.get("ratings"):
+            hosts["ratings"] = [ratings.hostname, ratings.port]
+        elif "ratings" in known and self.model.relations.get("ratings"):
+            hosts["ratings"] = list(known["ratings"])
+        if hosts != dict(known):
+            self._stored.backend_hosts = hosts
+        return {name: (hostname, port) for name, (hostname, port) in hosts.items()}
+
     def _set_ports(self):
         """Open the application ports to fix Juju's 65535 placeholder issue."""
+        if self._stored.opened_port == PORT:
+            return
         try:
             self.unit.open_port("tcp", PORT)
+            self._stored.opened_port = PORT
             logger.info(f"Opened TCP port {PORT}")
         except Exception as e:
             logger.warning(f"Failed to open port: {e}")
@@ -0,0 +1,7 @@
+"""Fixtures for reviews charm hook latency benchmarks."""
+
+from charms.bookinfo_lib.v0.benchmark import benchmark_fixture
+
+CHARM = "bookinfo-reviews-k8s"
+
+benchmark = benchmark_fixture(CHARM)
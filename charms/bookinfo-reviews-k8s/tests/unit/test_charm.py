@@ -1,11 +1,25 @@
 """Unit tests for reviews charm."""
 
+import os
+import subprocess
+import sys
 import unittest
+from unittest.mock import patch
 
 import ops.testing
 
 from charm import ReviewsK8sCharm
 
+# Libraries the charm imports only in the hooks that use them
+DEFERRED_MODULES = {
+    "charms.istio_beacon_k8s.v0.service_mesh",
+    "lightkube",
+    "pydantic",
+    "httpx",
+}
+# Calls an update-status hook may make to each API once the workload is running
+UPDATE_STATUS_BUDGET = {"pebble": 5, "hook-tools": 2, "kubernetes": 0}
+
 
 class TestReviewsCharm(unittest.TestCase):
     """Test cases for ReviewsK8sCharm."""
@@ -27,3 +41,110 @@ class TestReviewsCharm(unittest.TestCase):
             self.harness.model.unit.status,
             (ops.WaitingStatus, ops.ActiveStatus, ops.MaintenanceStatus),
         )
+
+    def test_config_change_applied_once_drained(self):
+        """Test that a config change drains the workload and restarts it when drained."""
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        container = self.harness.charm.container
+        with patch("charms.bookinfo_lib.v0.workload.time.time", return_value=1000.0):
+            self.harness.update_config({"log-level": "debug"})
+        self.assertTrue(container.exists("/tmp/reviews.drain"))
+
+        with patch("charms.bookinfo_lib.v0.workload.time.time", return_value=1007.0):
+            self.harness.charm.on.bookinfo_reviews_pebble_check_failed.emit(
+                container, "reviews-drained"
+            )
+        self.assertFalse(container.exists("/tmp/reviews.drain"))
+        plan = self.harness.get_container_pebble_plan("bookinfo-reviews")
+        self.assertEqual(plan.services["reviews"].environment["LOG_LEVEL"], "debug")
+
+    def test_unchanged_state_skips_replan(self):
+        """Test that a hook with the same desired state does not replan the workload."""
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        with patch.object(ops.Container, "replan") as replan:
+            self.harness.charm.on.update_status.emit()
+        replan.assert_not_called()
+
+        with patch.object(ops.Container, "replan") as replan:
+            self.harness.update_config({"log-level": "debug", "drain-timeout": 0.0})
+        replan.assert_called_once()
+
+    def test_ratings_relation_read_once_per_dispatch(self):
+        """Test that status and environment share one read of the ratings relation."""
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        rel_id = self.harness.add_relation("ratings", "ratings")
+        self.harness.update_relation_data(rel_id, "ratings", {"url": "http://ratings:9081"})
+        charm = self.harness.charm
+
+        with patch.object(charm, "_read_ratings_url", wraps=charm._read_ratings_url) as read:
+            charm.on.update_status.emit()
+        read.assert_called_once()
+        environment = charm._get_environment()
+        self.assertEqual(environment["RATINGS_HOSTNAME"], "ratings")
+        self.assertEqual(environment["RATINGS_SERVICE_PORT"], "9081")
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)
+
+    def test_withdrawn_ratings_url_keeps_environment(self):
+        """Test that ratings withdrawing its URL neither drains nor restarts the service."""
+        self.harness.update_config({"drain-timeout": 0.0})
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        rel_id = self.harness.add_relation("ratings", "ratings")
+        self.harness.update_relation_data(rel_id, "ratings", {"url": "http://ratings:9081"})
+
+        with patch.object(ops.Container, "replan") as replan:
+            self.harness.update_relation_data(rel_id, "ratings", {"url": "", "ready": "false"})
+        replan.assert_not_called()
+        plan = self.harness.get_container_pebble_plan("bookinfo-reviews")
+        environment = plan.services["reviews"].environment
+        self.assertEqual(environment["RATINGS_HOSTNAME"], "ratings")
+        self.assertEqual(environment["ENABLE_RATINGS"], "true")
+
+        # Removing the relation drops the variables
+        self.harness.remove_relation(rel_id)
+        self.assertNotIn("ENABLE_RATINGS", self.harness.charm._get_environment())
+
+    def test_import_defers_heavy_libraries(self):
+        """Test that importing the charm leaves out the mesh, Kubernetes and validation libs."""
+        code = "import sys, charm; print(*sys.modules)"
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        result = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+        )
+        self.assertFalse(DEFERRED_MODULES & set(result.stdout.split()))
+
+    def test_mesh_set_up_only_in_its_hooks(self):
+        """Test that the service mesh library is only loaded for the hooks it handles."""
+        for hook, expected in (("update-status", False), ("reviews-relation-created", True)):
+            with patch.dict(os.environ, {"JUJU_DISPATCH_PATH": f"hooks/{hook}"}):
+                harness = ops.testing.Harness(ReviewsK8sCharm)
+                self.addCleanup(harness.cleanup)
+                harness.begin()
+            self.assertEqual(hasattr(harness.charm, "_mesh"), expected, hook)
+
+    def test_update_status_within_call_budget(self):
+        """Test that update-status stays within its budget of API calls."""
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        calls = self.harness.charm.api_calls
+        calls.reset()
+        self.harness.charm.on.update_status.emit()
+        for api, budget in UPDATE_STATUS_BUDGET.items():
+            self.assertLessEqual(calls.total(api), budget, calls.summary())
+
+    def test_health_check_drives_status(self):
+        """Test that the status follows the health check as soon as it fails or recovers."""
+        self.harness.container_pebble_ready("bookinfo-reviews")
+        plan = self.harness.get_container_pebble_plan("bookinfo-reviews")
+        health = plan.checks["reviews-health"]
+        self.assertEqual(health.http, {"url": "http://localhost:9080/health"})
+        self.assertEqual((health.period, health.threshold), ("10s", 3))
+
+        container = self.harness.charm.container
+        events = self.harness.charm.on
+        check = container.get_check("reviews-health")
+        check.status = ops.pebble.CheckStatus.DOWN
+        events.bookinfo_reviews_pebble_check_failed.emit(container, "reviews-health")
+        self.assertEqual(self.harness.model.unit.status.message, "Health check failing")
+
+        check.status = ops.pebble.CheckStatus.UP
+        events.bookinfo_reviews_pebble_check_recovered.emit(container, "reviews-health")
+        self.assertIsInstance(self.harness.model.unit.status, ops.ActiveStatus)